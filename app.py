@@ -1,14 +1,18 @@
 # filepath: d:\Users\Lexar\OneDrive - MSFT\Documents\GitHub\Waste-for-WiFi-An-Eco-Incentive-Model-Machine-Using-Plastic-Bottles-for-Internet-Access\app.py
 import os
 import time
+
+_IMPORT_STARTED = time.perf_counter()
+
+import importlib
 import json
 import threading
 import argparse
 from functools import wraps
 from flask import Flask, current_app, make_response, redirect, send_from_directory, render_template, request, jsonify, url_for, Response, session
+from flask.json.provider import DefaultJSONProvider
 from pathlib import Path
 from datetime import datetime, timezone, timedelta
-from flask_sock import Sock
 
 try:
     from dotenv import load_dotenv
@@ -17,8 +21,61 @@ except ImportError:
     pass
 
 import db
+from records import Record, json_default
+from routes.portal import bp as portal_bp, get_device_identifier
+from services import (
+    access_control, admission, assets, capacity, http_cache, idempotency, insertion_lock, insertion_queue, page_cache,
+    rate_limit,
+)
+from services.http_cache import conditional
+from services.idempotency import idempotent
+from services.rate_limit import rate_limited
+
+_IMPORTS_DONE = time.perf_counter()
+
+BOTTLE_BATCH_MAX_EVENTS = 100
+
+
+class _JSONProvider(DefaultJSONProvider):
+    """jsonify() support for records.Record rows."""
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, Record):
+            return o.to_dict()
+        return DefaultJSONProvider.default(o)
 
-sock = Sock()
+
+class _StartupTimer:
+    """Milliseconds spent in each create_app phase, logged once at startup."""
+
+    def __init__(self, import_seconds):
+        self.phases = [("imports", import_seconds * 1000)]
+        self.started = self.last = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, (now - self.last) * 1000))
+        self.last = now
+
+    def report(self, logger):
+        timings = {phase: round(ms, 1) for phase, ms in self.phases}
+        timings["total"] = round(sum(ms for _, ms in self.phases), 1)
+        logger.info("Startup: %s", ", ".join(f"{phase} {ms}ms" for phase, ms in timings.items()))
+        return timings
+
+def _init_later(app, module_name):
+    """
+    Import services.<module_name> and call its init_app on a short-lived
+    thread. For background jobs whose first run comes well after startup, so
+    neither their imports nor their setup sit on the cold-start path.
+    """
+    def _run():
+        try:
+            importlib.import_module(f"services.{module_name}").init_app(app)
+        except Exception:
+            app.logger.exception("Starting %s failed", module_name)
+    threading.Thread(target=_run, daemon=True, name=f"init-{module_name}").start()
 
 ADMIN_USERNAME = os.environ.get("ADMIN_USERNAME")
 ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD")
@@ -36,6 +93,92 @@ def require_admin(view_func):
         return view_func(*args, **kwargs)
     return wrapper
 
+def _insertion_queue():
+    return current_app.extensions["insertion_queue"]
+
+def _insertion_lock():
+    return current_app.extensions["insertion_lock"]
+
+def _acquire_insertion_lock(device, ip, resolve):
+    """
+    Take the insertion lease for device through the FIFO waiting line: while
+    others wait, only the reserved head (or the current holder) gets it.
+    Returns (session_id, None), or (None, queue position) after putting the
+    device in line.
+    """
+    queue = _insertion_queue()
+    lock = _insertion_lock()
+    if queue.may_acquire(device):
+        session_id = lock.acquire(device, resolve)
+    else:
+        # Others are waiting; only a device that already holds the lock skips the line
+        session_id = lock.holder_session(device)
+    if not session_id:
+        return None, queue.enqueue(device, ip)
+    queue.notify_acquired(device)
+    return session_id, None
+
+def _busy_response(position):
+    return make_response(jsonify({
+        "error": "Machine is currently busy",
+        "message": f"Another user is inserting bottles. You are number {position['position']} in line.",
+        **position,
+    }), 409)
+
+def _release_insertion_lock(session_id, status):
+    """
+    Release the in-memory lease (if session_id holds it) and wait for the
+    status write-through, so the caller's own writes to the row land after it.
+    """
+    lock = _insertion_lock()
+    if lock.release(session_id, status):
+        lock.flush()
+        return True
+    return False
+
+def _start_session(session_id):
+    _release_insertion_lock(session_id, db.STATUS_ACTIVE)
+    db.start_session(session_id)
+
+def _set_status(session_id, status):
+    _release_insertion_lock(session_id, status)
+    db.update_session_status(session_id, status)
+
+def _set_active(session_id):
+    _set_status(session_id, db.STATUS_ACTIVE)
+
+def _is_running(session, now=None):
+    """True for a started session whose clock has not run out (it holds an active slot)."""
+    now = int(now if now is not None else time.time())
+    return session["session_start"] is not None and (session["session_end"] or 0) > now
+
+def _admit_or_park(manager, session, start):
+    """
+    Start a session whose clock has not started yet through the capacity cap.
+    With a free slot start(session_id) runs under the manager's lock and
+    None is returned. Otherwise the session is parked in awaiting_insertion
+    with its provisional end dropped, so nothing reads the paused time as
+    running; the insertion lock is freed for the next inserter and the
+    manager's wait info is returned. The cleanup loop starts parked sessions
+    once slots free up.
+    """
+    session_id = session["id"]
+    with manager.lock:
+        wait = manager.admit(session_id, session["seconds_earned"], db.get_active_session_ends())
+        if wait is None:
+            start(session_id)
+            return None
+    _release_insertion_lock(session_id, db.STATUS_AWAITING_INSERTION)
+    if session["session_end"] is not None:
+        db.update_session(session_id, {"session_end": None})
+    return wait
+
+def _queued_response(manager, wait):
+    resp = jsonify({"success": False, "queued": True, **wait})
+    resp.status_code = 202
+    resp.headers["Retry-After"] = str(manager.retry_after(wait["eta_seconds"]))
+    return resp
+
 def _build_admin_payload():
     """Compute metrics for admin dashboard."""
     db_conn = db.get_db()
@@ -53,17 +196,8 @@ def _build_admin_payload():
     total_reviews = db.count_total_reviews()
 
     # All ongoing sessions: awaiting_insertion + inserting + active
-    ongoing_rows = db_conn.execute(
-        """
-        SELECT id, mac_address, ip_address, status,
-               bottles_inserted, seconds_earned, session_end, updated_at
-        FROM sessions
-        WHERE status IN (?, ?, ?)
-        ORDER BY updated_at DESC
-        """,
-        (db.STATUS_AWAITING_INSERTION, db.STATUS_INSERTING, db.STATUS_ACTIVE),
-    ).fetchall()
-    ongoing_sessions = [dict(row) for row in ongoing_rows]
+    ongoing_sessions = db.get_ongoing_sessions()
+    session_usage = db.get_session_usage(s.id for s in ongoing_sessions if s.status == db.STATUS_ACTIVE)
 
     # All-time rating means
     rating_means = db.get_ratings_means_all_time()
@@ -75,11 +209,14 @@ def _build_admin_payload():
         "total_reviews": total_reviews,
         "rating_means": rating_means,
         "ongoing_sessions": ongoing_sessions,
+        "session_usage": session_usage,
+        "usage_today": db.get_usage_today(),
         "generated_at": now_utc,
     }
 
 def create_app(test_config=None):
     app = Flask(__name__, instance_relative_config=True)
+    app.json = _JSONProvider(app)
     app.config.from_mapping(
         SECRET_KEY=os.environ.get("SECRET_KEY", "dev"),
         DB_PATH=os.environ.get("DB_PATH", os.path.join(app.instance_path, "wifi_portal.db")),
@@ -88,51 +225,161 @@ def create_app(test_config=None):
         STALE_SESSION_AGE=int(os.environ.get("STALE_SESSION_AGE", 600)),
         CLEANUP_INTERVAL=int(os.environ.get("CLEANUP_INTERVAL", 60)),
         INSERTING_LOCK_TIMEOUT=int(os.environ.get("INSERTING_LOCK_TIMEOUT", 180)),
+        INSERTION_HEARTBEAT_GRACE=int(os.environ.get("INSERTION_HEARTBEAT_GRACE", 15)),
+        INSERTION_LOCK_SWEEP_INTERVAL=float(os.environ.get("INSERTION_LOCK_SWEEP_INTERVAL", 2)),
+        DB_PROFILE=os.environ.get("DB_PROFILE", "false").lower() == "true",
+        DB_PROFILE_SLOW_MS=float(os.environ.get("DB_PROFILE_SLOW_MS", 50)),
+        DB_PROFILE_EXPLAIN_SAMPLE=float(os.environ.get("DB_PROFILE_EXPLAIN_SAMPLE", 0.1)),
+        DB_PROFILE_REPORT=os.environ.get("DB_PROFILE_REPORT", os.path.join(app.instance_path, "query_profile.txt")),
+        MIGRATE_ON_START=os.environ.get("MIGRATE_ON_START", "true").lower() == "true",
+        MIGRATION_BATCH_SIZE=int(os.environ.get("MIGRATION_BATCH_SIZE", 5000)),
+        MIGRATION_BATCH_PAUSE=float(os.environ.get("MIGRATION_BATCH_PAUSE", 0.05)),
+        RETENTION_INTERVAL=int(os.environ.get("RETENTION_INTERVAL", 3600)),
+        SYSTEM_LOG_RETENTION_DAYS=int(os.environ.get("SYSTEM_LOG_RETENTION_DAYS", 90)),
+        BOTTLE_LOG_RETENTION_DAYS=int(os.environ.get("BOTTLE_LOG_RETENTION_DAYS", 180)),
+        RETENTION_BATCH_SIZE=int(os.environ.get("RETENTION_BATCH_SIZE", 1000)),
+        RETENTION_BATCH_PAUSE=float(os.environ.get("RETENTION_BATCH_PAUSE", 0.05)),
+        RETENTION_VACUUM_PAGES=int(os.environ.get("RETENTION_VACUUM_PAGES", 256)),
+        BACKUP_INTERVAL=int(os.environ.get("BACKUP_INTERVAL", 86400)),
+        BACKUP_DIR=os.environ.get("BACKUP_DIR", os.path.join(app.instance_path, "backups")),
+        BACKUP_KEEP=int(os.environ.get("BACKUP_KEEP", 7)),
+        BACKUP_STEP_PAGES=int(os.environ.get("BACKUP_STEP_PAGES", 256)),
+        BACKUP_STEP_PAUSE=float(os.environ.get("BACKUP_STEP_PAUSE", 0.01)),
+        QUEUE_CLAIM_TIMEOUT=int(os.environ.get("QUEUE_CLAIM_TIMEOUT", 30)),
+        QUEUE_ENTRY_TTL=int(os.environ.get("QUEUE_ENTRY_TTL", 30)),
+        QUEUE_STATE_PATH=os.environ.get("QUEUE_STATE_PATH", os.path.join(app.instance_path, "insertion_queue.json")),
+        IDEMPOTENCY_TTL=int(os.environ.get("IDEMPOTENCY_TTL", 86400)),
+        IDEMPOTENCY_CACHE_SIZE=int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", 1024)),
+        USE_BUILT_ASSETS=os.environ.get("USE_BUILT_ASSETS", "true").lower() == "true",
+        PAGE_CACHE=os.environ.get("PAGE_CACHE", "true").lower() == "true",
+        RATE_LIMIT_ENABLED=os.environ.get("RATE_LIMIT_ENABLED", "true").lower() == "true",
+        RATE_LIMITS=os.environ.get("RATE_LIMITS", ""),
+        RATE_LIMIT_SWEEP_INTERVAL=int(os.environ.get("RATE_LIMIT_SWEEP_INTERVAL", 60)),
+        RATE_LIMIT_MAX_BUCKETS=int(os.environ.get("RATE_LIMIT_MAX_BUCKETS", 10000)),
+        ADMISSION_ENABLED=os.environ.get("ADMISSION_ENABLED", "true").lower() == "true",
+        ADMISSION_MAX_IN_FLIGHT=int(os.environ.get("ADMISSION_MAX_IN_FLIGHT", 16)),
+        ADMISSION_LATENCY_TARGET_MS=float(os.environ.get("ADMISSION_LATENCY_TARGET_MS", 500)),
+        USE_IPTABLES=os.environ.get("USE_IPTABLES", "false").lower() == "true",
+        DRY_RUN=os.environ.get("DRY_RUN", "true").lower() == "true",
+        ACCESS_RECONCILE_INTERVAL=int(os.environ.get("ACCESS_RECONCILE_INTERVAL", 30)),
+        USAGE_INTERVAL=int(os.environ.get("USAGE_INTERVAL", 60)),
+        SHAPING_ENABLED=os.environ.get("SHAPING_ENABLED", "false").lower() == "true",
+        SHAPING_IFACE=os.environ.get("SHAPING_IFACE", "wlan0"),
+        SHAPING_RATE_KBIT=int(os.environ.get("SHAPING_RATE_KBIT", 2048)),
+        SHAPING_CEIL_KBIT=int(os.environ.get("SHAPING_CEIL_KBIT", 0)) or None,
+        SHAPING_UPLINK_KBIT=int(os.environ.get("SHAPING_UPLINK_KBIT", 0)) or None,
+        MAX_ACTIVE_SESSIONS=int(os.environ.get("MAX_ACTIVE_SESSIONS", 0)),
+        CAPACITY_AUTO=os.environ.get("CAPACITY_AUTO", "true").lower() == "true",
+        CAPACITY_UPLINK_KBIT=int(os.environ.get("CAPACITY_UPLINK_KBIT", 0)) or None,
+        CAPACITY_SESSION_KBIT_MIN=float(os.environ.get("CAPACITY_SESSION_KBIT_MIN", 256)),
+        CAPACITY_HEADROOM=float(os.environ.get("CAPACITY_HEADROOM", 0.9)),
     )
 
     if test_config:
         app.config.update(test_config)
 
     Path(app.instance_path).mkdir(parents=True, exist_ok=True)
-    sock.init_app(app)
+    startup = _StartupTimer(_IMPORTS_DONE - _IMPORT_STARTED)
+    # fingerprinted, precompressed static/dist (scripts/build_assets.py) if built
+    assets.init_app(app)
+    # rendered landing/rating pages kept as bytes
+    page_cache.init_app(app)
+    if app.config.get("DB_PROFILE"):
+        # only profiling runs load the profiler
+        from services import query_profiler
+        query_profiler.init_app(app)
+    insertion_queue.init_app(app)
+    startup.mark("extensions")
     db.init_db(app)
+    startup.mark("init_db")
+    # in-memory insertion lease; rebuilt from the 'inserting' row after a restart
+    insertion_lock.init_app(app)
+    startup.mark("insertion_lock")
+    # Idempotency-Key replay store for mutating endpoints
+    idempotency.init_app(app)
+    # ETag/304 for polled GET endpoints, invalidated by db.on_change
+    http_cache.init_app(app)
+    # per-device token buckets for captive probes and session lookup/create
+    rate_limit.init_app(app)
+    # 503 for low-priority requests while in-flight/latency are over budget
+    admission.init_app(app)
     app.teardown_appcontext(db.close_db)
 
+    # Apply pending migrations in the background; batched backfills yield the
+    # write lock between batches so the portal keeps serving during upgrades.
+    if app.config.get("MIGRATE_ON_START", True):
+        def _migrate(application):
+            try:
+                db.migrate(application)
+            except Exception:
+                application.logger.exception("Background migration failed")
+        threading.Thread(target=_migrate, args=(app,), daemon=True).start()
+
+    # client firewall access (in-memory, or iptables with USE_IPTABLES), kept in
+    # line with active sessions by a reconcile thread
+    access_control.init_app(app)
+    # per-session byte counters from the firewall, every USAGE_INTERVAL seconds
+    _init_later(app, "usage")
+    # cap on concurrently active sessions (fixed or tuned from measured usage);
+    # activations beyond it wait in line with their time paused
+    capacity.init_app(app)
+
     # start background cleanup thread to expire stale/finished sessions
     def _cleanup_loop(application):
         with application.app_context():
             while True:
                 try:
-                    stale_awaiting = db.expire_stale_awaiting_sessions(
-                        application.config.get("STALE_SESSION_AGE", 600)
+                    # the live lease is reclaimed by the insertion lock's own sweep
+                    # thread; only orphaned 'inserting' rows are expired here
+                    sweep = db.sweep_expired_sessions(
+                        awaiting_max_age=application.config.get("STALE_SESSION_AGE", 600),
+                        inserting_max_age=application.config.get("INSERTING_LOCK_TIMEOUT", 180),
+                        keep_session_ids=(application.extensions["insertion_lock"].holder_session(),),
                     )
-                    stale_inserting = db.expire_stale_inserting_sessions(
-                        application.config.get("INSERTING_LOCK_TIMEOUT", 180)
-                    )
-                    finished_active = db.expire_finished_active_sessions()
-                    if stale_awaiting or stale_inserting or finished_active:
+                    revoked = []
+                    if sweep["revoke_ips"]:
+                        revoked = application.extensions["access_control"].revoke_many(sweep["revoke_ips"])
+                    expired = sweep["expired"]
+                    if any(expired.values()):
                         application.logger.debug(
-                            "Session cleanup: expired %d stale awaiting_insertion, %d stale inserting, %d finished active",
-                            stale_awaiting,
-                            stale_inserting,
-                            finished_active,
+                            "Session cleanup: expired %d awaiting_insertion, %d active, %d inserting; "
+                            "revoked %d IPs in %.1f ms",
+                            len(expired.get(db.STATUS_AWAITING_INSERTION, ())),
+                            len(expired.get(db.STATUS_ACTIVE, ())),
+                            len(expired.get(db.STATUS_INSERTING, ())),
+                            len(revoked),
+                            sweep["duration_ms"],
                         )
                 except Exception as e:
                     application.logger.exception("Session cleanup error: %s", e)
+                manager = application.extensions.get("capacity")
+                if manager is not None:
+                    try:
+                        # parked activations whose client stopped asking still get their slot
+                        started = manager.promote()
+                        if started:
+                            application.logger.info("Capacity: started queued sessions %s", started)
+                    except Exception:
+                        application.logger.exception("Capacity promotion failed")
+                try:
+                    # device IP/last_seen noted by lookups, written in one batch
+                    db.flush_device_seen()
+                except Exception:
+                    application.logger.exception("Device last_seen flush failed")
                 time.sleep(application.config.get("CLEANUP_INTERVAL", 60))
     t = threading.Thread(target=_cleanup_loop, args=(app,), daemon=True)
     t.start()
+    # periodic pruning/compaction of system_logs and bottle_logs
+    _init_later(app, "retention")
+    # nightly (BACKUP_INTERVAL) online snapshots into BACKUP_DIR
+    _init_later(app, "backup")
+    startup.mark("background jobs")
     # Blueprints (keep routing organized in routes/)
-    from routes.portal import bp as portal_bp
     app.register_blueprint(portal_bp)
 
     @app.route("/")
     def index():
-        session_id = request.args.get("session")
-        session_data = None
-        if session_id:
-            session_data = db.get_session(int(session_id))
-        return render_template("index.html", session=session_data)
+        return page_cache.render_page("index.html")
 
     @app.route("/favicon.ico")
     def favicon():
@@ -140,8 +387,7 @@ def create_app(test_config=None):
 
     @app.route("/rate.html")
     def rate():
-        session_id = request.args.get("session")
-        return render_template("rate.html", session_id=session_id)
+        return page_cache.render_page("rate.html")
 
     # ---------------- ADMIN HTTP ENDPOINTS ----------------
 
@@ -174,6 +420,7 @@ def create_app(test_config=None):
     
     @app.route("/api/admin/metrics")
     @require_admin
+    @conditional(http_cache.metrics_validators)
     def admin_metrics():
         """HTTP endpoint for admin metrics (fallback when WebSocket not available)."""
         payload = _build_admin_payload()
@@ -191,9 +438,27 @@ def create_app(test_config=None):
         ratings = db.get_ratings_by_date_range(from_date=from_date, to_date=to_date)
         return jsonify(ratings)
 
+    @app.route("/api/admin/load")
+    @require_admin
+    def admin_load():
+        """Admission control, rate limiter, access reconciler, usage collector and capacity counters."""
+        controller = current_app.extensions.get("admission")
+        limiter = current_app.extensions.get("rate_limit")
+        reconciler = current_app.extensions.get("access_reconciler")
+        collector = current_app.extensions.get("usage")
+        manager = current_app.extensions.get("capacity")
+        return jsonify({
+            "admission": controller.snapshot() if controller else None,
+            "rate_limit": limiter.snapshot() if limiter else None,
+            "access": reconciler.snapshot() if reconciler else None,
+            "usage": collector.snapshot() if collector else None,
+            "capacity": manager.snapshot() if manager else None,
+        })
+
     # ---------------- EXISTING API ENDPOINTS ----------------
 
     @app.route("/api/session/<int:session_id>")
+    @conditional(http_cache.session_validators)
     def get_session_api(session_id):
         session = db.get_session(session_id)
         if not session:
@@ -201,6 +466,7 @@ def create_app(test_config=None):
         return jsonify(session)
 
     @app.route("/api/bottle", methods=["POST"])
+    @idempotent("bottle")
     def insert_bottle():
         """Handle bottle insertion - allows both 'inserting' and 'active' statuses"""
         data = request.get_json() or {}
@@ -221,6 +487,9 @@ def create_app(test_config=None):
         if not session:
             return jsonify({"error": "Session not found"}), 404
 
+        # the lease is authoritative; the row's status may lag the write-through
+        if _insertion_lock().refresh(session_id):
+            session['status'] = db.STATUS_INSERTING
         if session.get('status') not in ['inserting', 'active']:
             return jsonify({"error": "Session not accepting bottles"}), 409
 
@@ -266,8 +535,77 @@ def create_app(test_config=None):
             "remaining_seconds": remaining_seconds,
         })
 
+    # Batched bottle events: one transaction per burst; event keys make retries safe
+    @app.route("/api/bottle/batch", methods=["POST"])
+    def insert_bottle_batch():
+        """
+        Body: {"session_id": 1, "events": [{"key": "...", "count": 1, "ts": 1700000000}, ...]}
+        Returns the session state after applying all new events.
+        """
+        data = request.get_json(silent=True) or {}
+        session_id = data.get('session_id')
+        raw_events = data.get('events')
+
+        if not session_id:
+            return jsonify({"error": "session_id is required"}), 400
+        if not isinstance(raw_events, list) or not raw_events:
+            return jsonify({"error": "events must be a non-empty list"}), 400
+        if len(raw_events) > BOTTLE_BATCH_MAX_EVENTS:
+            return jsonify({"error": f"at most {BOTTLE_BATCH_MAX_EVENTS} events per batch"}), 400
+
+        current_time = int(datetime.now(timezone.utc).timestamp())
+        events = []
+        for ev in raw_events:
+            if not isinstance(ev, dict):
+                return jsonify({"error": "each event must be an object"}), 400
+            key = ev.get('key')
+            if not isinstance(key, str) or not key or len(key) > 64:
+                return jsonify({"error": "each event needs a key of 1-64 characters"}), 400
+            try:
+                count = int(ev.get('count', 1))
+                if count <= 0:
+                    raise ValueError
+            except (ValueError, TypeError):
+                return jsonify({"error": "count must be a positive integer"}), 400
+            try:
+                # client clocks drift; never log a bottle in the future
+                ts = min(int(ev.get('ts') or current_time), current_time)
+            except (ValueError, TypeError):
+                ts = current_time
+            events.append((key, count, ts))
+
+        if not db.bottle_event_keys_ready():
+            resp = jsonify({"error": "Database upgrade in progress, retry shortly"})
+            resp.headers["Retry-After"] = "2"
+            return resp, 503
+
+        session = db.get_session(session_id)
+        if not session:
+            return jsonify({"error": "Session not found"}), 404
+        if _insertion_lock().refresh(session_id):
+            session['status'] = db.STATUS_INSERTING
+        if session.get('status') not in ['inserting', 'active']:
+            return jsonify({"error": "Session not accepting bottles"}), 409
+
+        result = db.record_bottle_events(session_id, events, session['status'])
+        session = db.get_session(session_id)
+        session_end = session.get('session_end')
+        remaining_seconds = session_end - current_time if session_end and session_end > current_time else 0
+
+        return jsonify({
+            "success": True,
+            "session_id": session_id,
+            "accepted": result['accepted'],
+            "duplicates": result['duplicates'],
+            "bottles_inserted": session.get('bottles_inserted', 0),
+            "seconds_earned": session.get('seconds_earned', 0),
+            "session_end": session_end,
+            "remaining_seconds": remaining_seconds,
+        })
+
     # Start / activate session
     @app.route("/api/session/<int:session_id>/activate", methods=["POST"])
+    @idempotent("activate")
     def activate_session(session_id):
         session = db.get_session(session_id)
         if not session:
@@ -275,10 +613,29 @@ def create_app(test_config=None):
         if session["bottles_inserted"] == 0:
             return jsonify({"error": "No bottles inserted"}), 400
 
-        db.start_session(session_id)
+        manager = current_app.extensions.get("capacity")
+        running = _is_running(session)
+        if manager is not None and running and session["status"] == db.STATUS_ACTIVE:
+            # already started, e.g. by the cleanup loop while the client was queued
+            return jsonify({"success": True, "session": session})
+        # a started session topping up its time already holds a slot
+        if manager is None or running:
+            _start_session(session_id)
+        else:
+            wait = _admit_or_park(manager, session, _start_session)
+            if wait is not None:
+                return _queued_response(manager, wait)
         updated_session = db.get_session(session_id)
         return jsonify({"success": True, "session": updated_session})
 
+    # Insert modal heartbeat: keeps the insertion lease; missing beats free the machine fast
+    @app.route("/api/session/<int:session_id>/heartbeat", methods=["POST"])
+    def insertion_heartbeat(session_id):
+        expires_in = _insertion_lock().heartbeat(session_id)
+        if expires_in is None:
+            return jsonify({"error": "Insertion lock not held"}), 409
+        return jsonify({"success": True, "expires_in": expires_in})
+
     # Update session status
     @app.route("/api/session/<int:session_id>/status", methods=["POST"])
     def update_status(session_id):
@@ -286,7 +643,29 @@ def create_app(test_config=None):
         status = data.get("status")
         if status not in db.ALL_SESSION_STATUSES:
             return jsonify({"error": "Invalid status"}), 400
-        db.update_session_status(session_id, status)
+        if status == db.STATUS_INSERTING:
+            # only the lease may mark a session inserting, and only in line order
+            session = db.get_session(session_id)
+            if not session:
+                return jsonify({"error": "Session not found"}), 404
+            held, position = _acquire_insertion_lock(session["mac_address"], session["ip_address"], lambda: session_id)
+            if position is not None:
+                return _busy_response(position)
+            if held != session_id:
+                return jsonify({"error": "Machine is currently busy"}), 409
+            _insertion_lock().flush()
+            return jsonify({"success": True})
+        manager = current_app.extensions.get("capacity")
+        if status == db.STATUS_ACTIVE and manager is not None:
+            session = db.get_session(session_id)
+            if not session:
+                return jsonify({"error": "Session not found"}), 404
+            if not _is_running(session):
+                wait = _admit_or_park(manager, session, _set_active)
+                if wait is not None:
+                    return _queued_response(manager, wait)
+                return jsonify({"success": True})
+        _set_status(session_id, status)
         return jsonify({"success": True})
 
     # Expire session
@@ -295,27 +674,38 @@ def create_app(test_config=None):
         session = db.get_session(session_id)
         if not session:
             return jsonify({"error": "Session not found"}), 404
+        _release_insertion_lock(session_id, db.STATUS_EXPIRED)
         db.update_session_status(session_id, db.STATUS_EXPIRED)
         return jsonify({"success": True})
 
-    # Create session / acquire insertion lock (returns 409 if busy)
+    # Create session / acquire insertion lock (returns 409 + queue position if busy)
     @app.route("/api/session/create", methods=["POST"])
+    @rate_limited("create")
     def create_session_api():
         """Create or acquire insertion lock for a session."""
-        from routes.portal import get_device_identifier
         
         client_ip = request.remote_addr or request.headers.get("X-Forwarded-For")
         
         # Use centralized device identifier logic
         mac_address, is_cookie, set_cookie = get_device_identifier(request)
+
+        def _lockable_session():
+            return (db.find_lockable_session_id(mac_address=mac_address, ip_address=client_ip)
+                    or db.create_session(mac_address, client_ip))
         
         try:
-            session_id = db.acquire_insertion_lock(mac_address=mac_address, ip_address=client_ip)
+            session_id, position = _acquire_insertion_lock(mac_address, client_ip, _lockable_session)
             
             if not session_id:
-                return jsonify({"error": "Machine is currently busy", "message": "Another user is inserting bottles. Please try again in a few minutes."}), 409
+                resp = _busy_response(position)
+                if set_cookie:
+                    device_id = mac_address.replace("device:", "")
+                    resp.set_cookie("device_id", device_id, max_age=60*60*24*365*5, path="/", samesite='Lax')
+                return resp
             
             session = db.get_session(session_id)
+            if session:
+                session["status"] = db.STATUS_INSERTING
             resp = make_response(jsonify({"session_id": session_id, "session": session}), 200)
             if set_cookie:
                 device_id = mac_address.replace("device:", "")
@@ -329,7 +719,6 @@ def create_app(test_config=None):
     @app.route("/api/session/unlock", methods=["POST"])
     def unlock_insertion():
         """Release insertion lock without activating session."""
-        from routes.portal import get_device_identifier
     
         try:
             client_ip = request.remote_addr or request.headers.get("X-Forwarded-For")
@@ -337,24 +726,27 @@ def create_app(test_config=None):
             # Use centralized device identifier logic
             mac_address, is_cookie, set_cookie = get_device_identifier(request)
             
-            # Find any inserting session for this device
-            inserting_session = db.get_session_for_device(
-                mac_address=mac_address,
-                ip_address=client_ip,
-                statuses=('inserting',)
-            )
+            # Find the session holding the insertion lease for this device
+            session_id = _insertion_lock().holder_session(mac_address)
+            inserting_session = db.get_session(session_id) if session_id else None
             
             if inserting_session:
-                session_id = inserting_session['id']
                 has_bottles = inserting_session.get('bottles_inserted', 0) > 0
 
-                if has_bottles:
+                manager = current_app.extensions.get("capacity")
+                if has_bottles and manager is not None and not _is_running(inserting_session):
+                    # a fresh session only starts if the capacity cap has a slot for it
+                    if _admit_or_park(manager, inserting_session, _set_active) is None:
+                        app.logger.info(f"Reverted session {session_id} to active after unlock")
+                    else:
+                        app.logger.info(f"Parked session {session_id} for an active slot after unlock")
+                elif has_bottles:
                     # User already has earned time; go back to ACTIVE
-                    db.update_session_status(session_id, db.STATUS_ACTIVE)
+                    _insertion_lock().release(session_id, db.STATUS_ACTIVE)
                     app.logger.info(f"Reverted session {session_id} to active after unlock")
                 else:
                     # No bottles inserted yet; just release lock and allow another try
-                    db.update_session_status(session_id, db.STATUS_AWAITING_INSERTION)
+                    _insertion_lock().release(session_id, db.STATUS_AWAITING_INSERTION)
                     app.logger.info(
                         f"Reverted session {session_id} to awaiting_insertion after unlock with no bottles"
                     )
@@ -368,18 +760,26 @@ def create_app(test_config=None):
             app.logger.exception("Error in /api/session/unlock")
             return jsonify({"error": "internal_server_error", "message": str(e)}), 500
 
+    # Waiting line for the insertion lock (read-only poll; no DB write lock)
+    @app.route("/api/session/queue", methods=["GET", "DELETE"])
+    def insertion_queue_status():
+        """Return this device's place in line, or leave the line (DELETE)."""
+        mac_address, is_cookie, set_cookie = get_device_identifier(request)
+        queue = _insertion_queue()
+        if request.method == "DELETE":
+            return jsonify({"success": True, "left": queue.leave(mac_address)})
+        status = queue.status(mac_address, lock_free=_insertion_lock().is_free)
+        return jsonify(status)
+
     # Captive portal detection (returns redirect to portal and ensures session exists)
     @app.route("/generate_204")
     @app.route("/connecttest.txt")
     @app.route("/hotspot-detect.html")
+    @rate_limited("captive")
     def captive_portal_detect():
         client_ip = request.remote_addr
-        # Attempt to resolve MAC via services.network.get_mac_for_ip if available
-        try:
-            from services.network import get_mac_for_ip
-            mac = get_mac_for_ip(client_ip)
-        except Exception:
-            mac = None
+        # ARP/dnsmasq MAC on the Pi, otherwise the device_id cookie
+        mac, is_cookie, set_cookie = get_device_identifier(request)
 
         # NOTE/TODO: On Raspberry Pi ensure Flask receives real client IP (not 127.0.0.1)
         # when running behind any NAT/proxy. If using a reverse proxy set app.wsgi_app =
@@ -387,21 +787,32 @@ def create_app(test_config=None):
         # reads /proc/net/arp or dnsmasq leases on the Pi (implemented in services/network.py).
 
         # Check for any existing session for this device
-        existing = db.get_session_for_device(mac=mac, ip=client_ip, statuses=(db.STATUS_AWAITING_INSERTION, db.STATUS_INSERTING, db.STATUS_ACTIVE))
+        existing = db.get_session_for_device(
+            mac_address=mac,
+            ip_address=client_ip,
+            statuses=(db.STATUS_AWAITING_INSERTION, db.STATUS_INSERTING, db.STATUS_ACTIVE),
+        )
         if existing:
             session_id = existing["id"]
         else:
             session_id = db.create_session(mac, client_ip, status=db.STATUS_AWAITING_INSERTION)
 
         # Redirect to portal with session ID
-        return f'<html><body><script>window.location.href="/?session={session_id}";</script></body></html>'
+        resp = page_cache.captive_redirect(session_id)
+        if set_cookie:
+            resp.set_cookie(
+                "device_id",
+                mac.replace("device:", ""),
+                max_age=60 * 60 * 24 * 365 * 5,
+                path="/",
+                samesite="Lax",
+            )
+        return resp
 
     # Protected rating page: only users with an existing session can access
     @app.route("/rating", methods=["GET"])
     def rating_page():
         """Render the rating page for the current device if it has a session."""
-        from routes.portal import get_device_identifier
-
         client_ip = request.remote_addr or request.headers.get("X-Forwarded-For")
         mac_address, is_cookie, set_cookie = get_device_identifier(request)
         # Find a relevant session for this device (allow any known session)
@@ -416,7 +827,7 @@ def create_app(test_config=None):
             return redirect(url_for("index"))
             return redirect(url_for("index"))
 
-        resp = make_response(render_template("rate.html"))
+        resp = page_cache.render_page("rate.html")
         if set_cookie:
             device_id = mac_address.replace("device:", "")
             resp.set_cookie(
@@ -430,10 +841,9 @@ def create_app(test_config=None):
 
     # Protected rating API: bind rating to the caller's own session
     @app.route("/api/rating", methods=["POST"])
+    @idempotent("rating")
     def submit_rating():
         """Submit rating for the session associated with the current device."""
-        from routes.portal import get_device_identifier
-
         client_ip = request.remote_addr or request.headers.get("X-Forwarded-For")
         mac_address, is_cookie, set_cookie = get_device_identifier(request)
 
@@ -449,11 +859,6 @@ def create_app(test_config=None):
 
         session_id = session["id"]
 
-        # ✅ One review per session
-        existing = db.get_rating_by_session(session_id)
-        if existing:
-            return jsonify({"error": "Rating already submitted for this session"}), 409
-
         data = request.get_json(silent=True) or {}
         # Validate that all q1..q14 are present and in [1, 5]
         answers = {}
@@ -481,7 +886,9 @@ def create_app(test_config=None):
         comment = (data.get("comment") or "").strip()
 
         try:
-            db.submit_rating(session_id, answers, comment or None)
+            # ✅ One review per session (unique ratings.session_id)
+            if not db.submit_rating(session_id, answers, comment or None):
+                return jsonify({"error": "Rating already submitted for this session"}), 409
         except Exception as e:
             current_app.logger.exception("Failed to submit rating for session %s", session_id)
             return jsonify({"error": "Failed to submit rating", "detail": str(e)}), 500
@@ -499,10 +906,9 @@ def create_app(test_config=None):
         return resp
 
     @app.route("/api/rating/status", methods=["GET"])
+    @conditional(http_cache.device_validators, vary="Cookie")
     def rating_status():
         """Return whether the current device's session already has a rating."""
-        from routes.portal import get_device_identifier
-
         client_ip = request.remote_addr or request.headers.get("X-Forwarded-For")
         mac_address, is_cookie, set_cookie = get_device_identifier(request)
 
@@ -523,12 +929,51 @@ def create_app(test_config=None):
             "session_id": session_id,
         }), 200
 
+    # admin metrics stream; the websocket stack loads on the first connection
+    app.add_url_rule("/ws/admin", "admin_ws", _websocket_view(admin_ws), websocket=True)
+
+    startup.mark("routes")
+    app.extensions["startup"] = startup.report(app.logger)
     return app
 
 
 # ---------------- WEBSOCKET ROUTE (ADMIN) ----------------
 
-@sock.route("/ws/admin")
+class _WebSocketResponse(Response):
+    """Empty response for a request whose socket a WebSocket took over (as flask_sock answers)."""
+
+    def __init__(self, mode):
+        super().__init__()
+        self.ws_mode = mode
+
+    def __call__(self, environ, start_response):
+        if self.ws_mode == "gunicorn":
+            raise StopIteration()
+        if self.ws_mode == "werkzeug":
+            return super().__call__(environ, start_response)
+        return []
+
+def _websocket_view(handler):
+    """
+    Flask view running handler(ws) over a WebSocket. simple_websocket (and
+    wsproto under it) is imported on the first connection, so only admins
+    watching the dashboard pay for the websocket stack.
+    """
+    @wraps(handler)
+    def view():
+        from simple_websocket import ConnectionClosed, Server
+        ws = Server.accept(request.environ, **current_app.config.get("SOCK_SERVER_OPTIONS", {}))
+        try:
+            handler(ws)
+        except ConnectionClosed:
+            pass
+        try:
+            ws.close()
+        except Exception:
+            pass
+        return _WebSocketResponse(ws.mode)
+    return view
+
 def admin_ws(ws):
     """
     WebSocket stream sending admin metrics every few seconds.
@@ -543,7 +988,7 @@ def admin_ws(ws):
     while True:
         try:
             payload = _build_admin_payload()
-            ws.send(json.dumps(payload))
+            ws.send(json.dumps(payload, default=json_default))
             time.sleep(interval)
         except Exception:
             break
@@ -5,8 +5,13 @@ Stores sessions, ratings, bottle logs, and system events.
 from flask import current_app, g
 import sqlite3
 import os
+import threading
+import time
 from datetime import datetime, timezone, timedelta
 
+import migrations
+from records import BottleLog, ExpiredSession, Rating, Session
+
 # Session status constants
 STATUS_AWAITING_INSERTION = 'awaiting_insertion'
 STATUS_INSERTING = 'inserting'
@@ -21,8 +26,35 @@ ALL_SESSION_STATUSES = (
 )
 
 DEFAULT_SESSION_STATUS = STATUS_AWAITING_INSERTION
+
+# A session whose clock is running: active, or started and topping up its time
+# (it is 'inserting' then but keeps its session_start and running session_end).
+# Holds an active slot and network access. Takes the named parameter :now.
+RUNNING_SESSION_SQL = (
+    f"((status = '{STATUS_ACTIVE}' AND (session_end IS NULL OR session_end > :now)) "
+    f"OR (status = '{STATUS_INSERTING}' AND session_start IS NOT NULL AND session_end > :now))"
+)
 SECONDS_PER_BOTTLE = 120  # 2 minutes per bottle
 
+# Write notifications, e.g. for HTTP cache validators (services/http_cache.py).
+# Listeners are called as fn(kind, session_id) after a commit; kind is one of
+# 'session' (one row), 'sessions' (bulk update), 'rating', 'bottles' or
+# 'usage' (traffic counters, services/usage.py).
+_change_listeners = []
+
+def on_change(listener):
+    _change_listeners.append(listener)
+
+def notify_change(kind, session_id=None):
+    for listener in _change_listeners:
+        listener(kind, session_id)
+
+def _fetch(db, record_cls, sql, params=()):
+    """Cursor whose rows are record_cls instances; sql must select record_cls.columns."""
+    cur = db.cursor()
+    cur.row_factory = record_cls.row_factory
+    return cur.execute(sql, params)
+
 def get_db():
     """Get or create database connection for current request."""
     if 'db' not in g:
@@ -30,28 +62,81 @@ def get_db():
         if not db_path:
             db_path = os.path.join(current_app.instance_path, 'wifi_portal.db')
             os.makedirs(current_app.instance_path, exist_ok=True)
-        g.db = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES)
-        g.db.row_factory = sqlite3.Row
-        g.db.execute('PRAGMA foreign_keys = ON')
+        conn = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA foreign_keys = ON')
+        # Opt-in query profiling (DB_PROFILE=true), see services/query_profiler.py
+        profiler = current_app.extensions.get('query_profiler')
+        g.db = profiler.wrap(conn) if profiler else conn
     return g.db
 
+def connect_autocommit(db_path, busy_timeout_ms=5000):
+    """
+    Standalone connection for background jobs (migrations, retention, backups).
+    Autocommit mode: callers issue explicit BEGIN IMMEDIATE / COMMIT so each
+    batch holds the write lock only briefly.
+    """
+    conn = sqlite3.connect(db_path, isolation_level=None, timeout=busy_timeout_ms / 1000)
+    conn.execute(f'PRAGMA busy_timeout = {int(busy_timeout_ms)}')
+    conn.execute('PRAGMA foreign_keys = ON')
+    return conn
+
 def close_db(e=None):
     """Close database connection at end of request."""
     db = g.pop('db', None)
     if db is not None:
         db.close()
 
+def _init_schema(db):
+    # The baseline DDL is migration 1; once that is recorded there is nothing
+    # to create, and a restart after a power cut skips straight to serving.
+    if 1 in migrations.applied_versions(db):
+        return False
+    # Only takes effect on a new, empty database; lets the retention
+    # job hand freed pages back with PRAGMA incremental_vacuum.
+    db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    _create_tables(db)
+    db.commit()
+    return True
+
 def init_db(app=None):
-    """Initialize database with schema."""
+    """Initialize database with schema. Returns False when the schema was already there."""
     if app:
         with app.app_context():
-            db = get_db()
-            _create_tables(db)
-            db.commit()
-    else:
-        db = get_db()
-        _create_tables(db)
-        db.commit()
+            return _init_schema(get_db())
+    return _init_schema(get_db())
+
+def get_db_path(app):
+    """Database file configured for app (DB_PATH, DATABASE or instance default)."""
+    path = app.config.get('DB_PATH') or app.config.get('DATABASE')
+    return path or os.path.join(app.instance_path, 'wifi_portal.db')
+
+def migrate(app=None):
+    """
+    Apply pending versioned migrations (see migrations.py).
+    Backfills run in batches of MIGRATION_BATCH_SIZE with MIGRATION_BATCH_PAUSE
+    seconds between them, so this is safe to run while the portal is serving.
+    Returns True when migrations ran, False without an app.
+    """
+    if app is None:
+        return False
+    applied = migrations.migrate(
+        get_db_path(app),
+        batch_size=app.config.get('MIGRATION_BATCH_SIZE', migrations.DEFAULT_BATCH_SIZE),
+        pause=app.config.get('MIGRATION_BATCH_PAUSE', migrations.DEFAULT_BATCH_PAUSE),
+        logger=app.logger,
+    )
+    if applied:
+        app.logger.info("Migrations applied: %s", applied)
+    return True
+
+def _bottle_rollup_ready(db):
+    """True once the bottle_daily_totals backfill has completed."""
+    return migrations.is_applied(db, migrations.BOTTLE_ROLLUP_VERSION, get_db_path(current_app))
+
+def _devices_ready(db):
+    """True once every session row has a device_id (migration DEVICES_VERSION)."""
+    return migrations.is_applied(db, migrations.DEVICES_VERSION, get_db_path(current_app))
 
 def _create_tables(db):
     """Create all tables with proper schema, indexes, and foreign keys."""
@@ -131,6 +216,87 @@ def _create_tables(db):
     db.execute('CREATE INDEX IF NOT EXISTS idx_system_logs_type ON system_logs(event_type)')
     db.execute('CREATE INDEX IF NOT EXISTS idx_system_logs_created ON system_logs(created_at)')
 
+# ============================================================================
+# DEVICE REGISTRY
+# ============================================================================
+
+# A device row is never renumbered, so (db path, identifier) -> device id is
+# cached for the life of the process. Lookups never write: the device's
+# current IP and last_seen are kept in memory and written in one batch by
+# flush_device_seen(), which the cleanup loop calls every CLEANUP_INTERVAL.
+# Only registering a new device inserts a row.
+_DEVICE_CACHE_MAX = 10000
+_device_cache = {}  # (db path, identifier) -> device id
+_device_seen = {}  # db path -> {device id: (ip, last_seen)} not yet written
+_device_cache_lock = threading.Lock()
+
+def _device_key(identifier):
+    """('cookie_id', id) or ('mac_address', mac) for a get_device_identifier() string."""
+    if identifier.startswith('device:'):
+        return 'cookie_id', identifier[len('device:'):]
+    return 'mac_address', identifier.lower()
+
+def resolve_device(identifier, ip_address=None, create=True):
+    """
+    Device id for a routes.portal.get_device_identifier() string, noting the
+    device's current IP and last_seen for the next flush_device_seen(). With
+    create=False an unknown device is not registered and None is returned.
+    """
+    if not identifier:
+        return None
+    now = int(datetime.now(timezone.utc).timestamp())
+    path = get_db_path(current_app)
+    key = (path, identifier)
+    with _device_cache_lock:
+        device_id = _device_cache.get(key)
+
+    if device_id is None:
+        db = get_db()
+        column, value = _device_key(identifier)
+        row = db.execute(f'SELECT id FROM devices WHERE {column} = ?', (value,)).fetchone()
+        if row is None:
+            if not create:
+                return None
+            row = db.execute(
+                f'''
+                INSERT INTO devices ({column}, ip_address, first_seen, last_seen)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT({column}) WHERE {column} IS NOT NULL DO UPDATE SET
+                    last_seen = excluded.last_seen
+                RETURNING id
+                ''',
+                (value, ip_address, now, now),
+            ).fetchone()
+            db.commit()
+        device_id = row[0]
+        with _device_cache_lock:
+            if len(_device_cache) >= _DEVICE_CACHE_MAX:
+                _device_cache.clear()
+            _device_cache[key] = device_id
+
+    with _device_cache_lock:
+        seen = _device_seen.setdefault(path, {})
+        previous = seen.get(device_id)
+        if ip_address is None and previous is not None:
+            ip_address = previous[0]
+        seen[device_id] = (ip_address, now)
+    return device_id
+
+def flush_device_seen():
+    """Write the IP/last_seen noted by resolve_device since the last flush; returns rows updated."""
+    path = get_db_path(current_app)
+    with _device_cache_lock:
+        seen = _device_seen.pop(path, None)
+    if not seen:
+        return 0
+    db = get_db()
+    db.executemany(
+        'UPDATE devices SET ip_address = COALESCE(?, ip_address), last_seen = MAX(last_seen, ?) WHERE id = ?',
+        [(ip, seen_at, device_id) for device_id, (ip, seen_at) in seen.items()],
+    )
+    db.commit()
+    return len(seen)
+
 # ============================================================================
 # SESSION HELPERS
 # ============================================================================
@@ -154,6 +320,7 @@ def create_session(mac_address, ip_address=None, status=DEFAULT_SESSION_STATUS):
 
     # Map desirable fields -> candidate column names (in preference order)
     candidates = {
+        "device": [("device_id", resolve_device(mac_address, ip_address) if "device_id" in available_cols else None)],
         "mac": [("mac", mac_address), ("mac_address", mac_address), ("client_mac", mac_address)],
         "ip": [("ip", ip_address), ("ip_address", ip_address), ("client_ip", ip_address)],
         "status": [("status", status)],
@@ -178,13 +345,13 @@ def create_session(mac_address, ip_address=None, status=DEFAULT_SESSION_STATUS):
     sql = f"INSERT INTO sessions ({cols_sql}) VALUES ({placeholders})"
     cur.execute(sql, tuple(insert_vals))
     db.commit()
+    notify_change('session', cur.lastrowid)
     return cur.lastrowid
 
 def get_session(session_id):
     """Get session by ID."""
     db = get_db()
-    row = db.execute('SELECT * FROM sessions WHERE id = ?', (session_id,)).fetchone()
-    return dict(row) if row else None
+    return _fetch(db, Session, f'SELECT {Session.columns} FROM sessions WHERE id = ?', (session_id,)).fetchone()
 
 def update_session_status(session_id, status):
     """Update session status."""
@@ -198,12 +365,13 @@ def update_session_status(session_id, status):
     ''', (status, now, session_id))
     
     db.commit()
+    notify_change('session', session_id)
     
     if status == STATUS_EXPIRED:
         log_system_event('session_expired', f'Session {session_id} expired')
 
-def start_session(session_id):
-    """Activate session and set start/end times."""
+def start_session(session_id, only_status=None):
+    """Activate session and set start/end times (only if it is in only_status, when given)."""
     db = get_db()
     session = get_session(session_id)
     if not session:
@@ -212,13 +380,21 @@ def start_session(session_id):
     now = int(datetime.now(timezone.utc).timestamp())
     session_end = now + session['seconds_earned']
     
-    db.execute('''
+    sql = '''
         UPDATE sessions 
         SET status = ?, session_start = ?, session_end = ?, updated_at = ?
         WHERE id = ?
-    ''', (STATUS_ACTIVE, now, session_end, now, session_id))
+    '''
+    params = [STATUS_ACTIVE, now, session_end, now, session_id]
+    if only_status:
+        sql += ' AND status = ?'
+        params.append(only_status)
+    cur = db.execute(sql, params)
     
     db.commit()
+    if not cur.rowcount:
+        return False
+    notify_change('session', session_id)
     return True
 
 def add_bottle_to_session(session_id, seconds_per_bottle=SECONDS_PER_BOTTLE):
@@ -240,6 +416,7 @@ def add_bottle_to_session(session_id, seconds_per_bottle=SECONDS_PER_BOTTLE):
     ''', (session_id, now))
     
     db.commit()
+    notify_change('session', session_id)
     
     log_system_event('bottle_inserted', f'Bottle added to session {session_id}')
     
@@ -262,6 +439,7 @@ def extend_session(session_id, additional_seconds):
     ''', (new_end, additional_seconds, now, session_id))
     
     db.commit()
+    notify_change('session', session_id)
     return True
 
 # ============================================================================
@@ -269,17 +447,14 @@ def extend_session(session_id, additional_seconds):
 # ============================================================================
 
 def submit_rating(session_id, answers, comment=None):
-    """Submit rating for a session."""
+    """
+    Store the rating for a session and its 'rating_submitted' event in one
+    transaction. Returns False (and writes nothing) if the session already
+    has a rating.
+    """
     db = get_db()
     now = int(datetime.now(timezone.utc).timestamp())
-    
-    db.execute('''
-        INSERT INTO ratings (
-            session_id, q1, q2, q3, q4, q5, q6, q7, q8, q9, q10,
-            q11, q12, q13, q14,
-            comment, submitted_at
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
+    values = (
         session_id,
         answers.get('q1'), answers.get('q2'), answers.get('q3'),
         answers.get('q4'), answers.get('q5'), answers.get('q6'),
@@ -287,12 +462,39 @@ def submit_rating(session_id, answers, comment=None):
         answers.get('q10'), answers.get('q11'), answers.get('q12'), answers.get('q13'), answers.get('q14'),
         comment,
         now
-    ))
-    
-    db.commit()
-    
-    log_system_event('rating_submitted', f'Rating submitted for session {session_id}')
-    
+    )
+    columns = '''
+            session_id, q1, q2, q3, q4, q5, q6, q7, q8, q9, q10,
+            q11, q12, q13, q14,
+            comment, submitted_at
+    '''
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        if migrations.is_applied(db, migrations.RATINGS_UNIQUE_VERSION, get_db_path(current_app)):
+            cur = db.execute(f'''
+                INSERT INTO ratings ({columns})
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(session_id) DO NOTHING
+            ''', values)
+        else:
+            # no unique index yet; the write lock taken above serializes the check
+            cur = db.execute(f'''
+                INSERT INTO ratings ({columns})
+                SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
+                WHERE NOT EXISTS (SELECT 1 FROM ratings WHERE session_id = ?)
+            ''', values + (session_id,))
+        if cur.rowcount == 0:
+            db.rollback()
+            return False
+        db.execute('''
+            INSERT INTO system_logs (event_type, description, created_at)
+            VALUES (?, ?, ?)
+        ''', ('rating_submitted', f'Rating submitted for session {session_id}', now))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    notify_change('rating', session_id)
     return True
 
 def add_rating(session_id, answers, comment=None):
@@ -305,8 +507,7 @@ def add_rating(session_id, answers, comment=None):
 def get_rating_by_session(session_id):
     """Get rating for a specific session."""
     db = get_db()
-    row = db.execute('SELECT * FROM ratings WHERE session_id = ?', (session_id,)).fetchone()
-    return dict(row) if row else None
+    return _fetch(db, Rating, f'SELECT {Rating.columns} FROM ratings WHERE session_id = ?', (session_id,)).fetchone()
 
 # ============================================================================
 # LOGGING HELPERS
@@ -327,11 +528,11 @@ def log_system_event(event_type, description=None):
 def get_bottle_logs(session_id):
     """Return all bottle_logs for a session."""
     db = get_db()
-    rows = db.execute(
-        'SELECT * FROM bottle_logs WHERE session_id = ? ORDER BY created_at ASC',
+    return _fetch(
+        db, BottleLog,
+        f'SELECT {BottleLog.columns} FROM bottle_logs WHERE session_id = ? ORDER BY created_at ASC',
         (session_id,),
     ).fetchall()
-    return [dict(r) for r in rows]
 
 # ---------------- RATINGS (ADMIN FILTER) ----------------
 
@@ -467,277 +668,226 @@ def get_rating_stats():
     ''').fetchone()
     return dict(stats) if stats else {}
 
+def get_ongoing_sessions():
+    """awaiting_insertion, inserting and active sessions, most recently updated first."""
+    db = get_db()
+    return _fetch(
+        db, Session,
+        f"""
+        SELECT {Session.columns}
+        FROM sessions
+        WHERE status IN (?, ?, ?)
+        ORDER BY updated_at DESC
+        """,
+        (STATUS_AWAITING_INSERTION, STATUS_INSERTING, STATUS_ACTIVE),
+    ).fetchall()
+
+def get_active_session_ends(now=None):
+    """
+    session_end of every session holding an active slot, soonest first (None
+    for open-ended ones, last). A started session topping up its time is
+    'inserting' but keeps its session_start and running session_end, so it
+    counts too; a fresh one only has the provisional end set by its credits.
+    """
+    db = get_db()
+    now = int(now if now is not None else datetime.now(timezone.utc).timestamp())
+    rows = db.execute(
+        f"""
+        SELECT session_end FROM sessions
+        WHERE {RUNNING_SESSION_SQL}
+        ORDER BY session_end IS NULL, session_end
+        """,
+        {'now': now},
+    )
+    return [row[0] for row in rows]
+
+def get_running_sessions_by_ip(conn, now=None):
+    """
+    {ip_address: newest session id} of running sessions (RUNNING_SESSION_SQL),
+    on conn so background threads can use their own connection. The access
+    reconciler grants these IPs and the usage collector charges them.
+    """
+    now = int(now if now is not None else datetime.now(timezone.utc).timestamp())
+    return dict(conn.execute(
+        f"SELECT ip_address, MAX(id) FROM sessions "
+        f"WHERE ip_address IS NOT NULL AND {RUNNING_SESSION_SQL} GROUP BY ip_address",
+        {'now': now},
+    ).fetchall())
+
+def get_unstarted_paid_sessions():
+    """
+    (id, status, seconds_earned) of sessions with credited bottles whose
+    clock never started and that are still waiting or inserting, longest
+    waiting first. These are the activations parked by the capacity cap.
+    """
+    db = get_db()
+    return db.execute(
+        """
+        SELECT id, status, seconds_earned FROM sessions
+        WHERE status IN (?, ?) AND session_start IS NULL AND bottles_inserted > 0
+        ORDER BY updated_at, id
+        """,
+        (STATUS_AWAITING_INSERTION, STATUS_INSERTING),
+    ).fetchall()
+
 def get_session_for_device(mac_address=None, ip_address=None, statuses=None):
     """
-    Find the most recent session for a device (by mac or ip) with given statuses.
-    Returns session dict or None.
-    
-    Best practice: prefer MAC lookup over IP for device identification.
+    Find the most recent session for a device with given statuses.
+    Returns a records.Session or None.
+
+    mac_address is the get_device_identifier() string. Once the devices
+    migration has run it is resolved to a device id and the lookup is a
+    single sessions.device_id match; before that the device is matched by
+    mac OR ip.
     """
     if not mac_address and not ip_address:
         return None
     
     db = get_db()
-    cur = db.cursor()
-    
-    # Build WHERE clause
-    where_parts = []
-    params = []
     
-    if mac_address:
-        where_parts.append("mac_address = ?")
-        params.append(mac_address)
-    
-    if ip_address:
-        where_parts.append("ip_address = ?")
-        params.append(ip_address)
+    if mac_address and _devices_ready(db):
+        device_id = resolve_device(mac_address, ip_address, create=False)
+        if device_id is None:
+            return None
+        device_parts = ["device_id = ?"]
+        params = [device_id]
+    else:
+        # Build WHERE clause: (mac OR ip) AND status
+        device_parts = []
+        params = []
+
+        if mac_address:
+            device_parts.append("mac_address = ?")
+            params.append(mac_address)
+
+        if ip_address:
+            device_parts.append("ip_address = ?")
+            params.append(ip_address)
     
+    where_clause = f"({' OR '.join(device_parts)})"
     if statuses:
         placeholders = ','.join(['?'] * len(statuses))
-        where_parts.append(f"status IN ({placeholders})")
+        where_clause += f" AND status IN ({placeholders})"
         params.extend(statuses)
     
-    where_clause = " OR ".join(where_parts[:2] if len(where_parts) > 2 else where_parts[:1])
-    if statuses and len(where_parts) > 2:
-        where_clause = f"({where_clause}) AND {where_parts[2]}"
-    
     query = f"""
-        SELECT id, mac_address, ip_address, bottles_inserted, seconds_earned,
-               session_start, session_end, status, created_at, updated_at
+        SELECT {Session.columns}
         FROM sessions
         WHERE {where_clause}
         ORDER BY updated_at DESC, created_at DESC
         LIMIT 1
     """
     
-    cur.execute(query, tuple(params))
-    row = cur.fetchone()
-    
-    if not row:
-        return None
-    
-    return {
-        'id': row[0],
-        'mac_address': row[1],
-        'ip_address': row[2],
-        'bottles_inserted': row[3],
-        'seconds_earned': row[4],
-        'session_start': row[5],
-        'session_end': row[6],
-        'status': row[7],
-        'created_at': row[8],
-        'updated_at': row[9]
-    }
+    return _fetch(db, Session, query, tuple(params)).fetchone()
 
-def acquire_insertion_lock(mac_address=None, ip_address=None):
+def find_lockable_session_id(mac_address=None, ip_address=None):
     """
-    Acquire the machine-wide insertion lock.
-
-    Returns:
-        int session_id on success, or None if another session already holds the lock.
-
-    Behavior:
-    - If THIS device has a session with status in (awaiting_insertion, active, inserting),
-      prefer the newest one:
-        * awaiting_insertion or active -> transition to inserting and return its id
-        * inserting -> just return its id
-    - If another session (for any device) already has status='inserting', return None.
-    - Otherwise create a new session with status='inserting' and return its id.
+    Newest session of this device that may take the insertion lock
+    (awaiting_insertion, active or inserting), matched by device, else by IP.
+    Returns its id or None.
+    """
+    if mac_address and _devices_ready(get_db()):
+        device_id = resolve_device(mac_address, ip_address, create=False)
+        if device_id is None:
+            return None
+        where, param = "device_id = ?", device_id
+    elif mac_address:
+        where, param = "mac_address = ?", mac_address
+    elif ip_address:
+        where, param = "ip_address = ?", ip_address
+    else:
+        return None
+    row = get_db().execute(
+        f"""
+        SELECT id FROM sessions
+        WHERE {where} AND status IN (?, ?, ?)
+        ORDER BY created_at DESC
+        LIMIT 1
+        """,
+        (param, STATUS_AWAITING_INSERTION, STATUS_ACTIVE, STATUS_INSERTING),
+    ).fetchone()
+    return row[0] if row else None
 
-    The UNIQUE INDEX on status='inserting' guarantees at most one such row.
+def sweep_expired_sessions(awaiting_max_age=600, inserting_max_age=None, keep_session_ids=()):
     """
+    Expire, in one transaction:
+      - awaiting_insertion sessions created more than awaiting_max_age seconds
+        ago, unless they still hold earned time that never ran (paid
+        activations waiting for a capacity slot)
+      - active sessions whose session_end has passed
+      - inserting sessions not updated for inserting_max_age seconds (skipped
+        when None)
+    and log one aggregated 'session_expired' event. Awaiting/inserting
+    sessions in keep_session_ids (the live insertion lease) are left alone.
+
+    Returns {'expired': {previous status: [records.ExpiredSession]},
+    'revoke_ips': IPs of expired active/inserting sessions that no other
+    active session still uses, 'duration_ms': time spent}.
+    """
+    started = time.perf_counter()
     db = get_db()
     now = int(datetime.now(timezone.utc).timestamp())
-    cur = db.cursor()
-
+    keep = tuple(sid for sid in keep_session_ids if sid is not None)
+    keep_clause = f" AND id NOT IN ({','.join('?' * len(keep))})" if keep else ''
+    categories = [
+        # a NULL session_end with earned seconds is paused time, never expired
+        (STATUS_AWAITING_INSERTION,
+         'created_at < ? AND (seconds_earned = 0 OR session_end <= ?)' + keep_clause,
+         (now - int(awaiting_max_age), now) + keep),
+        (STATUS_ACTIVE, 'session_end IS NOT NULL AND session_end <= ?', (now,)),
+    ]
+    if inserting_max_age is not None:
+        categories.append((STATUS_INSERTING, 'updated_at < ?' + keep_clause, (now - int(inserting_max_age),) + keep))
+
+    expired = {}
+    revoke_ips = []
     try:
         db.execute("BEGIN IMMEDIATE")
-
-        # Get available columns (schema may evolve)
-        cur.execute("PRAGMA table_info(sessions)")
-        cols_info = cur.fetchall()
-        if not cols_info:
-            db.rollback()
-            return None
-        available_cols = {r[1] for r in cols_info}
-
-        mac_cols = [c for c in ("mac_address", "mac", "client_mac") if c in available_cols]
-        ip_cols = [c for c in ("ip_address", "ip", "client_ip") if c in available_cols]
-
-        # 1) If some session already holds inserting, remember it
-        cur.execute(
-            "SELECT id FROM sessions WHERE status = ? LIMIT 1",
-            (STATUS_INSERTING,),
-        )
-        existing_inserting = cur.fetchone()  # tuple like (id,) or None
-
-        # 2) Find this device's most recent session in (awaiting_insertion, active, inserting)
-        where_parts = []
-        params = []
-
-        if mac_address and mac_cols:
-            where_parts.append(f"{mac_cols[0]} = ?")
-            params.append(mac_address)
-        elif ip_address and ip_cols:
-            where_parts.append(f"{ip_cols[0]} = ?")
-            params.append(ip_address)
-
-        row = None
-        if where_parts:
-            where_sql = f"({where_parts[0]}) AND status IN (?, ?, ?)"
-            params_with_status = params + [
-                STATUS_AWAITING_INSERTION,
-                STATUS_ACTIVE,
-                STATUS_INSERTING,
-            ]
-            cur.execute(
+        for status, condition, params in categories:
+            expired[status] = _fetch(
+                db, ExpiredSession,
                 f"""
-                SELECT id, status
-                FROM sessions
-                WHERE {where_sql}
-                ORDER BY created_at DESC
-                LIMIT 1
+                UPDATE sessions
+                SET status = ?, updated_at = ?
+                WHERE status = ? AND {condition}
+                RETURNING {ExpiredSession.columns}
                 """,
-                tuple(params_with_status),
+                (STATUS_EXPIRED, now, status, *params),
+            ).fetchall()
+
+        # awaiting_insertion sessions never had access; an IP may also have
+        # moved on to a newer active session of the same device
+        ips = {r.ip_address for status in (STATUS_ACTIVE, STATUS_INSERTING)
+               for r in expired.get(status, ()) if r.ip_address}
+        if ips:
+            named = {f'ip{i}': ip for i, ip in enumerate(ips)}
+            still_active = {
+                row[0] for row in db.execute(
+                    f"SELECT ip_address FROM sessions WHERE {RUNNING_SESSION_SQL} "
+                    f"AND ip_address IN ({','.join(':' + name for name in named)})",
+                    {'now': now, **named},
+                )
+            }
+            revoke_ips = sorted(ips - still_active)
+
+        total = sum(len(rows) for rows in expired.values())
+        if total:
+            counts = ', '.join(f'{len(rows)} {status}' for status, rows in expired.items() if rows)
+            db.execute(
+                'INSERT INTO system_logs (event_type, description, created_at) VALUES (?, ?, ?)',
+                ('session_expired', f'Expired {total} sessions ({counts})', now),
             )
-            row = cur.fetchone()
-
-        if row:
-            session_id, status = row
-
-            if status == STATUS_INSERTING:
-                # This device already holds the lock
-                db.commit()
-                return session_id
-
-            # Another session (maybe other device) is inserting
-            if existing_inserting and existing_inserting[0] != session_id:
-                db.commit()
-                return None
-
-            # Upgrade this device's session to inserting
-            cur.execute(
-                "UPDATE sessions SET status = ?, updated_at = ? WHERE id = ?",
-                (STATUS_INSERTING, now, session_id),
-            )
-            db.commit()
-            return session_id
-
-        # 3) No session for this device; if someone else is inserting, we're busy
-        if existing_inserting:
-            db.commit()
-            return None
-
-        # 4) Create a new session in inserting state for this device
-        insert_cols = []
-        insert_vals = []
-
-        if mac_cols and mac_address:
-            insert_cols.append(mac_cols[0])
-            insert_vals.append(mac_address)
-        if ip_cols and ip_address:
-            insert_cols.append(ip_cols[0])
-            insert_vals.append(ip_address)
-
-        insert_cols.extend(["status", "created_at", "updated_at"])
-        insert_vals.extend([STATUS_INSERTING, now, now])
-
-        cols_sql = ",".join(insert_cols)
-        placeholders = ",".join(["?"] * len(insert_vals))
-        cur.execute(
-            f"INSERT INTO sessions ({cols_sql}) VALUES ({placeholders})",
-            tuple(insert_vals),
-        )
-        new_id = cur.lastrowid
         db.commit()
-        return new_id
-
-    except sqlite3.IntegrityError as e:
-        # UNIQUE(status='inserting') violated -> someone else grabbed the lock
-        try:
-            db.rollback()
-        except Exception:
-            pass
-        current_app.logger.warning("acquire_insertion_lock: integrity error: %s", e)
-        return None
     except Exception:
-        try:
-            db.rollback()
-        except Exception:
-            pass
+        db.rollback()
         raise
-
-def _row_to_dict(row):
-    """Helper to convert sqlite3.Row to plain dict."""
-    if row is None:
-        return None
-    return {k: row[k] for k in row.keys()}
-
-def expire_stale_awaiting_sessions(max_age_seconds=600):
-    """
-    Mark sessions with status=awaiting_insertion older than max_age_seconds as expired.
-    Returns number of sessions updated.
-    """
-    db = get_db()
-    now = int(datetime.now(timezone.utc).timestamp())
-    cutoff = now - int(max_age_seconds)
-    cur = db.cursor()
-    cur.execute(
-        """
-        UPDATE sessions
-        SET status = ?, updated_at = ?
-        WHERE status = ?
-          AND created_at IS NOT NULL
-          AND created_at < ?
-        """,
-        (STATUS_EXPIRED, now, STATUS_AWAITING_INSERTION, cutoff),
-    )
-    db.commit()
-    return cur.rowcount
-
-def expire_finished_active_sessions():
-    """
-    Mark active sessions whose time has fully elapsed as expired.
-    Uses session_end as the authoritative end time.
-    Returns number of sessions updated.
-    """
-    db = get_db()
-    now = int(datetime.now(timezone.utc).timestamp())
-    cur = db.cursor()
-    cur.execute(
-        """
-        UPDATE sessions
-        SET status = ?, updated_at = ?
-        WHERE status = ?
-          AND session_end IS NOT NULL
-          AND session_end <= ?
-        """,
-        (STATUS_EXPIRED, now, STATUS_ACTIVE, now),
-    )
-    db.commit()
-    return cur.rowcount
-
-def expire_stale_inserting_sessions(max_age_seconds=180):
-    """
-    Mark sessions with status=inserting whose updated_at is older than max_age_seconds as expired.
-    This frees the machine if someone started insertion and then abandoned it.
-    """
-    db = get_db()
-    now = int(datetime.now(timezone.utc).timestamp())
-    cutoff = now - int(max_age_seconds)
-    cur = db.cursor()
-    cur.execute(
-        """
-        UPDATE sessions
-        SET status = ?, updated_at = ?
-        WHERE status = ?
-          AND updated_at IS NOT NULL
-          AND updated_at < ?
-        """,
-        (STATUS_EXPIRED, now, STATUS_INSERTING, cutoff),
-    )
-    db.commit()
-    return cur.rowcount
+    if total:
+        notify_change('sessions')
+    return {
+        'expired': expired,
+        'revoke_ips': revoke_ips,
+        'duration_ms': round((time.perf_counter() - started) * 1000, 2),
+    }
 
 def update_session(session_id, updates):
     """Update session fields
@@ -770,6 +920,7 @@ def update_session(session_id, updates):
     try:
         conn.execute(query, values)
         conn.commit()
+        notify_change('session', session_id)
         return True
     except Exception as e:
         print(f"Error updating session {session_id}: {e}")
@@ -788,6 +939,63 @@ def log_bottles(session_id, count=1):
         (session_id, int(count), now),
     )
     db.commit()
+    notify_change('bottles', session_id)
+
+def bottle_event_keys_ready():
+    """True once bottle_logs has the event_key column (migration 6)."""
+    return migrations.is_applied(get_db(), migrations.BOTTLE_EVENT_KEYS_VERSION, get_db_path(current_app))
+
+def record_bottle_events(session_id, events, status):
+    """
+    Apply a batch of client bottle events to a session in one transaction.
+
+    events: iterable of (event_key, count, created_at). Events whose key was
+    already recorded for this session are skipped, so a retried batch never
+    credits bottles twice. `status` is the session status the caller checked
+    (the insertion lease may be ahead of the row).
+
+    Returns dict(accepted=<new events>, duplicates=<skipped events>, bottles=<bottles added>).
+    """
+    db = get_db()
+    now = int(datetime.now(timezone.utc).timestamp())
+    accepted = duplicates = bottles = 0
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        for event_key, count, created_at in events:
+            cur = db.execute(
+                'INSERT OR IGNORE INTO bottle_logs (session_id, count, created_at, event_key) VALUES (?, ?, ?, ?)',
+                (session_id, int(count), int(created_at), event_key),
+            )
+            if cur.rowcount:
+                accepted += 1
+                bottles += int(count)
+            else:
+                duplicates += 1
+
+        if bottles:
+            row = db.execute('SELECT session_end FROM sessions WHERE id = ?', (session_id,)).fetchone()
+            session_end = row[0] if row else None
+            if status == STATUS_ACTIVE or (status == STATUS_INSERTING and session_end):
+                # extend from the existing end
+                session_end = (session_end or now) + bottles * SECONDS_PER_BOTTLE
+            else:
+                session_end = now + bottles * SECONDS_PER_BOTTLE
+            db.execute(
+                """
+                UPDATE sessions
+                SET bottles_inserted = bottles_inserted + ?,
+                    seconds_earned = seconds_earned + ?,
+                    session_end = ?
+                WHERE id = ?
+                """,
+                (bottles, bottles * SECONDS_PER_BOTTLE, session_end, session_id),
+            )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    notify_change('session' if bottles else 'bottles', session_id)
+    return {'accepted': accepted, 'duplicates': duplicates, 'bottles': bottles}
 
 # ============================================================================
 # BOTTLE METRICS + REVIEWS HELPERS (for admin dashboard)
@@ -814,14 +1022,52 @@ def count_bottles_today_ph() -> int:
     now_ph = datetime.now(ph_tz)
     start_ph = datetime(now_ph.year, now_ph.month, now_ph.day, tzinfo=ph_tz)
     end_ph = start_ph + timedelta(days=1)
+    db = get_db()
+    if _bottle_rollup_ready(db):
+        row = db.execute(
+            'SELECT bottles FROM bottle_daily_totals WHERE day = ?',
+            (start_ph.strftime('%Y-%m-%d'),),
+        ).fetchone()
+        return row[0] if row else 0
     start_utc = int(start_ph.astimezone(timezone.utc).timestamp())
     end_utc = int(end_ph.astimezone(timezone.utc).timestamp())
     return count_bottles_between(start_utc, end_utc)
 
 
+def _usage_ready(db):
+    return migrations.is_applied(db, migrations.USAGE_VERSION, get_db_path(current_app))
+
+
+def get_session_usage(session_ids):
+    """{session_id: {'bytes_up', 'bytes_down'}} for the given sessions (missing = no traffic yet)."""
+    db = get_db()
+    ids = list(session_ids)
+    if not ids or not _usage_ready(db):
+        return {}
+    placeholders = ','.join('?' * len(ids))
+    rows = db.execute(
+        f'SELECT session_id, bytes_up, bytes_down FROM session_usage WHERE session_id IN ({placeholders})',
+        ids,
+    ).fetchall()
+    return {r[0]: {'bytes_up': r[1], 'bytes_down': r[2]} for r in rows}
+
+
+def get_usage_today() -> dict:
+    """Bytes up/down for the current Philippines (UTC+8) day."""
+    db = get_db()
+    if not _usage_ready(db):
+        return {'bytes_up': 0, 'bytes_down': 0}
+    day = datetime.now(timezone(timedelta(hours=8))).strftime('%Y-%m-%d')
+    row = db.execute('SELECT bytes_up, bytes_down FROM usage_daily_totals WHERE day = ?', (day,)).fetchone()
+    return {'bytes_up': row[0], 'bytes_down': row[1]} if row else {'bytes_up': 0, 'bytes_down': 0}
+
+
 def count_bottles_total() -> int:
     """Total bottles ever inserted."""
     db = get_db()
+    if _bottle_rollup_ready(db):
+        row = db.execute('SELECT COALESCE(SUM(bottles), 0) FROM bottle_daily_totals').fetchone()
+        return row[0] if row else 0
     row = db.execute('SELECT COALESCE(SUM(count), 0) FROM bottle_logs').fetchone()
     return row[0] if row else 0
 
@@ -863,13 +1109,12 @@ def get_ratings_by_date_range(from_date: str | None = None, to_date: str | None
         except ValueError:
             pass
 
-    sql = "SELECT * FROM ratings"
+    sql = f"SELECT {Rating.columns} FROM ratings"
     if conditions:
         sql += " WHERE " + " AND ".join(conditions)
     sql += " ORDER BY submitted_at DESC"
 
-    rows = db.execute(sql, params).fetchall()
-    return [dict(r) for r in rows]
+    return _fetch(db, Rating, sql, params).fetchall()
 
 
 
@@ -1,16 +1,20 @@
-"""Simple DB migration runner for the captive portal.
+"""DB migration runner for the captive portal.
 
-Run this on the Pi or locally to ensure schema is up-to-date.
+Run this on the Pi or locally to bring the schema up to the latest version.
+Safe to run while the portal is serving: data backfills run in small batches.
 """
 from app import create_app
 import db
+import migrations
 
 
 def main():
-    app = create_app({"MOCK_SENSOR": True})
+    app = create_app({"MOCK_SENSOR": True, "MIGRATE_ON_START": False})
     ok = db.migrate(app)
     if ok:
-        print("Migration ran (tables ensured)")
+        with app.app_context():
+            version = migrations.current_version(db.get_db())
+        print(f"Migration ran (schema version {version}, latest {migrations.LATEST_VERSION})")
     else:
         print("Migration no-op; provide an app to run migrations")
 
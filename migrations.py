@@ -0,0 +1,427 @@
+"""Versioned schema migrations for the portal database.
+
+Applied versions are recorded in `schema_version`. Each migration has a
+short `up` step (DDL, runs in one `BEGIN IMMEDIATE` transaction) and an
+optional batched `backfill` step that works through a table in bounded
+chunks, committing and pausing between chunks so portal requests can take
+the write lock in between. Backfill progress is stored in
+`schema_migration_progress`, so an interrupted upgrade resumes where it
+stopped instead of starting over.
+
+Add new migrations to the end of `MIGRATIONS`; never renumber or edit one
+that has shipped.
+"""
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+import db as portal_db
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 5000
+DEFAULT_BATCH_PAUSE = 0.05  # seconds between backfill batches
+
+# Versions known to be applied, per database path. Versions never go backwards,
+# so positive answers can be cached for the life of the process.
+_applied_cache = {}
+_cache_lock = threading.Lock()
+
+
+class Migration:
+    """One schema step.
+
+    up(conn) -> optional int target passed to backfill (e.g. a max id high-water mark).
+    backfill(conn, position, target, batch_size) -> next position, or None when done.
+    """
+
+    def __init__(self, version, name, up, backfill=None):
+        self.version = version
+        self.name = name
+        self.up = up
+        self.backfill = backfill
+
+
+# ----------------------------------------------------------------------------
+# Migration steps
+# ----------------------------------------------------------------------------
+
+def _baseline(conn):
+    portal_db._create_tables(conn)
+
+
+def _index_sessions_ip(conn):
+    # get_session_for_device matches mac_address OR ip_address; without this
+    # index SQLite can only use the status index and filters the rest.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_ip ON sessions(ip_address)')
+
+
+def _index_ratings_submitted(conn):
+    # Admin date-range filters on ratings.submitted_at scanned the whole table.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_ratings_submitted ON ratings(submitted_at)')
+
+
+def _bottle_daily_totals(conn):
+    """Per-PH-day bottle totals so admin counters don't SUM all of bottle_logs."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS bottle_daily_totals (
+            day TEXT PRIMARY KEY,
+            bottles INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    # New rows are counted by the trigger from now on; rows up to the current
+    # max id are counted by the backfill below.
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_bottle_logs_daily_totals
+        AFTER INSERT ON bottle_logs
+        BEGIN
+            INSERT INTO bottle_daily_totals (day, bottles)
+            VALUES (date(NEW.created_at + 28800, 'unixepoch'), NEW.count)
+            ON CONFLICT(day) DO UPDATE SET bottles = bottles + excluded.bottles;
+        END
+    ''')
+    row = conn.execute('SELECT COALESCE(MAX(id), 0) FROM bottle_logs').fetchone()
+    return row[0]
+
+
+def _backfill_bottle_daily_totals(conn, position, target, batch_size):
+    if position >= target:
+        return None
+    upper = min(target, position + batch_size)
+    conn.execute('''
+        INSERT INTO bottle_daily_totals (day, bottles)
+        SELECT date(created_at + 28800, 'unixepoch') AS day, SUM(count)
+        FROM bottle_logs
+        WHERE id > ? AND id <= ?
+        GROUP BY day
+        ON CONFLICT(day) DO UPDATE SET bottles = bottles + excluded.bottles
+    ''', (position, upper))
+    return upper
+
+
+def _retention_tables(conn):
+    """Daily event counts that survive system_logs pruning, plus retention job state."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS system_log_daily_counts (
+            day TEXT NOT NULL,
+            event_type TEXT NOT NULL,
+            events INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, event_type)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS retention_state (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+
+
+def _bottle_event_keys(conn):
+    """Client event keys on bottle_logs so batched bottle posts can be retried safely."""
+    conn.execute('ALTER TABLE bottle_logs ADD COLUMN event_key TEXT')
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_bottle_logs_event_key
+        ON bottle_logs(session_id, event_key)
+        WHERE event_key IS NOT NULL
+    ''')
+
+
+def _idempotency_keys(conn):
+    """Stored responses for Idempotency-Key replays (services/idempotency.py)."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            scope TEXT NOT NULL,
+            key TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            status INTEGER NOT NULL,
+            content_type TEXT,
+            body BLOB,
+            created_at INTEGER NOT NULL,
+            PRIMARY KEY (scope, key)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys(created_at)')
+
+
+def _ratings_unique_session(conn):
+    """One rating per session, enforced by SQLite instead of check-then-insert."""
+    # keep the first rating of any session that slipped through the old race
+    conn.execute('''
+        DELETE FROM ratings
+        WHERE id NOT IN (SELECT MIN(id) FROM ratings GROUP BY session_id)
+    ''')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_ratings_session_unique ON ratings(session_id)')
+    conn.execute('DROP INDEX IF EXISTS idx_ratings_session')
+
+
+def _devices(conn):
+    """Device registry; sessions point at a device instead of being matched by MAC OR IP."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS devices (
+            id INTEGER PRIMARY KEY,
+            mac_address TEXT,
+            cookie_id TEXT,
+            ip_address TEXT,
+            first_seen INTEGER NOT NULL,
+            last_seen INTEGER NOT NULL,
+            CHECK ((mac_address IS NULL) <> (cookie_id IS NULL))
+        )
+    ''')
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_devices_mac
+        ON devices(mac_address) WHERE mac_address IS NOT NULL
+    ''')
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_devices_cookie
+        ON devices(cookie_id) WHERE cookie_id IS NOT NULL
+    ''')
+    conn.execute('ALTER TABLE sessions ADD COLUMN device_id INTEGER REFERENCES devices(id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_device ON sessions(device_id, created_at)')
+    row = conn.execute('SELECT COALESCE(MAX(id), 0) FROM sessions').fetchone()
+    return row[0]
+
+
+def _backfill_session_devices(conn, position, target, batch_size):
+    # Sessions created while this runs may predate db.create_session seeing the
+    # device_id column, so keep going past the starting high-water mark until
+    # every session row has been visited.
+    latest = conn.execute('SELECT COALESCE(MAX(id), 0) FROM sessions').fetchone()[0]
+    if position >= max(target or 0, latest):
+        return None
+    upper = min(max(target or 0, latest), position + batch_size)
+    # mac_address holds either a MAC or 'device:<cookie id>' (routes.portal.get_device_identifier)
+    conn.execute('''
+        INSERT INTO devices (mac_address, cookie_id, ip_address, first_seen, last_seen)
+        SELECT
+            CASE WHEN substr(mac_address, 1, 7) = 'device:' THEN NULL ELSE lower(mac_address) END AS mac,
+            CASE WHEN substr(mac_address, 1, 7) = 'device:' THEN substr(mac_address, 8) END AS cookie,
+            ip_address, MIN(created_at), MAX(updated_at)
+        FROM sessions
+        WHERE id > ? AND id <= ?
+        GROUP BY mac, cookie
+        ON CONFLICT(mac_address) WHERE mac_address IS NOT NULL DO UPDATE SET
+            first_seen = MIN(first_seen, excluded.first_seen),
+            last_seen = MAX(last_seen, excluded.last_seen)
+        ON CONFLICT(cookie_id) WHERE cookie_id IS NOT NULL DO UPDATE SET
+            first_seen = MIN(first_seen, excluded.first_seen),
+            last_seen = MAX(last_seen, excluded.last_seen)
+    ''', (position, upper))
+    conn.execute('''
+        UPDATE sessions SET device_id = CASE
+            WHEN substr(mac_address, 1, 7) = 'device:'
+                THEN (SELECT id FROM devices WHERE cookie_id = substr(sessions.mac_address, 8))
+            ELSE (SELECT id FROM devices WHERE mac_address = lower(sessions.mac_address))
+        END
+        WHERE id > ? AND id <= ? AND device_id IS NULL
+    ''', (position, upper))
+    return upper
+
+
+def _session_usage(conn):
+    """Per-session traffic counters and per-PH-day totals (services/usage.py)."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS session_usage (
+            session_id INTEGER PRIMARY KEY REFERENCES sessions(id) ON DELETE CASCADE,
+            bytes_up INTEGER NOT NULL DEFAULT 0,
+            bytes_down INTEGER NOT NULL DEFAULT 0,
+            packets_up INTEGER NOT NULL DEFAULT 0,
+            packets_down INTEGER NOT NULL DEFAULT 0,
+            updated_at INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS usage_daily_totals (
+            day TEXT PRIMARY KEY,
+            bytes_up INTEGER NOT NULL DEFAULT 0,
+            bytes_down INTEGER NOT NULL DEFAULT 0,
+            packets_up INTEGER NOT NULL DEFAULT 0,
+            packets_down INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+
+
+MIGRATIONS = [
+    Migration(1, 'baseline schema', _baseline),
+    Migration(2, 'index sessions.ip_address', _index_sessions_ip),
+    Migration(3, 'index ratings.submitted_at', _index_ratings_submitted),
+    Migration(4, 'bottle_daily_totals rollup', _bottle_daily_totals, _backfill_bottle_daily_totals),
+    Migration(5, 'retention tables', _retention_tables),
+    Migration(6, 'bottle_logs.event_key', _bottle_event_keys),
+    Migration(7, 'idempotency_keys', _idempotency_keys),
+    Migration(8, 'unique ratings.session_id', _ratings_unique_session),
+    Migration(9, 'devices registry', _devices, _backfill_session_devices),
+    Migration(10, 'session_usage', _session_usage),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+# Version after which db.py may read bottle_daily_totals instead of bottle_logs.
+BOTTLE_ROLLUP_VERSION = 4
+# Version after which services/retention.py may prune logs.
+RETENTION_VERSION = 5
+# Version after which /api/bottle/batch can deduplicate events by key.
+BOTTLE_EVENT_KEYS_VERSION = 6
+# Version after which services/idempotency.py persists responses.
+IDEMPOTENCY_VERSION = 7
+# Version after which ratings.session_id is UNIQUE (db.submit_rating uses ON CONFLICT).
+RATINGS_UNIQUE_VERSION = 8
+# Version after which every session has sessions.device_id (db.get_session_for_device uses it).
+DEVICES_VERSION = 9
+# Version after which services/usage.py stores traffic counters.
+USAGE_VERSION = 10
+
+
+# ----------------------------------------------------------------------------
+# Engine
+# ----------------------------------------------------------------------------
+
+def _now():
+    return int(datetime.now(timezone.utc).timestamp())
+
+
+def _ensure_version_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migration_progress (
+            version INTEGER PRIMARY KEY,
+            position INTEGER NOT NULL DEFAULT 0,
+            target INTEGER,
+            updated_at INTEGER NOT NULL
+        )
+    ''')
+
+
+def applied_versions(conn):
+    """Set of versions recorded in schema_version (empty if the table is missing)."""
+    try:
+        rows = conn.execute('SELECT version FROM schema_version').fetchall()
+    except sqlite3.OperationalError:
+        return set()
+    return {r[0] for r in rows}
+
+
+def current_version(conn):
+    versions = applied_versions(conn)
+    return max(versions) if versions else 0
+
+
+def is_applied(conn, version, db_path=None):
+    """Cheap check used on request paths; caches positive answers per db_path."""
+    key = db_path or ''
+    with _cache_lock:
+        if version in _applied_cache.get(key, ()):
+            return True
+    versions = applied_versions(conn)
+    with _cache_lock:
+        _applied_cache[key] = versions
+    return version in versions
+
+
+def _apply_up(conn, migration):
+    """Run the DDL step. Returns False if another process got there first."""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        done = conn.execute('SELECT 1 FROM schema_version WHERE version = ?', (migration.version,)).fetchone()
+        started = conn.execute(
+            'SELECT 1 FROM schema_migration_progress WHERE version = ?', (migration.version,)
+        ).fetchone()
+        if done or started:
+            conn.execute('COMMIT')
+            return not done
+        target = migration.up(conn)
+        if migration.backfill is None:
+            conn.execute(
+                'INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)',
+                (migration.version, migration.name, _now()),
+            )
+        else:
+            conn.execute(
+                'INSERT INTO schema_migration_progress (version, position, target, updated_at) VALUES (?, 0, ?, ?)',
+                (migration.version, target, _now()),
+            )
+        conn.execute('COMMIT')
+        return migration.backfill is not None
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def _run_backfill(conn, migration, batch_size, pause):
+    batches = 0
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT position, target FROM schema_migration_progress WHERE version = ?',
+                (migration.version,),
+            ).fetchone()
+            if row is None:
+                # finished by another process
+                conn.execute('COMMIT')
+                return batches
+            position, target = row
+            next_position = migration.backfill(conn, position, target, batch_size)
+            if next_position is None:
+                conn.execute('DELETE FROM schema_migration_progress WHERE version = ?', (migration.version,))
+                conn.execute(
+                    'INSERT OR IGNORE INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)',
+                    (migration.version, migration.name, _now()),
+                )
+                conn.execute('COMMIT')
+                return batches
+            conn.execute(
+                'UPDATE schema_migration_progress SET position = ?, updated_at = ? WHERE version = ?',
+                (next_position, _now(), migration.version),
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        batches += 1
+        if pause:
+            # let request handlers grab the write lock between batches
+            time.sleep(pause)
+
+
+def migrate(db_path, batch_size=DEFAULT_BATCH_SIZE, pause=DEFAULT_BATCH_PAUSE, logger=None):
+    """Apply all pending migrations to the database at db_path.
+
+    Returns the list of versions applied by this call.
+    """
+    logger = logger or log
+    conn = portal_db.connect_autocommit(db_path)
+    applied_now = []
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        _ensure_version_tables(conn)
+        conn.execute('COMMIT')
+
+        done = applied_versions(conn)
+        for migration in MIGRATIONS:
+            if migration.version in done:
+                continue
+            started = time.perf_counter()
+            needs_backfill = _apply_up(conn, migration)
+            batches = 0
+            if needs_backfill:
+                batches = _run_backfill(conn, migration, batch_size, pause)
+            if migration.version in applied_versions(conn):
+                applied_now.append(migration.version)
+                logger.info(
+                    'Applied migration %d (%s) in %.2fs, %d backfill batches',
+                    migration.version, migration.name, time.perf_counter() - started, batches,
+                )
+    finally:
+        conn.close()
+    with _cache_lock:
+        _applied_cache.pop(db_path, None)
+    return applied_now
@@ -0,0 +1,120 @@
+"""Slotted record types for rows read by db.py.
+
+`db.py` builds these straight from the cursor (a per-cursor row factory on
+an explicit column list), instead of going through `sqlite3.Row` and then
+a dict for every row. A `Session` is one object with ten slots and no
+per-instance `__dict__`.
+
+Records read like the dicts they replace (`s["status"]`, `s.get("ip_address")`,
+`s["status"] = ...` for fields), so route code is unchanged. `to_dict()` is
+the JSON path: Flask's JSON provider (see app.py) and `json_default` for
+plain `json.dumps` call it.
+"""
+from dataclasses import dataclass, fields
+from operator import attrgetter
+
+
+class Record:
+    __slots__ = ()
+    _fields = ()
+    _field_set = frozenset()
+    columns = ''
+
+    def __getitem__(self, key):
+        if key not in self._field_set:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self._field_set:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self._field_set
+
+    def get(self, key, default=None):
+        if key not in self._field_set:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return self._fields
+
+    def to_dict(self):
+        return dict(zip(self._fields, self._values(self)))
+
+    @classmethod
+    def row_factory(cls, cursor, row):
+        return cls(*row)
+
+
+def record(cls):
+    """Class decorator: slotted dataclass whose fields are also its SELECT column list."""
+    cls = dataclass(slots=True)(cls)
+    cls._fields = tuple(f.name for f in fields(cls))
+    cls._field_set = frozenset(cls._fields)
+    # attrgetter with one name returns a bare value, not a 1-tuple
+    getter = attrgetter(*cls._fields)
+    cls._values = staticmethod(getter if len(cls._fields) > 1 else (lambda obj: (getter(obj),)))
+    cls.columns = ', '.join(cls._fields)
+    return cls
+
+
+@record
+class Session(Record):
+    id: int
+    mac_address: str
+    ip_address: str
+    bottles_inserted: int
+    seconds_earned: int
+    session_start: int
+    session_end: int
+    status: str
+    created_at: int
+    updated_at: int
+
+
+@record
+class Rating(Record):
+    id: int
+    session_id: int
+    q1: int
+    q2: int
+    q3: int
+    q4: int
+    q5: int
+    q6: int
+    q7: int
+    q8: int
+    q9: int
+    q10: int
+    q11: int
+    q12: int
+    q13: int
+    q14: int
+    comment: str
+    submitted_at: int
+
+
+@record
+class BottleLog(Record):
+    id: int
+    session_id: int
+    count: int
+    created_at: int
+
+
+@record
+class ExpiredSession(Record):
+    """RETURNING row of db.sweep_expired_sessions."""
+    id: int
+    ip_address: str
+    mac_address: str
+
+
+def json_default(obj):
+    """`default=` hook for json.dumps."""
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
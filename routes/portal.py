@@ -1,8 +1,11 @@
 import os
+import re
 import subprocess
 import uuid
 from flask import Blueprint, render_template, request, redirect, url_for, current_app, jsonify, make_response
 import db
+from services.http_cache import conditional, session_validators
+from services.rate_limit import rate_limited
 from services.network import get_mac_for_ip
 from db import create_session, get_session, get_session_for_device
 from datetime import datetime, timezone
@@ -63,6 +66,7 @@ def waiting(session_id):
 
 
 @bp.route("/api/session/<int:session_id>/status")
+@conditional(session_validators)
 def session_status(session_id):
     """Return basic session info for the UI (guard against server errors)."""
     try:
@@ -85,6 +89,7 @@ def session_status(session_id):
 
 
 @bp.route("/api/session/lookup", methods=("GET", "POST"))
+@rate_limited("lookup")
 def api_session_lookup():
     """
     Captive portal session lookup.
@@ -177,7 +182,6 @@ def _get_mac_for_ip(ip):
                 out = subprocess.check_output(cmd, stderr=subprocess.DEVNULL, universal_newlines=True)
                 if ip in out:
                     # try to extract a mac-like token
-                    import re
                     m = re.search(r'([0-9a-fA-F]{2}(?:[:\-][0-9a-fA-F]{2}){5})', out)
                     if m:
                         return m.group(1)
@@ -0,0 +1,54 @@
+"""Take, list or restore snapshots of the portal database.
+
+Backups use SQLite's online backup API, so they can run while the portal
+is serving. Restores overwrite the live database: stop the portal first.
+
+    python scripts/backup_db.py backup
+    python scripts/backup_db.py list
+    python scripts/backup_db.py restore instance/backups/wifi_portal-20260101-030000.db.gz
+"""
+import argparse
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services import backup  # noqa: E402
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="EcoNeT database backups")
+    parser.add_argument("--db", default=os.environ.get("DB_PATH", os.path.join("instance", "wifi_portal.db")))
+    parser.add_argument("--dir", default=os.environ.get("BACKUP_DIR", os.path.join("instance", "backups")))
+    sub = parser.add_subparsers(dest="command", required=True)
+    take = sub.add_parser("backup", help="take a compressed snapshot")
+    take.add_argument("--keep", type=int, default=int(os.environ.get("BACKUP_KEEP", 7)))
+    take.add_argument("--step-pages", type=int, default=256)
+    take.add_argument("--pause", type=float, default=0.01)
+    sub.add_parser("list", help="list snapshots, newest first")
+    restore = sub.add_parser("restore", help="restore a snapshot into --db")
+    restore.add_argument("snapshot", nargs="?", help="snapshot file (default: newest in --dir)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logger = logging.getLogger("backup")
+
+    if args.command == "backup":
+        backup.create_snapshot(args.db, args.dir, keep=args.keep, step_pages=args.step_pages,
+                               pause=args.pause, logger=logger)
+    elif args.command == "list":
+        for path in backup.list_snapshots(args.dir, args.db):
+            print(f"{path}\t{os.path.getsize(path)} bytes")
+    elif args.command == "restore":
+        snapshot = args.snapshot
+        if not snapshot:
+            snapshots = backup.list_snapshots(args.dir, args.db)
+            if not snapshots:
+                sys.exit(f"No snapshots found in {args.dir}")
+            snapshot = snapshots[0]
+        backup.restore_snapshot(snapshot, args.db, logger=logger)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""Build minified, fingerprinted and precompressed static assets.
+
+Writes static/dist/ and static/dist/manifest.json; templates pick the built
+files up on the next portal start (set USE_BUILT_ASSETS=false to ignore
+them). Re-run after editing anything under static/.
+
+    python scripts/build_assets.py
+"""
+import argparse
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services import assets  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build static/dist for production")
+    parser.add_argument("--static", default=os.path.join(ROOT, "static"))
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if assets.brotli is None:
+        print("brotli not installed; writing gzip variants only")
+    manifest = assets.build(args.static, logger=logging.getLogger("assets"))
+    for source, built in sorted(manifest.items()):
+        print(f"{source} -> {built}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Run one retention/compaction pass on the portal database.
+
+Unlike clear_db.py this keeps recent data and never blocks the portal for
+long: old logs are pruned in small batches and free pages are released with
+incremental vacuum.
+
+    python scripts/compact_db.py                      # one retention pass
+    python scripts/compact_db.py --enable-incremental # one-time switch, runs VACUUM
+"""
+import argparse
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services import retention  # noqa: E402
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prune old logs and reclaim space")
+    parser.add_argument("--db", default=os.environ.get("DB_PATH", os.path.join("instance", "wifi_portal.db")))
+    parser.add_argument("--system-log-days", type=int, default=int(os.environ.get("SYSTEM_LOG_RETENTION_DAYS", 90)))
+    parser.add_argument("--bottle-log-days", type=int, default=int(os.environ.get("BOTTLE_LOG_RETENTION_DAYS", 180)))
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--pause", type=float, default=0.05)
+    parser.add_argument("--enable-incremental", action="store_true",
+                        help="switch the database to auto_vacuum=INCREMENTAL (full VACUUM, stop the portal first)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.enable_incremental:
+        ok = retention.enable_incremental_vacuum(args.db)
+        print("auto_vacuum=INCREMENTAL enabled" if ok else "Failed to enable incremental vacuum")
+
+    report = retention.run_retention(
+        args.db,
+        system_log_days=args.system_log_days,
+        bottle_log_days=args.bottle_log_days,
+        batch_size=args.batch,
+        pause=args.pause,
+        logger=logging.getLogger("retention"),
+    )
+    if report is None:
+        print("Schema not migrated yet; run python migrate_db.py first")
+        return
+    for key, value in report.items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
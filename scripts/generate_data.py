@@ -0,0 +1,261 @@
+"""Fill a portal database with synthetic, production-sized data.
+
+Used to benchmark session lookups, cleanup sweeps and admin queries
+against realistic volumes. Output is deterministic for a given --seed and
+--end timestamp.
+
+    python scripts/generate_data.py --db instance/bench.db --sessions 1000000 --reset
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import migrations  # noqa: E402
+
+PH_OFFSET = 8 * 3600
+SECONDS_PER_DAY = 86400
+
+# Relative weight of each PH-local hour of the day (school / community hours peak).
+HOUR_WEIGHTS = [1, 1, 1, 1, 1, 2, 4, 8, 12, 14, 14, 16, 18, 16, 14, 14, 16, 18, 14, 10, 8, 5, 3, 2]
+
+# Likert answers skew positive; each question gets a small bias on top.
+LIKERT_WEIGHTS = [4, 8, 20, 38, 30]
+
+COMMENTS = [
+    "Great idea!",
+    "Machine was slow to detect my bottle.",
+    "Please add more time per bottle.",
+    "Easy to use.",
+    "Wi-Fi dropped a few times.",
+    "Love that it helps reduce plastic waste.",
+]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic EcoNeT portal data")
+    parser.add_argument("--db", default=os.environ.get("DB_PATH", os.path.join("instance", "wifi_portal.db")),
+                        help="SQLite database path (default: $DB_PATH or instance/wifi_portal.db)")
+    parser.add_argument("--sessions", type=int, default=100_000, help="number of sessions to create")
+    parser.add_argument("--devices", type=int, default=None, help="distinct devices (default: sessions / 4)")
+    parser.add_argument("--days", type=int, default=365, help="spread sessions over this many days")
+    parser.add_argument("--end", type=int, default=None, help="UTC timestamp of the newest session (default: now)")
+    parser.add_argument("--active", type=int, default=50, help="sessions left in 'active' state")
+    parser.add_argument("--awaiting", type=int, default=200, help="sessions left in 'awaiting_insertion' state")
+    parser.add_argument("--inserting", type=int, choices=(0, 1), default=1, help="leave one session holding the insertion lock")
+    parser.add_argument("--rating-rate", type=float, default=0.15, help="fraction of paid sessions that submit a rating")
+    parser.add_argument("--batch", type=int, default=50_000, help="sessions per transaction")
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
+    parser.add_argument("--reset", action="store_true", help="delete existing rows first")
+    return parser.parse_args(argv)
+
+
+def _make_devices(rng, count):
+    devices = []
+    for _ in range(count):
+        if rng.random() < 0.6:
+            mac = ":".join(f"{rng.randrange(256):02x}" for _ in range(6))
+        else:
+            mac = "device:" + str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        ip = f"192.168.{4 + rng.randrange(4)}.{2 + rng.randrange(250)}"
+        devices.append((mac, ip))
+    return devices
+
+
+def _register_devices(conn, devices, now):
+    """devices row id for each generated (identifier, ip), reusing rows already in the database."""
+    ids = []
+    conn.execute("BEGIN")
+    for identifier, ip in devices:
+        column, value = db._device_key(identifier)
+        row = conn.execute(
+            f"""
+            INSERT INTO devices ({column}, ip_address, first_seen, last_seen) VALUES (?, ?, ?, ?)
+            ON CONFLICT({column}) WHERE {column} IS NOT NULL DO UPDATE SET ip_address = excluded.ip_address
+            RETURNING id
+            """,
+            (value, ip, now, now),
+        ).fetchone()
+        ids.append(row[0])
+    conn.execute("COMMIT")
+    return ids
+
+
+def _random_created_at(rng, start_ts, days):
+    day = rng.randrange(days)
+    hour = rng.choices(range(24), weights=HOUR_WEIGHTS)[0]
+    local_day_start = (start_ts + PH_OFFSET) // SECONDS_PER_DAY * SECONDS_PER_DAY + day * SECONDS_PER_DAY
+    return local_day_start - PH_OFFSET + hour * 3600 + rng.randrange(3600)
+
+
+def _bottles(rng):
+    # Mostly 1-3 bottles, long tail up to 15
+    return min(15, 1 + int(rng.expovariate(0.6)))
+
+
+def _bursts(rng, bottles):
+    """Split a bottle total into the per-request counts a client would post."""
+    parts = []
+    remaining = bottles
+    while remaining:
+        n = min(remaining, rng.choice((1, 1, 1, 2, 3)))
+        parts.append(n)
+        remaining -= n
+    return parts
+
+
+def _rating(rng, session_id, ts, biases):
+    answers = []
+    for bias in biases:
+        v = rng.choices((1, 2, 3, 4, 5), weights=LIKERT_WEIGHTS)[0] + bias
+        answers.append(max(1, min(5, v)))
+    comment = rng.choice(COMMENTS) if rng.random() < 0.3 else None
+    return (session_id, *answers, comment, ts)
+
+
+def _plan_statuses(args):
+    """Status for each generated session index, newest sessions last."""
+    special = [db.STATUS_AWAITING_INSERTION] * args.awaiting + [db.STATUS_ACTIVE] * args.active
+    if args.inserting:
+        special.append(db.STATUS_INSERTING)
+    special = special[: args.sessions]
+    return args.sessions - len(special), special
+
+
+def generate(conn, args):
+    rng = random.Random(args.seed)
+    end_ts = args.end or int(time.time())
+    start_ts = end_ts - args.days * SECONDS_PER_DAY
+    devices = _make_devices(rng, args.devices or max(1, args.sessions // 4))
+    device_ids = _register_devices(conn, devices, end_ts)
+    seen = {}  # device id -> (first created_at, last updated_at)
+    biases = [rng.choice((-1, 0, 0, 0, 1)) for _ in range(14)]
+
+    next_id = (conn.execute("SELECT COALESCE(MAX(id), 0) FROM sessions").fetchone()[0] or 0) + 1
+    expired_count, special = _plan_statuses(args)
+    totals = {"sessions": 0, "bottle_logs": 0, "ratings": 0, "system_logs": 0}
+
+    index = 0
+    while index < args.sessions:
+        batch_end = min(args.sessions, index + args.batch)
+        sessions, bottle_logs, ratings, system_logs = [], [], [], []
+
+        for i in range(index, batch_end):
+            sid = next_id + i
+            d = rng.randrange(len(devices))
+            mac, ip = devices[d]
+            device_id = device_ids[d]
+            if i < expired_count:
+                status = db.STATUS_EXPIRED
+                created = min(_random_created_at(rng, start_ts, args.days), end_ts - 3600)
+                # 15% of expired sessions were abandoned before inserting anything
+                bottles = 0 if rng.random() < 0.15 else _bottles(rng)
+            else:
+                status = special[i - expired_count]
+                created = end_ts - rng.randrange(120 if status == db.STATUS_INSERTING else 500)
+                bottles = _bottles(rng) if status == db.STATUS_ACTIVE else 0
+
+            seconds = bottles * db.SECONDS_PER_BOTTLE
+            session_start = session_end = None
+            updated = created
+            if bottles:
+                t = created + rng.randrange(10, 60)
+                for count in _bursts(rng, bottles):
+                    t += rng.randrange(3, 40)
+                    bottle_logs.append((sid, count, t))
+                    system_logs.append(("bottle_inserted", f"Bottle added to session {sid}", t))
+                session_start = t + rng.randrange(1, 10)
+                if status == db.STATUS_ACTIVE:
+                    # keep active sessions running past --end
+                    session_start = end_ts - rng.randrange(max(1, seconds))
+                session_end = session_start + seconds
+                updated = session_start
+                system_logs.append(("session_started", f"Session {sid} started", session_start))
+                if status == db.STATUS_EXPIRED:
+                    updated = session_end
+                    system_logs.append(("session_expired", f"Session {sid} expired", session_end))
+                    if rng.random() < args.rating_rate:
+                        ts = session_end + rng.randrange(30, 900)
+                        ratings.append(_rating(rng, sid, ts, biases))
+                        system_logs.append(("rating_submitted", f"Rating submitted for session {sid}", ts))
+            elif status == db.STATUS_EXPIRED:
+                updated = created + 600
+                system_logs.append(("session_expired", f"Session {sid} expired", updated))
+
+            sessions.append((sid, mac, ip, device_id, bottles, seconds, session_start, session_end,
+                             status, created, updated))
+            first, last = seen.get(device_id, (created, updated))
+            seen[device_id] = (min(first, created), max(last, updated))
+
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT INTO sessions (id, mac_address, ip_address, device_id, bottles_inserted, seconds_earned, "
+            "session_start, session_end, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            sessions,
+        )
+        conn.executemany("INSERT INTO bottle_logs (session_id, count, created_at) VALUES (?, ?, ?)", bottle_logs)
+        conn.executemany(
+            "INSERT INTO ratings (session_id, q1, q2, q3, q4, q5, q6, q7, q8, q9, q10, q11, q12, q13, q14, "
+            "comment, submitted_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            ratings,
+        )
+        conn.executemany("INSERT INTO system_logs (event_type, description, created_at) VALUES (?, ?, ?)", system_logs)
+        conn.execute("COMMIT")
+
+        totals["sessions"] += len(sessions)
+        totals["bottle_logs"] += len(bottle_logs)
+        totals["ratings"] += len(ratings)
+        totals["system_logs"] += len(system_logs)
+        print(f"  {batch_end}/{args.sessions} sessions written")
+        index = batch_end
+
+    conn.execute("BEGIN")
+    conn.executemany(
+        "UPDATE devices SET first_seen = MIN(first_seen, ?), last_seen = ? WHERE id = ?",
+        [(first, last, device_id) for device_id, (first, last) in seen.items()],
+    )
+    conn.execute("COMMIT")
+    totals["devices"] = len(seen)
+    return totals
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    db_dir = os.path.dirname(args.db)
+    if db_dir:
+        os.makedirs(db_dir, exist_ok=True)
+
+    conn = sqlite3.connect(args.db, isolation_level=None)
+    db._create_tables(conn)
+    # devices registry, sessions.device_id and the other migrated tables
+    migrations.migrate(args.db, pause=0)
+    # Generation only: trade durability for speed, these settings are per-connection
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA temp_store = MEMORY")
+
+    if args.reset:
+        for table in ("ratings", "bottle_logs", "system_logs", "sessions", "devices"):
+            conn.execute(f"DELETE FROM {table}")
+            print(f"Cleared table: {table}")
+    elif args.inserting and conn.execute("SELECT 1 FROM sessions WHERE status = ?", (db.STATUS_INSERTING,)).fetchone():
+        # idx_single_inserting allows only one holder of the insertion lock
+        args.inserting = 0
+
+    started = time.perf_counter()
+    totals = generate(conn, args)
+    conn.execute("ANALYZE")
+    conn.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"Generated {totals['sessions']} sessions ({totals['devices']} devices), "
+          f"{totals['bottle_logs']} bottle_logs, {totals['ratings']} ratings, {totals['system_logs']} system_logs in {elapsed:.1f}s -> {args.db}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,12 +4,34 @@ The `AccessController` class delegates to an implementation chosen at
 initialization time. On a Pi you can enable iptables rules by setting
 `USE_IPTABLES=True` in app config; set `DRY_RUN=True` to avoid actually
 running system commands during testing.
+
+`AccessReconciler` keeps the controller in line with the `sessions` table.
+Every `ACCESS_RECONCILE_INTERVAL` seconds, and shortly after any session
+write, it diffs the IPs of active sessions against the controller's actual
+state. For iptables that state comes from one `iptables -S FORWARD` read. It
+then applies the missing grants and stale revokes as two batches. Rules
+survive a portal restart and the controller's own `_allowed` set doesn't, so
+the firewall is treated as the source of truth.
+
+With `SHAPING_ENABLED`, every granted IP also gets its own HTB class on
+`SHAPING_IFACE` (the LAN side, so this shapes downloads to the client). Each
+class is limited to `SHAPING_RATE_KBIT` (bursting to `SHAPING_CEIL_KBIT`)
+under an `SHAPING_UPLINK_KBIT` parent, with fq_codel inside it. Classes are
+added and removed in the same batches as the grants and revokes, one
+`tc -batch` run per batch. With `DRY_RUN` the tc scripts are recorded in
+`TrafficShaper.recorded` (the latest `RECORDED_MAX`) instead of run.
 """
 import logging
+import re
 import subprocess
+import threading
+import time
+from collections import deque
 from threading import Lock
 from typing import Optional
 
+import db
+
 
 class _InMemoryController:
 	def __init__(self, app=None):
@@ -28,6 +50,30 @@ class _InMemoryController:
 		logging.info("InMemoryController.revoke %s", ip)
 		return True
 
+	def revoke_many(self, ips):
+		with self._lock:
+			revoked = [ip for ip in ips if ip in self._allowed]
+			self._allowed.difference_update(revoked)
+		if revoked:
+			logging.info("InMemoryController.revoke_many %d IPs", len(revoked))
+		return revoked
+
+	def grant_many(self, ips):
+		with self._lock:
+			granted = [ip for ip in ips if ip not in self._allowed]
+			self._allowed.update(granted)
+		if granted:
+			logging.info("InMemoryController.grant_many %d IPs", len(granted))
+		return granted
+
+	def current_state(self):
+		with self._lock:
+			return set(self._allowed)
+
+	def counters(self):
+		# nothing to count without a firewall
+		return {}
+
 	def is_allowed(self, ip: str) -> bool:
 		with self._lock:
 			return ip in self._allowed
@@ -37,25 +83,53 @@ class _InMemoryController:
 			return list(self._allowed)
 
 
+# FORWARD rules written by grant()/grant_many(): `-s ip` lets the client out
+# and counts its upload, `-d ip` counts its download. Both are tagged with
+# RULE_COMMENT, so rules an operator added by hand (subnets, servers) are
+# never taken for portal grants. Matched against `iptables -S FORWARD` and,
+# with the `[packets:bytes]` prefix, `iptables-save -c`.
+RULE_COMMENT = "wifi-portal"
+_ACCEPT_RULE_RE = re.compile(
+	r"^(?:\[(\d+):(\d+)\] )?-A FORWARD -([sd]) (\S+)/32 -m comment --comment " + RULE_COMMENT + r" -j ACCEPT$"
+)
+
+
+def _rule(direction, ip):
+	"""iptables arguments of the portal's ACCEPT rule for ip, after the chain name."""
+	return [f"-{direction}", ip, "-m", "comment", "--comment", RULE_COMMENT, "-j", "ACCEPT"]
+
+
+def _restore_lines(action, ips, direction):
+	return "".join(f"{action} FORWARD {' '.join(_rule(direction, ip))}\n" for ip in ips)
+
+
 class _IptablesController:
 	def __init__(self, app=None, dry_run=True):
 		self._lock = Lock()
 		self._allowed = set()
+		self._counted = set()  # IPs with a `-d ip` download rule
 		self.dry_run = bool(dry_run)
 
-	def _run(self, cmd):
+	def _run(self, cmd, stdin=None):
 		logging.debug("Iptables cmd: %s (dry_run=%s)", " ".join(cmd), self.dry_run)
+		if stdin:
+			logging.debug("Iptables input:\n%s", stdin)
 		if self.dry_run:
 			return 0
-		return subprocess.check_call(cmd)
+		if stdin is None:
+			return subprocess.check_call(cmd)
+		return subprocess.run(cmd, input=stdin, text=True, check=True).returncode
 
 	def grant(self, ip: str, duration_seconds: int):
-		# Insert a rule to allow forwarding for this source IP.
-		cmd = ["iptables", "-I", "FORWARD", "-s", ip, "-j", "ACCEPT"]
+		# Insert a rule to allow forwarding for this source IP, and one that
+		# counts traffic back to it.
+		cmd = ["iptables", "-I", "FORWARD", *_rule("s", ip)]
 		try:
 			self._run(cmd)
+			self._run(["iptables", "-I", "FORWARD", *_rule("d", ip)])
 			with self._lock:
 				self._allowed.add(ip)
+				self._counted.add(ip)
 			logging.info("IptablesController.grant %s", ip)
 			return True
 		except Exception:
@@ -63,17 +137,94 @@ class _IptablesController:
 			return False
 
 	def revoke(self, ip: str):
-		cmd = ["iptables", "-D", "FORWARD", "-s", ip, "-j", "ACCEPT"]
+		cmd = ["iptables", "-D", "FORWARD", *_rule("s", ip)]
 		try:
 			self._run(cmd)
+			with self._lock:
+				counted = ip in self._counted
+			if counted:
+				self._run(["iptables", "-D", "FORWARD", *_rule("d", ip)])
 			with self._lock:
 				self._allowed.discard(ip)
+				self._counted.discard(ip)
 			logging.info("IptablesController.revoke %s", ip)
 			return True
 		except Exception:
 			logging.exception("Failed to revoke iptables rule for %s", ip)
 			return False
 
+	def revoke_many(self, ips):
+		# One iptables-restore run deletes every rule (and fails as a whole),
+		# instead of one iptables process per IP. Only IPs we granted are
+		# listed: deleting a missing rule would abort the batch.
+		with self._lock:
+			revoked = [ip for ip in ips if ip in self._allowed]
+			counted = [ip for ip in revoked if ip in self._counted]
+		if not revoked:
+			return []
+		rules = _restore_lines("-D", revoked, "s") + _restore_lines("-D", counted, "d")
+		try:
+			self._run(["iptables-restore", "--noflush"], stdin=f"*filter\n{rules}COMMIT\n")
+		except Exception:
+			logging.exception("Failed to revoke %d iptables rules", len(revoked))
+			return []
+		with self._lock:
+			self._allowed.difference_update(revoked)
+			self._counted.difference_update(counted)
+		logging.info("IptablesController.revoke_many %d IPs", len(revoked))
+		return revoked
+
+	def grant_many(self, ips):
+		with self._lock:
+			granted = [ip for ip in ips if ip not in self._allowed]
+		if not granted:
+			return []
+		rules = _restore_lines("-I", granted, "s") + _restore_lines("-I", granted, "d")
+		try:
+			self._run(["iptables-restore", "--noflush"], stdin=f"*filter\n{rules}COMMIT\n")
+		except Exception:
+			logging.exception("Failed to grant %d iptables rules", len(granted))
+			return []
+		with self._lock:
+			self._allowed.update(granted)
+			self._counted.update(granted)
+		logging.info("IptablesController.grant_many %d IPs", len(granted))
+		return granted
+
+	def current_state(self):
+		"""IPs with a portal ACCEPT rule, read from the FORWARD chain in one call."""
+		if self.dry_run:
+			with self._lock:
+				return set(self._allowed)
+		out = subprocess.check_output(["iptables", "-S", "FORWARD"], text=True)
+		allowed, counted = set(), set()
+		for line in out.splitlines():
+			m = _ACCEPT_RULE_RE.match(line)
+			if m:
+				(allowed if m.group(3) == "s" else counted).add(m.group(4))
+		with self._lock:
+			self._allowed = set(allowed)
+			self._counted = counted
+		return allowed
+
+	def counters(self):
+		"""{ip: (packets_up, bytes_up, packets_down, bytes_down)} from one `iptables-save -c` dump."""
+		if self.dry_run:
+			return {}
+		out = subprocess.check_output(["iptables-save", "-c", "-t", "filter"], text=True)
+		counts = {}
+		for line in out.splitlines():
+			m = _ACCEPT_RULE_RE.match(line)
+			if not m or m.group(1) is None:
+				continue
+			packets, nbytes, direction, ip = int(m.group(1)), int(m.group(2)), m.group(3), m.group(4)
+			up_p, up_b, down_p, down_b = counts.get(ip, (0, 0, 0, 0))
+			if direction == "s":
+				counts[ip] = (up_p + packets, up_b + nbytes, down_p, down_b)
+			else:
+				counts[ip] = (up_p, up_b, down_p + packets, down_b + nbytes)
+		return counts
+
 	def is_allowed(self, ip: str) -> bool:
 		with self._lock:
 			return ip in self._allowed
@@ -83,6 +234,113 @@ class _IptablesController:
 			return list(self._allowed)
 
 
+class TrafficShaper:
+	# 1:1 is the uplink parent, 1:2 the default class for unshaped traffic
+	# (portal pages before a grant); clients get minors from 0x10 up, which
+	# are also their filter priorities.
+	FIRST_MINOR = 0x10
+	LAST_MINOR = 0xfff0
+	# dry-run scripts kept for inspection; older ones are dropped
+	RECORDED_MAX = 200
+
+	def __init__(self, iface, rate_kbit, ceil_kbit=None, uplink_kbit=None, dry_run=True):
+		self.iface = iface
+		self.rate_kbit = int(rate_kbit)
+		self.ceil_kbit = int(ceil_kbit or rate_kbit)
+		self.uplink_kbit = int(uplink_kbit or max(self.ceil_kbit, self.rate_kbit) * 10)
+		self.dry_run = bool(dry_run)
+		self.recorded = deque(maxlen=self.RECORDED_MAX)  # latest tc batch scripts, when dry_run
+		self._lock = Lock()
+		self._classes = {}  # ip -> minor id
+		self._free = []
+		self._next_minor = self.FIRST_MINOR
+		self._started = False
+
+	def _tc(self, lines):
+		script = "".join(line + "\n" for line in lines)
+		if self.dry_run:
+			self.recorded.append(script)
+			return
+		try:
+			# -force: keep going past a single failed line (e.g. a class already gone)
+			subprocess.run(["tc", "-force", "-batch", "-"], input=script, text=True, check=True)
+		except Exception:
+			logging.exception("TrafficShaper: tc batch failed:\n%s", script)
+
+	def _setup_lines(self):
+		dev = self.iface
+		return [
+			f"qdisc replace dev {dev} root handle 1: htb default 2",
+			f"class replace dev {dev} parent 1: classid 1:1 htb rate {self.uplink_kbit}kbit",
+			f"class replace dev {dev} parent 1:1 classid 1:2 htb rate {self.rate_kbit}kbit ceil {self.uplink_kbit}kbit",
+			f"qdisc replace dev {dev} parent 1:2 handle 2: fq_codel",
+		]
+
+	def _allocate(self):
+		if self._free:
+			return self._free.pop()
+		if self._next_minor > self.LAST_MINOR:
+			return None
+		minor = self._next_minor
+		self._next_minor += 1
+		return minor
+
+	def add(self, ips):
+		"""Give each IP its own class; one tc run for the whole batch."""
+		dev = self.iface
+		lines = []
+		with self._lock:
+			if not self._started:
+				# replacing the root qdisc drops classes left by a previous run;
+				# the reconciler's sync() re-adds the clients that are still allowed
+				lines.extend(self._setup_lines())
+				self._started = True
+			for ip in ips:
+				if ip in self._classes:
+					continue
+				minor = self._allocate()
+				if minor is None:
+					logging.warning("TrafficShaper: out of class ids, %s stays in the default class", ip)
+					continue
+				self._classes[ip] = minor
+				lines.extend([
+					f"class replace dev {dev} parent 1:1 classid 1:{minor:x} htb rate {self.rate_kbit}kbit ceil {self.ceil_kbit}kbit",
+					f"qdisc replace dev {dev} parent 1:{minor:x} handle {minor:x}: fq_codel",
+					f"filter add dev {dev} parent 1: protocol ip prio {minor} flower dst_ip {ip} classid 1:{minor:x}",
+				])
+		if lines:
+			self._tc(lines)
+
+	def remove(self, ips):
+		dev = self.iface
+		lines = []
+		with self._lock:
+			for ip in ips:
+				minor = self._classes.pop(ip, None)
+				if minor is None:
+					continue
+				self._free.append(minor)
+				lines.extend([
+					f"filter del dev {dev} parent 1: protocol ip prio {minor}",
+					f"class del dev {dev} classid 1:{minor:x}",
+				])
+		if lines:
+			self._tc(lines)
+
+	def sync(self, allowed):
+		"""Shape exactly the IPs in `allowed` (a set)."""
+		with self._lock:
+			shaped = set(self._classes)
+		if shaped - allowed:
+			self.remove(sorted(shaped - allowed))
+		if allowed - shaped:
+			self.add(sorted(allowed - shaped))
+
+	def shaped(self):
+		with self._lock:
+			return dict(self._classes)
+
+
 class AccessController:
 	def __init__(self, app=None):
 		self.app = app
@@ -99,14 +357,150 @@ class AccessController:
 			self._impl = _InMemoryController(app=app)
 			logging.info("AccessController using InMemoryController")
 
+		self.shaper = None
+		if app is not None and app.config.get("SHAPING_ENABLED", False):
+			self.shaper = TrafficShaper(
+				app.config.get("SHAPING_IFACE", "wlan0"),
+				app.config.get("SHAPING_RATE_KBIT", 2048),
+				ceil_kbit=app.config.get("SHAPING_CEIL_KBIT"),
+				uplink_kbit=app.config.get("SHAPING_UPLINK_KBIT"),
+				dry_run=dry_run,
+			)
+			logging.info("AccessController shaping each client to %s kbit on %s",
+			             self.shaper.rate_kbit, self.shaper.iface)
+
 	def grant(self, ip: str, duration_seconds: int):
-		return self._impl.grant(ip, duration_seconds)
+		ok = self._impl.grant(ip, duration_seconds)
+		if ok and self.shaper is not None:
+			self.shaper.add([ip])
+		return ok
 
 	def revoke(self, ip: str):
-		return self._impl.revoke(ip)
+		ok = self._impl.revoke(ip)
+		if ok and self.shaper is not None:
+			self.shaper.remove([ip])
+		return ok
+
+	def revoke_many(self, ips):
+		"""Revoke several IPs in one batch; returns the IPs that had access."""
+		revoked = self._impl.revoke_many(ips)
+		if revoked and self.shaper is not None:
+			self.shaper.remove(revoked)
+		return revoked
+
+	def grant_many(self, ips):
+		"""Grant several IPs in one batch; returns the IPs that were newly granted."""
+		granted = self._impl.grant_many(ips)
+		if granted and self.shaper is not None:
+			self.shaper.add(granted)
+		return granted
+
+	def sync_shaping(self, allowed):
+		"""Make the shaper's classes match `allowed` (no-op without shaping)."""
+		if self.shaper is not None:
+			self.shaper.sync(allowed)
+
+	def current_state(self):
+		"""Set of IPs that currently have access, as the backend sees it."""
+		return self._impl.current_state()
+
+	def counters(self):
+		"""Cumulative per-IP (packets_up, bytes_up, packets_down, bytes_down) from the backend."""
+		return self._impl.counters()
 
 	def is_allowed(self, ip: str) -> bool:
 		return self._impl.is_allowed(ip)
 
 	def list_allowed(self):
 		return self._impl.list_allowed()
+
+
+def active_client_ips(conn, now=None):
+	"""IPs of sessions that should have access right now, including started ones topping up."""
+	return set(db.get_running_sessions_by_ip(conn, now))
+
+
+class AccessReconciler:
+	def __init__(self, controller, db_path, interval=30, min_gap=1.0):
+		self.controller = controller
+		self.db_path = db_path
+		self.interval = interval
+		self.min_gap = min_gap
+		self._wake = threading.Event()
+		self._lock = Lock()
+		self.runs = 0
+		self.granted = 0
+		self.revoked = 0
+		self.last = None
+
+	def reconcile(self):
+		"""One pass: diff desired vs actual and apply the difference. Returns a stats dict."""
+		started = time.perf_counter()
+		conn = db.connect_autocommit(self.db_path)
+		try:
+			desired = active_client_ips(conn)
+		finally:
+			conn.close()
+		read_done = time.perf_counter()
+		actual = self.controller.current_state()
+		to_grant = desired - actual
+		to_revoke = actual - desired
+		granted = self.controller.grant_many(sorted(to_grant)) if to_grant else []
+		revoked = self.controller.revoke_many(sorted(to_revoke)) if to_revoke else []
+		# clients allowed before a restart have no shaping class yet
+		self.controller.sync_shaping((actual | set(granted)) - set(revoked))
+		stats = {
+			"desired": len(desired),
+			"actual": len(actual),
+			"granted": len(granted),
+			"revoked": len(revoked),
+			"read_ms": round((read_done - started) * 1000, 2),
+			"total_ms": round((time.perf_counter() - started) * 1000, 2),
+			"at": int(time.time()),
+		}
+		with self._lock:
+			self.runs += 1
+			self.granted += len(granted)
+			self.revoked += len(revoked)
+			self.last = stats
+		if granted or revoked:
+			logging.info("Access reconcile: +%d -%d (%d active) in %.1f ms",
+			             len(granted), len(revoked), len(desired), stats["total_ms"])
+		return stats
+
+	def on_change(self, kind, session_id=None):
+		# db.on_change listener: activations and expiries show up within min_gap
+		if kind in ("session", "sessions"):
+			self._wake.set()
+
+	def _loop(self, logger):
+		while True:
+			self._wake.wait(self.interval)
+			self._wake.clear()
+			try:
+				self.reconcile()
+			except Exception:
+				logger.exception("Access reconcile failed")
+			time.sleep(self.min_gap)
+
+	def start(self, logger=None):
+		t = threading.Thread(target=self._loop, args=(logger or logging.getLogger(__name__),),
+		                     daemon=True, name="access-reconcile")
+		t.start()
+		return t
+
+	def snapshot(self):
+		with self._lock:
+			return {"runs": self.runs, "granted": self.granted, "revoked": self.revoked, "last": self.last}
+
+
+def init_app(app):
+	controller = AccessController(app)
+	app.extensions["access_control"] = controller
+	interval = int(app.config.get("ACCESS_RECONCILE_INTERVAL", 30))
+	if interval > 0:
+		reconciler = AccessReconciler(controller, db.get_db_path(app), interval=interval)
+		app.extensions["access_reconciler"] = reconciler
+		db.on_change(reconciler.on_change)
+		reconciler.start(app.logger)
+	return controller
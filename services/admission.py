@@ -0,0 +1,165 @@
+"""Admission control: shed low-priority requests when the portal is overloaded.
+
+Every request is classified by endpoint:
+
+    CRITICAL  bottle credits, activation, insertion heartbeat/unlock/status
+              changes: never shed, a lost credit or a stuck lock is worse
+              than a slow page
+    HIGH      captive-portal probes and the load endpoint itself (cheap,
+              and a failed probe makes the phone drop the portal)
+    NORMAL    everything else (pages, lookups, ratings)
+    LOW       admin analytics and dev-only endpoints
+
+The controller counts in-flight requests and keeps an exponentially weighted
+moving average of the time requests take to finish. That time includes
+waiting for SQLite's write lock, which is where an overloaded Pi spends it.
+The average decays while the portal is idle, so a burst doesn't shed traffic
+forever. A request is answered with 503 and `Retry-After` when in-flight or
+latency passes its priority's share of the budget:
+
+    LOW     in-flight >= ADMISSION_MAX_IN_FLIGHT / 2  or  latency > target
+    NORMAL  in-flight >= ADMISSION_MAX_IN_FLIGHT      or  latency > 2 x target
+    HIGH    in-flight >= 2 x ADMISSION_MAX_IN_FLIGHT  or  latency > 4 x target
+
+with target = ADMISSION_LATENCY_TARGET_MS. Counters per priority are served
+by `/api/admin/load`.
+"""
+import logging
+import math
+import threading
+import time
+
+from flask import current_app, g, make_response, request
+
+log = logging.getLogger(__name__)
+
+CRITICAL, HIGH, NORMAL, LOW = 0, 1, 2, 3
+PRIORITY_NAMES = {CRITICAL: 'critical', HIGH: 'high', NORMAL: 'normal', LOW: 'low'}
+
+PRIORITIES = {
+    'insert_bottle': CRITICAL,
+    'insert_bottle_batch': CRITICAL,
+    'activate_session': CRITICAL,
+    'insertion_heartbeat': CRITICAL,
+    'update_status': CRITICAL,
+    'expire_session': CRITICAL,
+    'unlock_insertion': CRITICAL,
+    'captive_portal_detect': HIGH,
+    'admin_load': HIGH,
+    'admin_metrics': LOW,
+    'admin_ratings': LOW,
+    'portal.clear_device_id': LOW,
+    'portal.sensor_hit': LOW,
+    'portal.waiting': LOW,
+}
+# long-lived or not worth counting
+EXEMPT = frozenset({'admin_ws'})
+
+# priority -> (share of max in-flight, multiple of the latency target)
+_BUDGETS = {HIGH: (2.0, 4.0), NORMAL: (1.0, 2.0), LOW: (0.5, 1.0)}
+
+
+class AdmissionController:
+    def __init__(self, max_in_flight=16, latency_target_ms=500, half_life=5.0, alpha=0.2,
+                 clock=time.monotonic):
+        self.max_in_flight = max_in_flight
+        self.latency_target = latency_target_ms / 1000.0
+        self.half_life = half_life
+        self.alpha = alpha
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self._latency = 0.0
+        self._latency_at = clock()
+        self.admitted = dict.fromkeys(PRIORITY_NAMES, 0)
+        self.shed = dict.fromkeys(PRIORITY_NAMES, 0)
+        self._shedding = False
+
+    def _decayed_latency(self, now):
+        idle = now - self._latency_at
+        if idle <= 0:
+            return self._latency
+        return self._latency * 0.5 ** (idle / self.half_life)
+
+    def admit(self, priority):
+        """Count the request in and return True, or False if it should be shed."""
+        now = self._clock()
+        with self._lock:
+            budget = _BUDGETS.get(priority)
+            if budget is not None:
+                share, factor = budget
+                latency = self._decayed_latency(now)
+                if (self.in_flight >= self.max_in_flight * share
+                        or latency > self.latency_target * factor):
+                    self.shed[priority] += 1
+                    if not self._shedding:
+                        self._shedding = True
+                        log.warning('Overloaded (%d in flight, %.0f ms average): shedding %s requests',
+                                    self.in_flight, latency * 1000, PRIORITY_NAMES[priority])
+                    return False
+            self.in_flight += 1
+            self.admitted[priority] += 1
+            return True
+
+    def done(self, elapsed):
+        now = self._clock()
+        with self._lock:
+            self.in_flight -= 1
+            latency = self._decayed_latency(now)
+            self._latency = latency + self.alpha * (elapsed - latency)
+            self._latency_at = now
+            if self._shedding and self.in_flight < self.max_in_flight / 2 and self._latency <= self.latency_target:
+                self._shedding = False
+                log.info('Load back under target, admitting all requests')
+
+    def retry_after(self):
+        """Seconds a shed client should wait: roughly until the latency average has halved."""
+        return max(1, math.ceil(self.half_life))
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'in_flight': self.in_flight,
+                'latency_ms': round(self._decayed_latency(self._clock()) * 1000, 1),
+                'shedding': self._shedding,
+                'admitted': {PRIORITY_NAMES[p]: n for p, n in self.admitted.items()},
+                'shed': {PRIORITY_NAMES[p]: n for p, n in self.shed.items()},
+            }
+
+
+def priority_for(endpoint):
+    return PRIORITIES.get(endpoint, NORMAL)
+
+
+def _before_request():
+    controller = current_app.extensions.get('admission')
+    endpoint = request.endpoint
+    if controller is None or endpoint is None or endpoint in EXEMPT:
+        return None
+    if not controller.admit(priority_for(endpoint)):
+        resp = make_response({'error': 'Server busy, try again shortly'}, 503)
+        resp.headers['Retry-After'] = str(controller.retry_after())
+        return resp
+    g.admission_started = time.monotonic()
+    return None
+
+
+def _teardown_request(exc=None):
+    started = g.pop('admission_started', None)
+    controller = current_app.extensions.get('admission')
+    if started is not None and controller is not None:
+        controller.done(time.monotonic() - started)
+
+
+def init_app(app):
+    if not app.config.get('ADMISSION_ENABLED', True):
+        return None
+    controller = AdmissionController(
+        max_in_flight=app.config.get('ADMISSION_MAX_IN_FLIGHT', 16),
+        latency_target_ms=app.config.get('ADMISSION_LATENCY_TARGET_MS', 500),
+    )
+    app.extensions['admission'] = controller
+    # first before_request hook, so shed requests skip everything else
+    app.before_request_funcs.setdefault(None, []).insert(0, _before_request)
+    app.teardown_request(_teardown_request)
+    return controller
@@ -0,0 +1,384 @@
+"""Precompressed, fingerprinted static assets.
+
+`build()` copies `static/css`, `static/js`, `static/images` and `static/svg`
+into `static/dist/`:
+
+- CSS and JS are minified conservatively (comments and indentation only, so
+  the output stays valid without a JS toolchain on the Pi).
+- Every file gets a content hash in its name (`js/init.3f2a1b9c0d.js`), and
+  relative ES module imports are rewritten to the hashed names, so a changed
+  module changes the URL of everything that imports it.
+- Text files get `.gz` siblings, plus `.br` when the optional `brotli`
+  package is installed.
+- `manifest.json` maps source paths to built paths.
+
+`init_app` loads the manifest, exposes `asset_url('js/init.js')` to
+templates and replaces Flask's static view so `/static/dist/...` is served
+with the best precompressed variant the client accepts and a one-year
+`immutable` Cache-Control. Without a manifest (development, or
+`USE_BUILT_ASSETS=false`) `asset_url` returns the plain `/static/...` path.
+
+Production (`MOCK_SENSOR` off) gets one bundle per page script instead of
+the module graph: every module is wrapped in a function scope and imports
+become lookups in a `__modules` table, so the page loads its JS in one
+request. Dynamic `import()`s (the dev panel) are left out of the bundle.
+
+    python scripts/build_assets.py
+"""
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+
+from flask import request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:  # optional; gzip alone is still a large win
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+SOURCE_DIRS = ('css', 'js', 'images', 'svg')
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+HASH_LENGTH = 10
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt')
+# Entry modules that also get a single-file bundle (`js/init.bundle.<hash>.js`).
+# Templates keep calling asset_url('js/init.js'); the bundle is used when
+# MOCK_SENSOR is off.
+BUNDLE_ENTRIES = ('js/init.js', 'js/rating.js')
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+_IMPORT_RE = re.compile(r'''(\bfrom\s*|\bimport\s*\(?\s*)(['"])(\.{1,2}/[^'"]+)\2''')
+# bundler patterns; they run on minify_js output, so statements start at column 0
+_STATIC_IMPORT_RE = re.compile(
+    r'''^import\s*(\{[^}]*\}|\*\s*as\s+[\w$]+|[\w$]+)\s*from\s*(['"])(\.{1,2}/[^'"]+)\2\s*;?''', re.M)
+_DYNAMIC_IMPORT_RE = re.compile(r'''\bimport\(\s*(['"])(\.{1,2}/[^'"]+)\1\s*\)''')
+_EXPORT_DECL_RE = re.compile(r'^export\s+((?:async\s+)?function\*?|class|const)\s+([\w$]+)', re.M)
+_EXPORT_LIST_RE = re.compile(r'^export\s*\{([^}]*)\}\s*;?', re.M)
+_ALIAS_RE = re.compile(r'([\w$]+)\s+as\s+([\w$]+)')
+_CSS_STRING_RE = re.compile(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')''')
+
+
+# ----------------------------------------------------------------------------
+# Minifiers
+# ----------------------------------------------------------------------------
+
+def minify_css(text):
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    parts = _CSS_STRING_RE.split(text)
+    for i in range(0, len(parts), 2):  # even indexes are outside quotes
+        chunk = re.sub(r'\s+', ' ', parts[i])
+        chunk = re.sub(r'\s*([{};,>])\s*', r'\1', chunk)
+        chunk = re.sub(r':\s+', ':', chunk)  # never a selector: '.a :hover' keeps its space
+        parts[i] = chunk.replace(';}', '}')
+    return ''.join(parts).strip() + '\n'
+
+
+def minify_js(text):
+    """Drop whole-line comments, blank lines and indentation.
+
+    Line breaks are kept so automatic semicolon insertion behaves exactly as
+    in the source; trailing `//` comments are left alone because telling
+    them apart from `//` inside strings needs a real tokenizer.
+    """
+    out = []
+    in_block = False
+    for line in text.splitlines():
+        line = line.strip()
+        if in_block:
+            if '*/' in line:
+                in_block = False
+                line = line.split('*/', 1)[1].strip()
+            else:
+                continue
+        if line.startswith('/*'):
+            if '*/' not in line:
+                in_block = True
+                continue
+            line = line.split('*/', 1)[1].strip()
+        if not line or line.startswith('//'):
+            continue
+        out.append(line)
+    return '\n'.join(out) + '\n'
+
+
+# ----------------------------------------------------------------------------
+# Build
+# ----------------------------------------------------------------------------
+
+def _fingerprint(rel_path, data):
+    digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+    stem, ext = posixpath.splitext(rel_path)
+    return f'{stem}.{digest}{ext}'
+
+
+def _js_imports(rel_path, text):
+    base = posixpath.dirname(rel_path)
+    return [posixpath.normpath(posixpath.join(base, m.group(3))) for m in _IMPORT_RE.finditer(text)]
+
+
+def _rewrite_imports(rel_path, text, manifest):
+    base = posixpath.dirname(rel_path)
+
+    def repl(m):
+        target = posixpath.normpath(posixpath.join(base, m.group(3)))
+        built = manifest.get(target)
+        if built is None:
+            return m.group(0)
+        new = posixpath.relpath(built, base or '.')
+        if not new.startswith('.'):
+            new = './' + new
+        return f'{m.group(1)}{m.group(2)}{new}{m.group(2)}'
+
+    return _IMPORT_RE.sub(repl, text)
+
+
+def _static_imports(rel_path, text):
+    base = posixpath.dirname(rel_path)
+    return [posixpath.normpath(posixpath.join(base, m.group(3))) for m in _STATIC_IMPORT_RE.finditer(text)]
+
+
+def _dependency_order(roots, sources, deps):
+    """Paths reachable from roots, each after the modules it imports."""
+    order, state = [], {}
+
+    def visit(path, stack):
+        if state.get(path) == 'done':
+            return
+        if state.get(path) == 'visiting':
+            raise ValueError('Import cycle: ' + ' -> '.join(stack + [path]))
+        state[path] = 'visiting'
+        for dep in deps(path, sources[path]):
+            if dep in sources:
+                visit(dep, stack + [path])
+        state[path] = 'done'
+        order.append(path)
+
+    for path in roots:
+        visit(path, [])
+    return order
+
+
+def _js_build_order(sources):
+    """JS paths ordered so every module comes after the modules it imports."""
+    return _dependency_order(sorted(sources), sources, _js_imports)
+
+
+def _bundle_module(rel_path, text, bundle_dir, manifest):
+    """Rewrite one minified ES module into a function scope registered in __modules."""
+    base = posixpath.dirname(rel_path)
+
+    def static_import(m):
+        target = posixpath.normpath(posixpath.join(base, m.group(3)))
+        binding = m.group(1)
+        if binding.startswith('{'):
+            names = _ALIAS_RE.sub(r'\1: \2', binding)
+            return f'const {names} = __modules["{target}"];'
+        if binding.startswith('*'):
+            return f'const {binding.split()[-1]} = __modules["{target}"];'
+        return f'const {binding} = __modules["{target}"].default;'
+
+    def dynamic_import(m):
+        # lazily loaded modules stay separate files (e.g. the dev panel)
+        target = posixpath.normpath(posixpath.join(base, m.group(2)))
+        built = manifest.get(target, target)
+        return f"import('./{posixpath.relpath(built, bundle_dir)}')"
+
+    exports = {}
+
+    def export_decl(m):
+        exports[m.group(2)] = m.group(2)
+        return m.group(1) + ' ' + m.group(2)
+
+    def export_list(m):
+        for item in m.group(1).split(','):
+            item = item.strip()
+            if item:
+                alias = _ALIAS_RE.fullmatch(item)
+                local, name = (alias.group(1), alias.group(2)) if alias else (item, item)
+                exports[name] = local
+        return ''
+
+    text = _STATIC_IMPORT_RE.sub(static_import, text)
+    text = _DYNAMIC_IMPORT_RE.sub(dynamic_import, text)
+    text = _EXPORT_DECL_RE.sub(export_decl, text)
+    text = _EXPORT_LIST_RE.sub(export_list, text)
+    leftover = re.search(r'^(?:import(?!\s*\()|export)\b.*', text, re.M)
+    if leftover:
+        # default exports, exported let/var (live bindings) and side-effect imports
+        raise ValueError(f'{rel_path}: cannot bundle {leftover.group(0)!r}')
+    members = ', '.join(f'{name}: {local}' for name, local in sorted(exports.items()))
+    members = f'{{ {members} }}' if members else '{}'
+    return f'__modules["{rel_path}"] = (() => {{\n{text}return {members};\n}})();\n'
+
+
+def bundle(entry, sources, manifest):
+    """One script for entry and everything it imports statically.
+
+    sources maps JS paths to minified source. Returns (bundled text, module paths).
+    """
+    modules = _dependency_order([entry], sources, _static_imports)
+    bundle_dir = posixpath.dirname(entry)
+    parts = ['const __modules = {};\n']
+    parts += [_bundle_module(path, sources[path], bundle_dir, manifest) for path in modules]
+    return ''.join(parts), modules
+
+
+def _write(out_dir, rel_path, data):
+    dest = os.path.join(out_dir, *rel_path.split('/'))
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    with open(dest, 'wb') as f:
+        f.write(data)
+    sizes = {'raw': len(data)}
+    if rel_path.endswith(COMPRESSIBLE):
+        gz = gzip.compress(data, compresslevel=9, mtime=0)
+        if len(gz) < len(data):
+            with open(dest + '.gz', 'wb') as f:
+                f.write(gz)
+            sizes['gzip'] = len(gz)
+        if brotli is not None:
+            br = brotli.compress(data, quality=11)
+            if len(br) < len(data):
+                with open(dest + '.br', 'wb') as f:
+                    f.write(br)
+                sizes['br'] = len(br)
+    return sizes
+
+
+def build(static_dir, out_dir=None, logger=None):
+    """Build static/dist from the source folders; returns the manifest dict."""
+    logger = logger or log
+    out_dir = out_dir or os.path.join(static_dir, DIST_DIR)
+    if os.path.isdir(out_dir):
+        shutil.rmtree(out_dir)
+
+    files = []
+    for top in SOURCE_DIRS:
+        for root, _, names in os.walk(os.path.join(static_dir, top)):
+            for name in names:
+                full = os.path.join(root, name)
+                files.append(os.path.relpath(full, static_dir).replace(os.sep, '/'))
+
+    manifest = {}
+    js_sources = {}
+    totals = {'raw': 0, 'gzip': 0}
+    for rel_path in sorted(files):
+        with open(os.path.join(static_dir, *rel_path.split('/')), 'rb') as f:
+            data = f.read()
+        if rel_path.endswith('.js'):
+            js_sources[rel_path] = data.decode('utf-8')
+            continue
+        if rel_path.endswith('.css'):
+            data = minify_css(data.decode('utf-8')).encode('utf-8')
+        built = _fingerprint(rel_path, data)
+        sizes = _write(out_dir, built, data)
+        manifest[rel_path] = built
+        totals['raw'] += sizes['raw']
+        totals['gzip'] += sizes.get('gzip', sizes['raw'])
+
+    # dependencies first, so importers hash over their dependencies' new names
+    js_sources = {path: minify_js(text) for path, text in js_sources.items()}
+    module_gzip = {}
+    for rel_path in _js_build_order(js_sources):
+        data = _rewrite_imports(rel_path, js_sources[rel_path], manifest).encode('utf-8')
+        built = _fingerprint(rel_path, data)
+        sizes = _write(out_dir, built, data)
+        manifest[rel_path] = built
+        module_gzip[rel_path] = sizes.get('gzip', sizes['raw'])
+        totals['raw'] += sizes['raw']
+        totals['gzip'] += sizes.get('gzip', sizes['raw'])
+
+    for entry in BUNDLE_ENTRIES:
+        if entry not in js_sources:
+            continue
+        text, modules = bundle(entry, js_sources, manifest)
+        data = text.encode('utf-8')
+        stem, ext = posixpath.splitext(entry)
+        key = f'{stem}.bundle{ext}'
+        built = _fingerprint(key, data)
+        sizes = _write(out_dir, built, data)
+        manifest[key] = built
+        logger.info('%s: %d modules, %d bytes gzipped in %d requests -> bundle %d bytes gzipped in 1',
+                    entry, len(modules), sum(module_gzip[m] for m in modules), len(modules),
+                    sizes.get('gzip', sizes['raw']))
+
+    with open(os.path.join(out_dir, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    logger.info('Built %d assets into %s (%d bytes minified, %d gzipped)',
+                len(manifest), out_dir, totals['raw'], totals['gzip'])
+    return manifest
+
+
+def load_manifest(static_dir):
+    path = os.path.join(static_dir, DIST_DIR, MANIFEST_NAME)
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        log.warning('Ignoring unreadable asset manifest %s', path)
+        return None
+
+
+# ----------------------------------------------------------------------------
+# Flask integration
+# ----------------------------------------------------------------------------
+
+def _accepts(encoding):
+    return request.accept_encodings[encoding] > 0
+
+
+def _serve_dist(dist_dir, filename):
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if _accepts(encoding) and os.path.isfile(os.path.join(dist_dir, filename + suffix)):
+            resp = send_from_directory(dist_dir, filename + suffix, mimetype=mimetype,
+                                       max_age=IMMUTABLE_MAX_AGE)
+            resp.headers['Content-Encoding'] = encoding
+            break
+    else:
+        resp = send_from_directory(dist_dir, filename, mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE)
+    resp.headers['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    resp.vary.add('Accept-Encoding')
+    return resp
+
+
+def init_app(app):
+    manifest = None
+    if app.config.get('USE_BUILT_ASSETS', True):
+        manifest = load_manifest(app.static_folder)
+    app.extensions['assets'] = manifest
+
+    bundled = not app.config.get('MOCK_SENSOR', True)
+
+    def asset_url(path):
+        built = None
+        if manifest and bundled:
+            stem, ext = posixpath.splitext(path)
+            built = manifest.get(f'{stem}.bundle{ext}')
+        if built is None and manifest:
+            built = manifest.get(path)
+        if built is None:
+            return url_for('static', filename=path)
+        return url_for('static', filename=f'{DIST_DIR}/{built}')
+
+    app.jinja_env.globals['asset_url'] = asset_url
+
+    dist_dir = os.path.join(app.static_folder, DIST_DIR)
+    plain_static = app.view_functions['static']
+
+    def static(filename):
+        if filename.startswith(DIST_DIR + '/'):
+            return _serve_dist(dist_dir, filename[len(DIST_DIR) + 1:])
+        return plain_static(filename=filename)
+
+    app.view_functions['static'] = static
+    return manifest
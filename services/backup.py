@@ -0,0 +1,195 @@
+"""Online backups of the portal database.
+
+Uses SQLite's online backup API, copying `BACKUP_STEP_PAGES` pages per step
+and sleeping `BACKUP_STEP_PAUSE` seconds between steps, so request handlers
+keep getting the database while a snapshot is taken. Snapshots are checked
+with `PRAGMA quick_check`, gzip-compressed into `BACKUP_DIR` and rotated to
+the newest `BACKUP_KEEP` files.
+
+A write from another connection restarts a stepped backup. After
+`MAX_RESTARTS` restarts the copy is redone in a single step, which holds the
+read lock until it is done but always finishes.
+
+A background thread takes a snapshot once the newest one is older than
+`BACKUP_INTERVAL` seconds (0 disables it), so a Pi that reboots more often
+than that still gets its backups. `scripts/backup_db.py` takes or restores
+snapshots by hand.
+"""
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import db
+
+SNAPSHOT_SUFFIX = '.db.gz'
+MAX_RESTARTS = 5
+# don't compete with startup (migrations, lease rebuild) for the first snapshot
+FIRST_RUN_DELAY = 60
+
+
+class BackupError(Exception):
+    pass
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def _snapshot_prefix(db_path):
+    return os.path.splitext(os.path.basename(db_path))[0] + '-'
+
+
+def list_snapshots(dest_dir, db_path):
+    """Snapshot paths for db_path in dest_dir, newest first."""
+    if not os.path.isdir(dest_dir):
+        return []
+    prefix = _snapshot_prefix(db_path)
+    names = [n for n in os.listdir(dest_dir) if n.startswith(prefix) and n.endswith(SNAPSHOT_SUFFIX)]
+    # timestamped names sort chronologically
+    return [os.path.join(dest_dir, n) for n in sorted(names, reverse=True)]
+
+
+def _copy_online(src_path, dest_path, step_pages, pause, max_restarts=MAX_RESTARTS):
+    src = db.connect_autocommit(src_path)
+    dest = sqlite3.connect(dest_path)
+    try:
+        restarts = 0
+        last_remaining = None
+
+        def _progress(status, remaining, total):
+            nonlocal restarts, last_remaining
+            # no progress since the last step: a writer restarted the copy
+            if last_remaining is not None and remaining >= last_remaining:
+                restarts += 1
+                if restarts > max_restarts:
+                    raise _TooManyRestarts
+            last_remaining = remaining
+            # yield between steps so portal writers aren't starved
+            if remaining and pause:
+                time.sleep(pause)
+
+        try:
+            src.backup(dest, pages=int(step_pages), progress=_progress)
+        except _TooManyRestarts:
+            src.backup(dest, pages=-1)
+        result = dest.execute('PRAGMA quick_check').fetchone()[0]
+        if result != 'ok':
+            raise BackupError(f'quick_check failed on snapshot: {result}')
+    finally:
+        dest.close()
+        src.close()
+
+
+def create_snapshot(db_path, dest_dir, keep=7, step_pages=256, pause=0.01, logger=None):
+    """Take a compressed snapshot of db_path; returns the snapshot path."""
+    started = time.perf_counter()
+    os.makedirs(dest_dir, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')
+    final_path = os.path.join(dest_dir, f'{_snapshot_prefix(db_path)}{stamp}{SNAPSHOT_SUFFIX}')
+
+    fd, raw_path = tempfile.mkstemp(suffix='.db', dir=dest_dir)
+    os.close(fd)
+    tmp_gz = final_path + '.tmp'
+    try:
+        _copy_online(db_path, raw_path, step_pages, pause)
+        with open(raw_path, 'rb') as src, gzip.open(tmp_gz, 'wb', compresslevel=6) as out:
+            shutil.copyfileobj(src, out, 1024 * 1024)
+        os.replace(tmp_gz, final_path)
+    finally:
+        for path in (raw_path, tmp_gz):
+            if os.path.exists(path):
+                os.remove(path)
+
+    removed = []
+    for old in list_snapshots(dest_dir, db_path)[max(1, int(keep)):]:
+        os.remove(old)
+        removed.append(old)
+
+    if logger:
+        logger.info(
+            "Backup written to %s (%d bytes) in %.2fs, rotated %d old snapshots",
+            final_path, os.path.getsize(final_path), time.perf_counter() - started, len(removed),
+        )
+    return final_path
+
+
+def restore_snapshot(snapshot_path, db_path, step_pages=1024, logger=None):
+    """
+    Restore a snapshot into db_path through the backup API, so any open
+    connections see the restored content. Stop the portal first to avoid
+    losing writes made during the restore.
+    """
+    if not os.path.exists(snapshot_path):
+        raise BackupError(f'snapshot not found: {snapshot_path}')
+    fd, raw_path = tempfile.mkstemp(suffix='.db', dir=os.path.dirname(os.path.abspath(db_path)))
+    os.close(fd)
+    try:
+        opener = gzip.open if snapshot_path.endswith('.gz') else open
+        with opener(snapshot_path, 'rb') as src, open(raw_path, 'wb') as out:
+            shutil.copyfileobj(src, out, 1024 * 1024)
+        src = sqlite3.connect(raw_path)
+        try:
+            result = src.execute('PRAGMA quick_check').fetchone()[0]
+            if result != 'ok':
+                raise BackupError(f'snapshot failed quick_check: {result}')
+            dest = db.connect_autocommit(db_path)
+            try:
+                src.backup(dest, pages=int(step_pages))
+            finally:
+                dest.close()
+        finally:
+            src.close()
+    finally:
+        os.remove(raw_path)
+    if logger:
+        logger.info("Restored %s into %s", snapshot_path, db_path)
+    return db_path
+
+
+def _config(app):
+    return {
+        'dest_dir': app.config.get('BACKUP_DIR') or os.path.join(app.instance_path, 'backups'),
+        'keep': app.config.get('BACKUP_KEEP', 7),
+        'step_pages': app.config.get('BACKUP_STEP_PAGES', 256),
+        'pause': app.config.get('BACKUP_STEP_PAUSE', 0.01),
+    }
+
+
+def seconds_until_due(dest_dir, db_path, interval, now=None):
+    """Seconds until the newest snapshot is `interval` old (0 when overdue or none exists)."""
+    snapshots = list_snapshots(dest_dir, db_path)
+    if not snapshots:
+        return 0
+    now = time.time() if now is None else now
+    return max(0, os.path.getmtime(snapshots[0]) + interval - now)
+
+
+def init_app(app):
+    """Start the periodic backup thread unless BACKUP_INTERVAL is 0."""
+    interval = int(app.config.get('BACKUP_INTERVAL', 86400))
+    if interval <= 0:
+        return None
+
+    def _loop():
+        time.sleep(FIRST_RUN_DELAY)
+        while True:
+            config = _config(app)
+            db_path = db.get_db_path(app)
+            wait = seconds_until_due(config['dest_dir'], db_path, interval)
+            if wait:
+                time.sleep(wait)
+                continue
+            try:
+                create_snapshot(db_path, logger=app.logger, **config)
+            except Exception:
+                app.logger.exception("Database backup failed")
+                time.sleep(min(interval, 3600))
+
+    t = threading.Thread(target=_loop, daemon=True, name='backup')
+    t.start()
+    return t
@@ -0,0 +1,218 @@
+"""Cap on concurrently active sessions, with a line for activations beyond it.
+
+Every path that would start a paid session's clock asks the manager for a
+slot first: `/api/session/<id>/activate`, closing the insert modal
+(`/api/session/unlock`), `POST /api/session/<id>/status` with `active`, and
+the insertion lock reclaiming an abandoned lease. Under the cap, and with
+nobody queued ahead, the session starts as before. Otherwise the session goes
+back to `awaiting_insertion` (session_end stays NULL, so its earned time is
+not running) and joins a FIFO line. The activate route answers 202 with the
+position and an ETA, and the client repeats the call until it gets a slot.
+
+The line lives in the database: a parked session is an `awaiting_insertion`
+row with bottles and no session_start, which the cleanup sweep never expires.
+The in-memory queue only keeps the order. The cleanup loop calls `promote()`,
+which lines the queue up with those rows (picking up sessions parked
+elsewhere or before a restart) and starts the head of the line while slots
+are free, so a session whose client stopped asking still gets its time.
+
+The cap is `MAX_ACTIVE_SESSIONS` (0 = no fixed cap). With an uplink capacity
+(`CAPACITY_UPLINK_KBIT`, else `SHAPING_UPLINK_KBIT`) and `CAPACITY_AUTO`, it
+is also limited to
+
+    CAPACITY_HEADROOM x uplink / max(per-session kbit/s, CAPACITY_SESSION_KBIT_MIN)
+
+The per-session rate is a moving average over the usage collector's passes:
+bytes moved / clients that moved any / interval. So a crowd of light users
+gets more slots than a few heavy ones.
+
+The ETA simulates the line. Each queued session ahead takes the slot that
+frees up first and holds it for its earned time.
+"""
+import heapq
+import math
+import threading
+import time
+from collections import OrderedDict
+
+import db
+
+# how often a queued client is told to ask again, at most
+MAX_RETRY_AFTER = 10
+
+
+class CapacityManager:
+    def __init__(self, max_active=0, uplink_kbit=None, auto=True, session_kbit_min=256,
+                 headroom=0.9, alpha=0.3, usage=lambda: None, clock=time.time):
+        self.max_active = max_active
+        self.uplink_kbit = uplink_kbit
+        self.auto = auto and bool(uplink_kbit)
+        self.session_kbit_min = session_kbit_min
+        self.headroom = headroom
+        self.alpha = alpha
+        # callable giving the usage collector, or None until it has started
+        self.usage = usage
+        self._clock = clock
+        # held across admit() and starting the session, so two activations
+        # can't both take the last slot
+        self.lock = threading.RLock()
+        self._queue = OrderedDict()  # session_id -> seconds_earned, in line order
+        self._session_kbit = None
+        self._measured_at = None
+        self.admitted = 0
+        self.queued = 0
+        self.promoted = 0
+
+    def _measure(self):
+        """Fold the usage collector's latest pass into the per-session average."""
+        usage = self.usage()
+        last = usage.last if usage is not None else None
+        if not last or last['at'] == self._measured_at:
+            return
+        self._measured_at = last['at']
+        if not last['changed']:
+            return
+        kbit = last['bytes'] * 8 / 1000.0 / usage.interval / last['changed']
+        if self._session_kbit is None:
+            self._session_kbit = kbit
+        else:
+            self._session_kbit += self.alpha * (kbit - self._session_kbit)
+
+    def cap(self):
+        """Current cap on active sessions, or None for unlimited."""
+        cap = self.max_active or None
+        if self.auto:
+            self._measure()
+            per_session = max(self._session_kbit or 0, self.session_kbit_min)
+            auto_cap = max(1, int(self.uplink_kbit * self.headroom // per_session))
+            cap = auto_cap if cap is None else min(cap, auto_cap)
+        return cap
+
+    def _sync(self, rows):
+        """
+        Line up with the parked sessions in the database (rows from
+        db.get_unstarted_paid_sessions): ones parked elsewhere join at the
+        back, ones that started or expired are forgotten. A queued session
+        back in the insert modal keeps its place. Returns {session_id: status}.
+        """
+        statuses = {}
+        for session_id, status, seconds_earned in rows:
+            statuses[session_id] = status
+            if session_id in self._queue:
+                self._queue[session_id] = seconds_earned
+            elif status == db.STATUS_AWAITING_INSERTION:
+                self._queue[session_id] = seconds_earned
+                self.queued += 1
+        for session_id in [sid for sid in self._queue if sid not in statuses]:
+            del self._queue[session_id]
+        return statuses
+
+    def admit(self, session_id, seconds_earned, active_ends):
+        """
+        Decide whether session_id may start now. active_ends is
+        db.get_active_session_ends(). Returns None when it may (and forgets
+        its queue entry), else {'position', 'eta_seconds', 'cap', 'active'}
+        after queueing it. Call with the lock held until the session is
+        started or parked.
+        """
+        now = self._clock()
+        with self.lock:
+            self._sync(db.get_unstarted_paid_sessions())
+            cap = self.cap()
+            free = None if cap is None else cap - len(active_ends)
+            ids = list(self._queue)
+            index = ids.index(session_id) if session_id in self._queue else len(ids)
+            if free is None or index < free:
+                self._queue.pop(session_id, None)
+                self.admitted += 1
+                return None
+            if session_id not in self._queue:
+                self.queued += 1
+            self._queue[session_id] = seconds_earned
+            return {
+                'position': index + 1,
+                'eta_seconds': self._eta([self._queue[sid] for sid in ids[:index]], active_ends, cap, now),
+                'cap': cap,
+                'active': len(active_ends),
+            }
+
+    def promote(self):
+        """
+        Start parked sessions from the head of the line while slots are free.
+        Runs in the cleanup loop (app context). Returns the started session ids.
+        """
+        started = []
+        with self.lock:
+            statuses = self._sync(db.get_unstarted_paid_sessions())
+            cap = self.cap()
+            free = None if cap is None else cap - len(db.get_active_session_ends())
+            for session_id in list(self._queue):
+                if free is not None and free <= 0:
+                    break
+                if statuses.get(session_id) != db.STATUS_AWAITING_INSERTION:
+                    continue  # adding bottles right now; starts once it is parked again
+                del self._queue[session_id]
+                if db.start_session(session_id, only_status=db.STATUS_AWAITING_INSERTION):
+                    started.append(session_id)
+                    if free is not None:
+                        free -= 1
+            self.promoted += len(started)
+        return started
+
+    @staticmethod
+    def _eta(ahead, active_ends, cap, now):
+        """Seconds until a slot frees for the session behind `ahead` (earned seconds, in line order)."""
+        ends = [e for e in active_ends if e is not None]
+        slots = cap - (len(active_ends) - len(ends))  # open-ended sessions never give theirs back
+        if slots <= 0:
+            return None
+        heapq.heapify(ends)
+        while len(ends) > slots:
+            heapq.heappop(ends)  # over the cap: the first ones to end free no slot
+        ends.extend([int(now)] * (slots - len(ends)))
+        heapq.heapify(ends)
+        for seconds in ahead:
+            heapq.heappush(ends, max(heapq.heappop(ends), int(now)) + seconds)
+        return max(0, math.ceil(ends[0] - now))
+
+    def retry_after(self, eta_seconds):
+        if eta_seconds is None:
+            return MAX_RETRY_AFTER
+        return max(1, min(MAX_RETRY_AFTER, eta_seconds))
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'cap': self.cap(),
+                'max_active': self.max_active or None,
+                'auto': self.auto,
+                'uplink_kbit': self.uplink_kbit,
+                'session_kbit': round(self._session_kbit, 1) if self._session_kbit is not None else None,
+                'queue': len(self._queue),
+                'admitted': self.admitted,
+                'queued': self.queued,
+                'promoted': self.promoted,
+            }
+
+
+def init_app(app):
+    """Install the manager when there is a fixed cap or an uplink to tune against."""
+    max_active = int(app.config.get('MAX_ACTIVE_SESSIONS', 0))
+    uplink = app.config.get('CAPACITY_UPLINK_KBIT') or app.config.get('SHAPING_UPLINK_KBIT')
+    auto = app.config.get('CAPACITY_AUTO', True)
+    if max_active <= 0 and not (auto and uplink):
+        return None
+    manager = CapacityManager(
+        max_active=max_active,
+        uplink_kbit=uplink,
+        auto=auto,
+        session_kbit_min=app.config.get('CAPACITY_SESSION_KBIT_MIN', 256),
+        headroom=app.config.get('CAPACITY_HEADROOM', 0.9),
+        usage=lambda: app.extensions.get('usage'),
+    )
+    lock = app.extensions.get('insertion_lock')
+    if lock is not None:
+        # an abandoned lease must not start a fresh session past the cap
+        lock.park_unstarted = True
+    app.extensions['capacity'] = manager
+    return manager
@@ -0,0 +1,128 @@
+"""Conditional GET support (ETag / Last-Modified / 304) for polled JSON APIs.
+
+Phones poll `/api/session/<id>`, `/api/session/<id>/status` and
+`/api/rating/status`, and the admin dashboard polls `/api/admin/metrics`.
+Most of those polls return exactly what the client already has.
+
+`VersionTracker` keeps in-memory version counters: one per session and one
+global counter bumped on any write. It learns about writes through
+`db.on_change`. The `conditional` decorator builds the ETag from those
+counters and answers `If-None-Match` / `If-Modified-Since` with 304 before
+the view runs, so SQLite is not touched at all. Counters start from a
+per-process boot token, so a restart invalidates every ETag handed out
+before it.
+
+Writes made by other processes (scripts, a backup restore) are not seen;
+restart the portal after changing the database by hand.
+"""
+import threading
+import time
+import zlib
+from datetime import datetime, timezone, timedelta
+from functools import wraps
+
+from flask import current_app, make_response, request
+
+import db
+
+PH_TZ = timezone(timedelta(hours=8))
+MAX_TRACKED_SESSIONS = 10000
+
+
+class VersionTracker:
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        now = int(clock())
+        self.boot = format(now, 'x')
+        self._lock = threading.Lock()
+        self._sessions = {}  # session id -> (version, changed_at)
+        self._epoch = 0  # bumped by bulk session updates; resets per-session counters
+        self._epoch_at = now
+        self._global = 0
+        self._global_at = now
+
+    def bump(self, kind, session_id=None):
+        """db.on_change listener."""
+        now = int(self._clock())
+        with self._lock:
+            self._global += 1
+            self._global_at = now
+            if kind == 'sessions' or (kind == 'session' and len(self._sessions) >= MAX_TRACKED_SESSIONS):
+                self._epoch += 1
+                self._epoch_at = now
+                self._sessions.clear()
+            elif kind == 'session' and session_id is not None:
+                version, _ = self._sessions.get(session_id, (0, 0))
+                self._sessions[session_id] = (version + 1, now)
+
+    def session_validators(self, session_id):
+        with self._lock:
+            version, changed_at = self._sessions.get(session_id, (0, self._epoch_at))
+            return f'{self.boot}-{self._epoch}-{session_id}-{version}', max(changed_at, self._epoch_at)
+
+    def global_validators(self, extra=''):
+        with self._lock:
+            return f'{self.boot}-g{self._global}{extra}', self._global_at
+
+
+def _not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified:
+        return last_modified <= int(request.if_modified_since.timestamp())
+    return False
+
+
+def _apply_headers(resp, etag, last_modified, cache_control, vary):
+    resp.set_etag(etag, weak=True)
+    resp.last_modified = datetime.fromtimestamp(last_modified, timezone.utc)
+    resp.headers['Cache-Control'] = cache_control
+    if vary:
+        resp.vary.add(vary)
+    return resp
+
+
+def conditional(validators, cache_control='private, no-cache', vary=None):
+    """
+    Route decorator. `validators(tracker, **view_kwargs)` returns
+    (etag, last_modified_ts); a matching request gets 304 without running
+    the view. Only 200 responses get validators attached.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(*args, **kwargs):
+            tracker = current_app.extensions.get('http_cache')
+            if tracker is None or request.method != 'GET':
+                return view_func(*args, **kwargs)
+            etag, last_modified = validators(tracker, **kwargs)
+            if _not_modified(etag, last_modified):
+                return _apply_headers(make_response('', 304), etag, last_modified, cache_control, vary)
+            resp = make_response(view_func(*args, **kwargs))
+            if resp.status_code == 200:
+                _apply_headers(resp, etag, last_modified, cache_control, vary)
+            return resp
+        return wrapper
+    return decorator
+
+
+def session_validators(tracker, session_id, **_):
+    return tracker.session_validators(session_id)
+
+
+def device_validators(tracker, **_):
+    # depends on which session the device cookie maps to; any write may change it
+    device = request.cookies.get('device_id') or request.remote_addr or ''
+    return tracker.global_validators('-' + format(zlib.crc32(device.encode()), 'x'))
+
+
+def metrics_validators(tracker, **_):
+    # "bottles today" rolls over at PH midnight even without writes
+    day = datetime.now(PH_TZ).strftime('%Y%m%d')
+    return tracker.global_validators('-' + day)
+
+
+def init_app(app):
+    tracker = VersionTracker()
+    db.on_change(tracker.bump)
+    app.extensions['http_cache'] = tracker
+    return tracker
@@ -0,0 +1,211 @@
+"""Idempotency keys for mutating endpoints.
+
+A client that sends an `Idempotency-Key` header gets exactly-once handling
+for that request: the first response is stored (status, content type and
+body) and any retry with the same key is answered with the stored response
+instead of running the view again. This makes it safe for the portal JS to
+retry `/api/bottle`, `/api/session/<id>/activate` and `/api/rating`
+aggressively on the captive Wi-Fi link.
+
+Responses live in the `idempotency_keys` table (migration 7) for
+`IDEMPOTENCY_TTL` seconds, with an in-memory LRU of `IDEMPOTENCY_CACHE_SIZE`
+entries in front so hot retries don't touch SQLite. Expired rows are deleted
+by the retention job. Only final 2xx responses are stored. A retry after
+an error (4xx/5xx, e.g. 409 busy) or a 202 "queued" answer runs the view
+again, so it sees the machine or the capacity line as they are now.
+
+A key reused with a different method, path or body is rejected with 422;
+a retry that arrives while the first request is still running gets 409.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, make_response, request
+
+import db
+import migrations
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 128
+
+
+class _Stored:
+    __slots__ = ('fingerprint', 'status', 'content_type', 'body', 'expires_at')
+
+    def __init__(self, fingerprint, status, content_type, body, expires_at):
+        self.fingerprint = fingerprint
+        self.status = status
+        self.content_type = content_type
+        self.body = body
+        self.expires_at = expires_at
+
+
+class IdempotencyStore:
+    def __init__(self, db_path, ttl=86400, cache_size=1024, clock=time.time):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()  # (scope, key) -> _Stored, LRU order
+        self._in_flight = set()
+        self.hits = 0
+        self.misses = 0
+
+    def _cache_put(self, ck, stored):
+        self._cache[ck] = stored
+        self._cache.move_to_end(ck)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def lookup(self, scope, key):
+        """Stored response for (scope, key), or None. Consults the LRU, then SQLite."""
+        ck = (scope, key)
+        now = self._clock()
+        with self._lock:
+            stored = self._cache.get(ck)
+            if stored is not None:
+                if stored.expires_at > now:
+                    self._cache.move_to_end(ck)
+                    self.hits += 1
+                    return stored
+                del self._cache[ck]
+
+        conn = db.get_db()
+        if not migrations.is_applied(conn, migrations.IDEMPOTENCY_VERSION, self.db_path):
+            return None
+        row = conn.execute(
+            'SELECT fingerprint, status, content_type, body, created_at FROM idempotency_keys '
+            'WHERE scope = ? AND key = ?',
+            (scope, key),
+        ).fetchone()
+        if row is None or row[4] + self.ttl <= now:
+            with self._lock:
+                self.misses += 1
+            return None
+        stored = _Stored(row[0], row[1], row[2], row[3], row[4] + self.ttl)
+        with self._lock:
+            self.hits += 1
+            self._cache_put(ck, stored)
+        return stored
+
+    def save(self, scope, key, fingerprint, status, content_type, body):
+        now = int(self._clock())
+        stored = _Stored(fingerprint, status, content_type, body, now + self.ttl)
+        with self._lock:
+            self._cache_put((scope, key), stored)
+        conn = db.get_db()
+        if not migrations.is_applied(conn, migrations.IDEMPOTENCY_VERSION, self.db_path):
+            return
+        conn.execute(
+            'INSERT OR REPLACE INTO idempotency_keys '
+            '(scope, key, fingerprint, status, content_type, body, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (scope, key, fingerprint, status, content_type, body, now),
+        )
+        conn.commit()
+
+    def begin(self, scope, key):
+        """Mark (scope, key) as running. False if another request already holds it."""
+        with self._lock:
+            if (scope, key) in self._in_flight:
+                return False
+            self._in_flight.add((scope, key))
+            return True
+
+    def end(self, scope, key):
+        with self._lock:
+            self._in_flight.discard((scope, key))
+
+    def snapshot(self):
+        with self._lock:
+            return {'cached': len(self._cache), 'hits': self.hits, 'misses': self.misses}
+
+
+def purge_expired(conn, ttl, now=None):
+    """Delete stored responses older than ttl seconds; returns rows removed."""
+    now = int(now if now is not None else time.time())
+    cur = conn.execute('DELETE FROM idempotency_keys WHERE created_at < ?', (now - int(ttl),))
+    return cur.rowcount
+
+
+def _fingerprint():
+    h = hashlib.sha256()
+    h.update(request.method.encode())
+    h.update(b'\0')
+    h.update(request.path.encode())
+    h.update(b'\0')
+    h.update(request.get_data(cache=True))
+    return h.hexdigest()
+
+
+def _replay(stored):
+    resp = make_response(stored.body, stored.status)
+    resp.headers['Content-Type'] = stored.content_type or 'application/json'
+    resp.headers['Idempotent-Replayed'] = 'true'
+    return resp
+
+
+def _error(message, status):
+    resp = make_response({'error': message}, status)
+    if status == 409:
+        resp.headers['Retry-After'] = '1'
+    return resp
+
+
+def _answer_stored(stored, fingerprint):
+    if stored.fingerprint != fingerprint:
+        return _error(f'{HEADER} was already used for a different request', 422)
+    return _replay(stored)
+
+
+def _is_final(status):
+    """Only a 2xx outcome is stored; 202 (queued) and errors may change on retry."""
+    return 200 <= status < 300 and status != 202
+
+
+def idempotent(scope):
+    """Route decorator: honour the Idempotency-Key header for this endpoint."""
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get(HEADER)
+            store = current_app.extensions.get('idempotency')
+            if not key or store is None:
+                return view_func(*args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                return _error(f'{HEADER} must be at most {MAX_KEY_LENGTH} characters', 400)
+
+            fingerprint = _fingerprint()
+            stored = store.lookup(scope, key)
+            if stored is not None:
+                return _answer_stored(stored, fingerprint)
+
+            if not store.begin(scope, key):
+                return _error('A request with this key is still being processed', 409)
+            try:
+                # a request with this key may have finished between the lookup
+                # above and begin(); its response is stored before it ends
+                stored = store.lookup(scope, key)
+                if stored is not None:
+                    return _answer_stored(stored, fingerprint)
+                resp = make_response(view_func(*args, **kwargs))
+                if _is_final(resp.status_code) and not resp.is_streamed:
+                    store.save(scope, key, fingerprint, resp.status_code, resp.content_type, resp.get_data())
+                return resp
+            finally:
+                store.end(scope, key)
+        return wrapper
+    return decorator
+
+
+def init_app(app):
+    store = IdempotencyStore(
+        db.get_db_path(app),
+        ttl=app.config.get('IDEMPOTENCY_TTL', 86400),
+        cache_size=app.config.get('IDEMPOTENCY_CACHE_SIZE', 1024),
+    )
+    app.extensions['idempotency'] = store
+    return store
@@ -0,0 +1,389 @@
+"""In-memory lease for the machine-wide insertion lock.
+
+Only one session may be `inserting` at a time. Deciding that used to take a
+`BEGIN IMMEDIATE` transaction per attempt, which serialized every writer
+(bottle logs, ratings) behind phones retrying the Insert button. The lease
+now lives in this process: acquire, refresh and release are answered under
+a short mutex without touching SQLite.
+
+The `sessions` table stays the durable record. Status changes are written
+through by a single background thread in the order they happened, so the
+`idx_single_inserting` index still holds on disk. Code that writes a
+session's status itself must call `release(session_id, status)` first and
+`flush()` before its own write.
+
+A lease lasts `INSERTING_LOCK_TIMEOUT` seconds from its last refresh. Once
+the insert modal has sent a heartbeat (`POST /api/session/<id>/heartbeat`)
+the lease also ends `INSERTION_HEARTBEAT_GRACE` seconds after the last one,
+so a closed tab frees the machine within seconds instead of minutes. A
+sweep thread checks deadlines every `INSERTION_LOCK_SWEEP_INTERVAL` seconds.
+
+On startup the lease is rebuilt from the `inserting` row, if any, using
+that row's `updated_at`, which refreshes keep roughly current.
+"""
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+import db
+
+log = logging.getLogger(__name__)
+
+
+class _Lease:
+    __slots__ = ("session_id", "device", "acquired_at", "expires_at", "touched_at", "heartbeat_at")
+
+    def __init__(self, session_id, device, acquired_at, expires_at):
+        self.session_id = session_id
+        self.device = device
+        self.acquired_at = acquired_at
+        self.expires_at = expires_at
+        self.touched_at = acquired_at
+        self.heartbeat_at = None  # set by the first heartbeat; clients without one only get the TTL
+
+
+class InsertionLock:
+    def __init__(self, db_path, ttl=180, heartbeat_grace=15, sweep_interval=2, touch_interval=15,
+                 on_release=None, clock=time.time):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.heartbeat_grace = heartbeat_grace
+        self.sweep_interval = sweep_interval
+        self.touch_interval = touch_interval
+        self.on_release = on_release
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._lease = None
+        self._ops = queue.Queue()
+        self._writer = None
+        self.reclaimed = 0  # leases ended by a deadline rather than a release
+        # set by the capacity manager: a reclaimed session whose clock never
+        # started is parked in awaiting_insertion for it instead of going active
+        self.park_unstarted = False
+
+    def _deadline(self, lease):
+        if lease.heartbeat_at is None:
+            return lease.expires_at
+        return min(lease.expires_at, lease.heartbeat_at + self.heartbeat_grace)
+
+    # ------------------------------------------------------------------
+    # lease API (in memory, no SQLite access)
+    # ------------------------------------------------------------------
+
+    def acquire(self, device, resolve):
+        """
+        Take the lease for device. `resolve()` is only called when the lock is
+        free and must return the session id to mark as inserting (the device's
+        newest open session, or a new one). It may touch SQLite, so it runs
+        outside the mutex and the lease is checked again before it is
+        installed. Returns the session id, or None if another device holds an
+        unexpired lease.
+        """
+        now = self._clock()
+        expired = None
+        with self._lock:
+            held = self._check_held(device, now)
+            if held is not False:
+                return held
+            lease = self._lease
+            if lease is not None:
+                # abandoned by its owner: reclaim it for this caller
+                expired = lease
+                self._lease = None
+                self.reclaimed += 1
+                self._enqueue("reclaim", expired, None, now)
+        if expired is not None:
+            log.info("Insertion lock: reclaimed expired lease of session %s", expired.session_id)
+            self._released()
+
+        session_id = resolve()
+        if session_id is None:
+            return None
+        now = self._clock()
+        with self._lock:
+            # another caller may have taken the lock while we resolved
+            held = self._check_held(device, now)
+            if held is not False:
+                return held
+            if self._lease is not None:
+                return None
+            lease = _Lease(session_id, device, now, now + self.ttl)
+            self._lease = lease
+            self._enqueue("acquire", lease, db.STATUS_INSERTING, now)
+        return session_id
+
+    def _check_held(self, device, now):
+        """
+        Under self._lock: the session id if device already holds the lease
+        (extending it), None if another device holds an unexpired one, else
+        False (free or expired).
+        """
+        lease = self._lease
+        if lease is None:
+            return False
+        if lease.device == device:
+            lease.expires_at = now + self.ttl
+            lease.heartbeat_at = None  # the reopened modal starts beating again
+            return lease.session_id
+        if self._deadline(lease) > now:
+            return None
+        return False
+
+    def refresh(self, session_id):
+        """Extend the lease held by session_id. Returns False if it doesn't hold it."""
+        now = self._clock()
+        with self._lock:
+            lease = self._lease
+            if lease is None or lease.session_id != session_id:
+                return False
+            lease.expires_at = now + self.ttl
+            if lease.heartbeat_at is not None:
+                lease.heartbeat_at = now  # a bottle post is as good as a heartbeat
+            # keep updated_at roughly current for crash recovery, without a write per refresh
+            if now - lease.touched_at >= self.touch_interval:
+                lease.touched_at = now
+                self._enqueue("touch", lease, None, now)
+            return True
+
+    def heartbeat(self, session_id):
+        """
+        Record that the insert modal of session_id is still open. Returns the
+        seconds left before the lease would be reclaimed, or None if it isn't held.
+        """
+        now = self._clock()
+        with self._lock:
+            lease = self._lease
+            if lease is None or lease.session_id != session_id or self._deadline(lease) <= now:
+                return None
+            lease.heartbeat_at = now
+            return max(0, int(self._deadline(lease) - now))
+
+    def release(self, session_id, status):
+        """
+        Drop the lease held by session_id and write `status` through to the
+        session row. Returns False (and writes nothing) if it didn't hold it.
+        """
+        now = self._clock()
+        with self._lock:
+            lease = self._lease
+            if lease is None or lease.session_id != session_id:
+                return False
+            self._lease = None
+            self._enqueue("release", lease, status, now)
+        self._released()
+        return True
+
+    def expire_stale(self):
+        """Expire the lease if it ran past its deadline. Returns 1 if it did, else 0."""
+        now = self._clock()
+        with self._lock:
+            lease = self._lease
+            if lease is None or self._deadline(lease) > now:
+                return 0
+            self._lease = None
+            self.reclaimed += 1
+            self._enqueue("reclaim", lease, None, now)
+        missed = lease.heartbeat_at is not None and lease.heartbeat_at + self.heartbeat_grace <= lease.expires_at
+        log.info("Insertion lock: lease of session %s expired (%s)", lease.session_id,
+                 "missed heartbeats" if missed else "timeout")
+        self._released()
+        return 1
+
+    def holds(self, session_id):
+        lease = self._lease
+        return lease is not None and lease.session_id == session_id
+
+    def holder_session(self, device=None):
+        """Session id holding the lease (only if held by `device`, when given), else None."""
+        lease = self._lease
+        if lease is None or (device is not None and lease.device != device):
+            return None
+        return lease.session_id
+
+    def is_free(self):
+        lease = self._lease
+        return lease is None or self._deadline(lease) <= self._clock()
+
+    def snapshot(self):
+        now = self._clock()
+        with self._lock:
+            lease = self._lease
+            return {
+                "session_id": lease.session_id if lease else None,
+                "held_seconds": round(now - lease.acquired_at, 1) if lease else 0,
+                "expires_in": max(0, int(self._deadline(lease) - now)) if lease else 0,
+                "heartbeat": lease is not None and lease.heartbeat_at is not None,
+                "reclaimed": self.reclaimed,
+                "pending_writes": self._ops.qsize(),
+            }
+
+    def _released(self):
+        if self.on_release is not None:
+            try:
+                self.on_release()
+            except Exception:
+                log.exception("Insertion lock: on_release callback failed")
+
+    # ------------------------------------------------------------------
+    # write-through (single background writer, FIFO)
+    # ------------------------------------------------------------------
+
+    def _enqueue(self, kind, lease, status, ts):
+        self._ops.put((kind, lease, status, int(ts)))
+
+    def flush(self, timeout=5.0):
+        """Block until every write queued so far has reached SQLite."""
+        if self._writer is None:
+            self._drain()
+            return True
+        done = threading.Event()
+        self._ops.put(("barrier", done, None, None))
+        return done.wait(timeout)
+
+    def start(self):
+        self._writer = threading.Thread(target=self._write_loop, daemon=True, name="insertion-lock-writer")
+        self._writer.start()
+        if self.sweep_interval > 0:
+            threading.Thread(target=self._sweep_loop, daemon=True, name="insertion-lock-sweep").start()
+        return self._writer
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.expire_stale()
+            except Exception:
+                log.exception("Insertion lock: sweep failed")
+
+    def _write_loop(self):
+        conn = None
+        while True:
+            op = self._ops.get()
+            try:
+                if op[0] == "barrier":
+                    op[1].set()
+                    continue
+                if conn is None:
+                    conn = db.connect_autocommit(self.db_path)
+                self._apply(conn, *op)
+            except Exception:
+                log.exception("Insertion lock: write-through of %s failed", op[0])
+                if conn is not None:
+                    conn.close()
+                    conn = None
+
+    def _drain(self):
+        """Apply queued writes on the calling thread (used when no writer runs)."""
+        conn = db.connect_autocommit(self.db_path)
+        try:
+            while True:
+                try:
+                    op = self._ops.get_nowait()
+                except queue.Empty:
+                    return
+                if op[0] == "barrier":
+                    op[1].set()
+                else:
+                    self._apply(conn, *op)
+        finally:
+            conn.close()
+
+    def _apply(self, conn, kind, lease, status, ts):
+        if kind == "reclaim":
+            # like /api/session/unlock: credited bottles or a running timer
+            # keep the session, only an empty one goes back to waiting
+            if self.park_unstarted:
+                conn.execute(
+                    "UPDATE sessions SET status = CASE WHEN session_start IS NOT NULL THEN ? ELSE ? END, "
+                    "session_end = CASE WHEN session_start IS NOT NULL THEN session_end END, "
+                    "updated_at = ? WHERE id = ? AND status = ?",
+                    (db.STATUS_ACTIVE, db.STATUS_AWAITING_INSERTION, ts, lease.session_id, db.STATUS_INSERTING),
+                )
+            else:
+                conn.execute(
+                    "UPDATE sessions SET status = CASE WHEN bottles_inserted > 0 OR session_end > ? "
+                    "THEN ? ELSE ? END, updated_at = ? WHERE id = ? AND status = ?",
+                    (ts, db.STATUS_ACTIVE, db.STATUS_AWAITING_INSERTION, ts, lease.session_id, db.STATUS_INSERTING),
+                )
+            db.notify_change("session", lease.session_id)
+            return
+        if kind == "release":
+            conn.execute(
+                "UPDATE sessions SET status = ?, updated_at = ? WHERE id = ? AND status = ?",
+                (status, ts, lease.session_id, db.STATUS_INSERTING),
+            )
+            db.notify_change("session", lease.session_id)
+            return
+        if self._lease is not lease:
+            # superseded; the release that ended this lease is queued behind us
+            return
+        if kind == "touch":
+            conn.execute(
+                "UPDATE sessions SET updated_at = ? WHERE id = ? AND status = ?",
+                (ts, lease.session_id, db.STATUS_INSERTING),
+            )
+            return
+        try:
+            cur = conn.execute(
+                "UPDATE sessions SET status = ?, updated_at = ? WHERE id = ? AND status IN (?, ?, ?)",
+                (db.STATUS_INSERTING, ts, lease.session_id,
+                 db.STATUS_AWAITING_INSERTION, db.STATUS_ACTIVE, db.STATUS_INSERTING),
+            )
+            applied = cur.rowcount > 0
+            if applied:
+                db.notify_change("session", lease.session_id)
+        except sqlite3.IntegrityError:
+            # another row is 'inserting' on disk (written outside this lock)
+            applied = False
+        if not applied:
+            log.warning("Insertion lock: session %s could not be marked inserting; dropping lease",
+                        lease.session_id)
+            with self._lock:
+                dropped = self._lease is lease
+                if dropped:
+                    self._lease = None
+            if dropped:
+                self._released()
+
+    # ------------------------------------------------------------------
+    # crash recovery
+    # ------------------------------------------------------------------
+
+    def recover(self):
+        """Rebuild the lease from the `inserting` row left by the previous process."""
+        conn = db.connect_autocommit(self.db_path)
+        try:
+            row = conn.execute(
+                "SELECT id, mac_address, updated_at FROM sessions WHERE status = ? "
+                "ORDER BY updated_at DESC LIMIT 1",
+                (db.STATUS_INSERTING,),
+            ).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        session_id, device, updated_at = row
+        updated_at = updated_at or int(self._clock())
+        with self._lock:
+            lease = _Lease(session_id, device, updated_at, updated_at + self.ttl)
+            lease.touched_at = updated_at
+            self._lease = lease
+        log.info("Insertion lock: recovered lease of session %s", session_id)
+        return session_id
+
+
+def init_app(app):
+    queue_ext = app.extensions.get("insertion_queue")
+    lock = InsertionLock(
+        db.get_db_path(app),
+        ttl=app.config.get("INSERTING_LOCK_TIMEOUT", 180),
+        heartbeat_grace=app.config.get("INSERTION_HEARTBEAT_GRACE", 15),
+        sweep_interval=app.config.get("INSERTION_LOCK_SWEEP_INTERVAL", 2),
+        on_release=queue_ext.notify_released if queue_ext else None,
+    )
+    lock.recover()
+    lock.start()
+    app.extensions["insertion_lock"] = lock
+    return lock
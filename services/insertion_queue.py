@@ -0,0 +1,228 @@
+"""FIFO waiting line for the machine-wide insertion lock.
+
+When another device holds the lock, `/api/session/create` puts the caller in
+this queue instead of returning a bare 409, and the client polls
+`GET /api/session/queue` (a read-only call) until it is its turn. When the
+lock is released or expires the head of the line gets a reservation for
+`QUEUE_CLAIM_TIMEOUT` seconds; during that window only the reserved device
+may acquire the lock, so there is no retry storm of `BEGIN IMMEDIATE`
+attempts. Entries that stop polling for `QUEUE_ENTRY_TTL` seconds are
+dropped so abandoned phones don't hold up the line.
+
+State lives in memory behind a single short mutex and is written to a
+small JSON file (`QUEUE_STATE_PATH`) on every change, so a restart keeps
+everyone's place. This assumes one app process, which is how the Pi runs.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class _Entry:
+    __slots__ = ("device", "ip", "enqueued_at", "last_seen")
+
+    def __init__(self, device, ip, enqueued_at, last_seen):
+        self.device = device
+        self.ip = ip
+        self.enqueued_at = enqueued_at
+        self.last_seen = last_seen
+
+
+class InsertionQueue:
+    def __init__(self, claim_timeout=30, entry_ttl=30, default_hold=90, state_path=None, clock=time.time):
+        self.claim_timeout = claim_timeout
+        self.entry_ttl = entry_ttl
+        self.state_path = state_path
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # device -> _Entry, FIFO order
+        self._reserved = None  # (device, deadline)
+        self._holder = None  # device holding the lock
+        self._holder_since = None  # when the current lock holder acquired it
+        self._avg_hold = float(default_hold)  # moving average of lock hold time
+        self._load()
+
+    # ------------------------------------------------------------------
+    # persistence
+    # ------------------------------------------------------------------
+
+    def _load(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as fh:
+                state = json.load(fh)
+        except (OSError, ValueError):
+            logging.warning("InsertionQueue: ignoring unreadable state file %s", self.state_path)
+            return
+        now = self._clock()
+        for item in state.get("entries", []):
+            # give restored entries a fresh TTL so clients can reconnect
+            self._entries[item["device"]] = _Entry(item["device"], item.get("ip"), item["enqueued_at"], now)
+        self._avg_hold = float(state.get("avg_hold", self._avg_hold))
+
+    def _save(self):
+        if not self.state_path:
+            return
+        state = {
+            "entries": [{"device": e.device, "ip": e.ip, "enqueued_at": e.enqueued_at} for e in self._entries.values()],
+            "avg_hold": self._avg_hold,
+        }
+        tmp = self.state_path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as fh:
+                json.dump(state, fh)
+            os.replace(tmp, self.state_path)
+        except OSError:
+            logging.exception("InsertionQueue: failed to persist state")
+
+    # ------------------------------------------------------------------
+    # internal helpers (call with self._lock held)
+    # ------------------------------------------------------------------
+
+    def _evict_idle(self, now):
+        stale = [d for d, e in self._entries.items() if now - e.last_seen > self.entry_ttl]
+        for device in stale:
+            del self._entries[device]
+        if self._reserved and (self._reserved[1] < now or self._reserved[0] not in self._entries):
+            # reservation not claimed in time: pass it on
+            self._entries.pop(self._reserved[0], None)
+            self._reserved = None
+            self._reserve_head(now)
+            return True
+        return bool(stale)
+
+    def _reserve_head(self, now):
+        if self._reserved is None and self._entries:
+            head = next(iter(self._entries))
+            self._reserved = (head, now + self.claim_timeout)
+
+    def _status(self, device, now):
+        if device not in self._entries:
+            return {"queued": False, "position": 0, "your_turn": False, "eta_seconds": 0}
+        position = list(self._entries).index(device) + 1
+        your_turn = bool(self._reserved and self._reserved[0] == device)
+        if your_turn:
+            eta = 0
+        else:
+            remaining = 0.0
+            if self._reserved is None and self._holder_since is not None:
+                remaining = max(0.0, self._avg_hold - (now - self._holder_since))
+            ahead = position - 1
+            eta = int(remaining + ahead * self._avg_hold)
+        status = {
+            "queued": True,
+            "position": position,
+            "queue_length": len(self._entries),
+            "your_turn": your_turn,
+            "eta_seconds": eta,
+        }
+        if your_turn:
+            status["claim_seconds"] = max(0, int(self._reserved[1] - now))
+        return status
+
+    # ------------------------------------------------------------------
+    # public API
+    # ------------------------------------------------------------------
+
+    def may_acquire(self, device):
+        """True if device may try the DB lock now (nobody waiting, or it holds the reservation)."""
+        now = self._clock()
+        with self._lock:
+            changed = self._evict_idle(now)
+            if changed:
+                self._save()
+            if self._reserved is not None:
+                return self._reserved[0] == device
+            return not self._entries or next(iter(self._entries)) == device
+
+    def enqueue(self, device, ip=None):
+        """Add device to the end of the line (no-op if already waiting); returns its status."""
+        now = self._clock()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._entries.get(device)
+            if entry is None:
+                self._entries[device] = _Entry(device, ip, now, now)
+            else:
+                entry.last_seen = now
+            self._save()
+            return self._status(device, now)
+
+    def status(self, device, lock_free=None):
+        """
+        Poll from a waiting device; refreshes its TTL. `lock_free` is an optional
+        callable consulted when the head is waiting without a reservation, to catch
+        releases that bypassed notify_released (expiry, restart).
+        """
+        now = self._clock()
+        with self._lock:
+            changed = self._evict_idle(now)
+            entry = self._entries.get(device)
+            if entry is not None:
+                entry.last_seen = now
+                if self._reserved is None and next(iter(self._entries)) == device and lock_free is not None:
+                    if lock_free():
+                        self._holder = self._holder_since = None
+                        self._reserve_head(now)
+                        changed = True
+            if changed:
+                self._save()
+            return self._status(device, now)
+
+    def leave(self, device):
+        with self._lock:
+            if self._entries.pop(device, None) is None:
+                return False
+            if self._reserved and self._reserved[0] == device:
+                self._reserved = None
+                self._reserve_head(self._clock())
+            self._save()
+            return True
+
+    def notify_acquired(self, device):
+        """The device got the DB lock: it leaves the line and starts the hold timer."""
+        now = self._clock()
+        with self._lock:
+            self._entries.pop(device, None)
+            if self._reserved and self._reserved[0] == device:
+                self._reserved = None
+            # the holder calls create again on every modal open: keep its start time
+            if self._holder != device or self._holder_since is None:
+                self._holder = device
+                self._holder_since = now
+            self._save()
+
+    def notify_released(self):
+        """The lock was released or expired: reserve it for the head of the line."""
+        now = self._clock()
+        with self._lock:
+            if self._holder_since is not None:
+                held = now - self._holder_since
+                self._avg_hold = 0.8 * self._avg_hold + 0.2 * held
+                self._holder = self._holder_since = None
+            self._evict_idle(now)
+            self._reserve_head(now)
+            self._save()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "length": len(self._entries),
+                "reserved": self._reserved[0] if self._reserved else None,
+                "avg_hold_seconds": round(self._avg_hold, 1),
+            }
+
+
+def init_app(app):
+    queue = InsertionQueue(
+        claim_timeout=app.config.get("QUEUE_CLAIM_TIMEOUT", 30),
+        entry_ttl=app.config.get("QUEUE_ENTRY_TTL", 30),
+        default_hold=app.config.get("INSERTING_LOCK_TIMEOUT", 180) / 2,
+        state_path=app.config.get("QUEUE_STATE_PATH"),
+    )
+    app.extensions["insertion_queue"] = queue
+    return queue
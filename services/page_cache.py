@@ -0,0 +1,94 @@
+"""In-memory cache of rendered portal pages.
+
+The landing page (`/`), the rating form and the captive-portal redirect are
+the first bytes every phone downloads, and their HTML only changes when a
+template, the config or the asset manifest changes. `PageCache.render`
+renders a template once per (template, config, manifest) key and keeps the
+output as bytes. The pages carry no per-request values: the scripts find
+the device's session through `/api/session/lookup`.
+
+Nothing is cached while templates auto-reload (debug) or with
+`PAGE_CACHE=false`.
+"""
+import hashlib
+import json
+import threading
+
+from flask import current_app, make_response, render_template
+
+# config values the cached templates read
+CONFIG_KEYS = ('MOCK_SENSOR', 'USE_BUILT_ASSETS')
+
+
+def _manifest_version(app):
+    manifest = app.extensions.get('assets')
+    if not manifest:
+        return ''
+    return hashlib.sha1(json.dumps(manifest, sort_keys=True).encode()).hexdigest()[:12]
+
+
+class PageCache:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._pages = {}  # key -> rendered bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, app, template):
+        return (template, tuple(app.config.get(k) for k in CONFIG_KEYS), _manifest_version(app))
+
+    def html(self, template):
+        """The rendered template as bytes, from the cache when possible."""
+        app = current_app._get_current_object()
+        if not self.enabled or app.jinja_env.auto_reload:
+            return render_template(template).encode('utf-8')
+        key = self._key(app, template)
+        with self._lock:
+            cached = self._pages.get(key)
+            if cached is not None:
+                self.hits += 1
+                return cached
+        html = render_template(template).encode('utf-8')
+        with self._lock:
+            self.misses += 1
+            self._pages[key] = html
+        return html
+
+    def render(self, template):
+        """Response with the cached page."""
+        resp = make_response(self.html(template))
+        resp.mimetype = 'text/html'
+        return resp
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return {'pages': len(self._pages), 'hits': self.hits, 'misses': self.misses}
+
+
+_REDIRECT_HEAD = b'<html><body><script>window.location.href="/?session='
+_REDIRECT_TAIL = b'";</script></body></html>'
+
+
+def captive_redirect(session_id):
+    """The captive-portal detection answer: a script redirect to the portal."""
+    resp = make_response(_REDIRECT_HEAD + str(int(session_id)).encode() + _REDIRECT_TAIL)
+    resp.mimetype = 'text/html'
+    return resp
+
+
+def render_page(template):
+    cache = current_app.extensions.get('page_cache')
+    if cache is None:
+        return make_response(render_template(template))
+    return cache.render(template)
+
+
+def init_app(app):
+    cache = PageCache(enabled=app.config.get('PAGE_CACHE', True))
+    app.extensions['page_cache'] = cache
+    return cache
@@ -0,0 +1,326 @@
+"""Opt-in SQL profiler for the SQLite connection returned by `db.get_db`.
+
+Enable it with `DB_PROFILE=true`. Every statement executed through the
+wrapped connection is grouped by its normalized SQL (literals and IN-lists
+collapsed) and accounted for: call count, total/max duration and rows
+returned or affected. A sample of executions also runs
+`EXPLAIN QUERY PLAN` so the summary report can flag full table scans.
+
+Statements slower than `DB_PROFILE_SLOW_MS` are logged as they happen; the
+summary report is written to `DB_PROFILE_REPORT` when the process exits.
+"""
+import atexit
+import logging
+import random
+import re
+import threading
+import time
+from typing import Optional
+
+
+_WS_RE = re.compile(r"\s+")
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+# Only statements with a meaningful query plan are sampled.
+_EXPLAINABLE = ("SELECT", "UPDATE", "DELETE", "WITH")
+
+
+def normalize_sql(sql: str) -> str:
+    """Collapse whitespace, literals and IN-lists so equivalent statements group together."""
+    text = _WS_RE.sub(" ", sql).strip()
+    text = _STRING_RE.sub("?", text)
+    text = _NUMBER_RE.sub("?", text)
+    text = _IN_LIST_RE.sub("(?...)", text)
+    return text
+
+
+def is_full_scan(plan_detail: str) -> bool:
+    """True when an EXPLAIN QUERY PLAN row describes a table scan without an index."""
+    detail = plan_detail.upper()
+    if not detail.startswith("SCAN"):
+        return False
+    return "USING INDEX" not in detail and "USING COVERING INDEX" not in detail and "USING INTEGER PRIMARY KEY" not in detail
+
+
+class _StatementStats:
+    __slots__ = ("sql", "calls", "total_ms", "max_ms", "rows", "slow", "plans", "full_scan")
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.calls = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.slow = 0
+        self.plans = set()
+        self.full_scan = False
+
+    def as_dict(self):
+        return {
+            "sql": self.sql,
+            "calls": self.calls,
+            "total_ms": round(self.total_ms, 3),
+            "avg_ms": round(self.total_ms / self.calls, 3) if self.calls else 0.0,
+            "max_ms": round(self.max_ms, 3),
+            "rows": self.rows,
+            "slow": self.slow,
+            "full_scan": self.full_scan,
+            "plans": sorted(self.plans),
+        }
+
+
+class QueryProfiler:
+    """Collects per-statement timings for every profiled connection of an app."""
+
+    def __init__(self, slow_ms: float = 50.0, explain_sample: float = 0.1, logger=None):
+        self.slow_ms = float(slow_ms)
+        self.explain_sample = max(0.0, min(1.0, float(explain_sample)))
+        self.logger = logger or logging.getLogger(__name__)
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def wrap(self, conn):
+        return ProfiledConnection(conn, self)
+
+    def _entry(self, key):
+        entry = self._stats.get(key)
+        if entry is None:
+            entry = self._stats[key] = _StatementStats(key)
+        return entry
+
+    def record_execute(self, key, elapsed_ms):
+        with self._lock:
+            entry = self._entry(key)
+            entry.calls += 1
+            entry.total_ms += elapsed_ms
+            entry.max_ms = max(entry.max_ms, elapsed_ms)
+
+    def record_fetch(self, key, elapsed_ms, rows):
+        with self._lock:
+            entry = self._entry(key)
+            entry.total_ms += elapsed_ms
+            entry.rows += rows
+
+    def record_statement_total(self, key, sql, params, total_ms):
+        """Called once per execution with execute + fetch time; logs slow statements."""
+        with self._lock:
+            entry = self._entry(key)
+            entry.max_ms = max(entry.max_ms, total_ms)
+            if total_ms < self.slow_ms:
+                return
+            entry.slow += 1
+        self.logger.warning("Slow query (%.1f ms): %s params=%r", total_ms, _WS_RE.sub(" ", sql).strip(), params)
+
+    def should_explain(self, sql):
+        if self.explain_sample <= 0.0:
+            return False
+        if not sql.lstrip().upper().startswith(_EXPLAINABLE):
+            return False
+        return self.explain_sample >= 1.0 or random.random() < self.explain_sample
+
+    def explain(self, raw_conn, key, sql, params):
+        try:
+            rows = raw_conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+        except Exception:
+            self.logger.debug("EXPLAIN QUERY PLAN failed for %s", key, exc_info=True)
+            return
+        details = [str(r[-1]) for r in rows]
+        with self._lock:
+            entry = self._entry(key)
+            entry.plans.update(details)
+            if any(is_full_scan(d) for d in details):
+                entry.full_scan = True
+
+    def snapshot(self):
+        with self._lock:
+            return sorted((s.as_dict() for s in self._stats.values()), key=lambda s: s["total_ms"], reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def report(self) -> str:
+        """Render a plain-text summary ordered by total time spent."""
+        stats = self.snapshot()
+        lines = [
+            "SQL profile report (%d distinct statements, slow threshold %.0f ms)" % (len(stats), self.slow_ms),
+            "",
+        ]
+        scans = [s for s in stats if s["full_scan"]]
+        if scans:
+            lines.append("FULL TABLE SCANS:")
+            for s in scans:
+                lines.append("  %s" % s["sql"])
+            lines.append("")
+        for s in stats:
+            lines.append(
+                "calls=%d total=%.1fms avg=%.2fms max=%.1fms rows=%d slow=%d%s"
+                % (s["calls"], s["total_ms"], s["avg_ms"], s["max_ms"], s["rows"], s["slow"],
+                   " FULL-SCAN" if s["full_scan"] else "")
+            )
+            lines.append("  " + s["sql"])
+            for plan in s["plans"]:
+                lines.append("    plan: " + plan)
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, path: str):
+        with open(path, "w", encoding="utf-8") as fh:
+            fh.write(self.report())
+        self.logger.info("SQL profile report written to %s", path)
+
+
+class ProfiledCursor:
+    """Cursor proxy timing execute and fetch calls for the current statement."""
+
+    def __init__(self, cursor, profiler, raw_conn):
+        self._cursor = cursor
+        self._profiler = profiler
+        self._raw_conn = raw_conn
+        self._key = None
+        self._sql = None
+        self._params = None
+        self._total_ms = 0.0
+
+    def _finish(self):
+        if self._key is not None:
+            self._profiler.record_statement_total(self._key, self._sql, self._params, self._total_ms)
+            self._key = None
+
+    def execute(self, sql, params=()):
+        self._finish()
+        key = normalize_sql(sql)
+        start = time.perf_counter()
+        self._cursor.execute(sql, params)
+        elapsed = (time.perf_counter() - start) * 1000.0
+        self._profiler.record_execute(key, elapsed)
+        if self._cursor.description is None and self._cursor.rowcount > 0:
+            # DML: account affected rows right away, there is nothing to fetch
+            self._profiler.record_fetch(key, 0.0, self._cursor.rowcount)
+        self._key, self._sql, self._params, self._total_ms = key, sql, params, elapsed
+        if self._profiler.should_explain(sql):
+            self._profiler.explain(self._raw_conn, key, sql, params)
+        if self._cursor.description is None:
+            self._finish()
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self._finish()
+        key = normalize_sql(sql)
+        start = time.perf_counter()
+        self._cursor.executemany(sql, seq_of_params)
+        elapsed = (time.perf_counter() - start) * 1000.0
+        self._profiler.record_execute(key, elapsed)
+        self._profiler.record_fetch(key, 0.0, max(self._cursor.rowcount, 0))
+        self._profiler.record_statement_total(key, sql, "<many>", elapsed)
+        return self
+
+    def _timed_fetch(self, fn, *args):
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = (time.perf_counter() - start) * 1000.0
+        if self._key is not None:
+            if isinstance(result, list):
+                rows = len(result)
+            else:
+                rows = 0 if result is None else 1
+            self._profiler.record_fetch(self._key, elapsed, rows)
+            self._total_ms += elapsed
+        return result
+
+    def fetchone(self):
+        row = self._timed_fetch(self._cursor.fetchone)
+        if row is None:
+            self._finish()
+        return row
+
+    def fetchall(self):
+        rows = self._timed_fetch(self._cursor.fetchall)
+        self._finish()
+        return rows
+
+    def fetchmany(self, size=None):
+        rows = self._timed_fetch(self._cursor.fetchmany, size or self._cursor.arraysize)
+        if not rows:
+            self._finish()
+        return rows
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def close(self):
+        self._finish()
+        self._cursor.close()
+
+    def __del__(self):
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+    @property
+    def row_factory(self):
+        return self._cursor.row_factory
+
+    @row_factory.setter
+    def row_factory(self, factory):
+        self._cursor.row_factory = factory
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class ProfiledConnection:
+    """Connection proxy: `execute`/`cursor` are profiled, everything else is delegated."""
+
+    def __init__(self, conn, profiler: QueryProfiler):
+        self._conn = conn
+        self._profiler = profiler
+
+    def cursor(self):
+        return ProfiledCursor(self._conn.cursor(), self._profiler, self._conn)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._conn.__exit__(*exc)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        if name in ("_conn", "_profiler"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._conn, name, value)
+
+
+def init_app(app) -> Optional[QueryProfiler]:
+    """Attach a profiler to `app` when `DB_PROFILE` is enabled; returns it (or None)."""
+    if not app.config.get("DB_PROFILE"):
+        return None
+    profiler = QueryProfiler(
+        slow_ms=app.config.get("DB_PROFILE_SLOW_MS", 50),
+        explain_sample=app.config.get("DB_PROFILE_EXPLAIN_SAMPLE", 0.1),
+        logger=app.logger,
+    )
+    app.extensions["query_profiler"] = profiler
+    report_path = app.config.get("DB_PROFILE_REPORT")
+    if report_path:
+        atexit.register(profiler.write_report, report_path)
+    app.logger.info("SQL profiling enabled (slow >= %.0f ms, explain sample %.2f)",
+                    profiler.slow_ms, profiler.explain_sample)
+    return profiler
@@ -0,0 +1,136 @@
+"""Per-device token-bucket rate limiting for the portal APIs.
+
+Captive-portal probes (`/generate_204` and friends), `/api/session/lookup`
+and `/api/session/create` all hit SQLite, and may shell out to `arp`. A
+phone stuck in a probe loop can take the Pi down with them. Each endpoint
+decorated with `rate_limited(scope)` gets a token bucket per client. The
+bucket refills at `per_minute / 60` tokens per second up to `burst`, and a
+request that finds it empty gets 429 with `Retry-After`.
+
+Clients are keyed by their `device_id` cookie when they have one, otherwise
+by IP. That is what `routes.portal.get_device_identifier` ends up with on
+the Pi's LAN, without paying for its ARP lookup before the limit is checked.
+
+A bucket is a (tokens, last refill) tuple in one dict. Buckets that have
+refilled completely behave exactly like missing ones, so a sweep every
+`RATE_LIMIT_SWEEP_INTERVAL` seconds drops them. Memory follows the number of
+recently active clients, capped at `RATE_LIMIT_MAX_BUCKETS`.
+
+Limits are set per scope with `RATE_LIMITS`, e.g.
+`RATE_LIMITS="captive=30/10,lookup=30/10,create=12/5"` (requests per
+minute / burst).
+"""
+import math
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, make_response, request
+
+DEFAULT_LIMITS = {
+    'captive': (30, 10),
+    'lookup': (30, 10),
+    'create': (12, 5),
+}
+
+
+def parse_limits(spec):
+    """'scope=per_minute/burst,...' -> {scope: (per_minute, burst)}."""
+    limits = {}
+    for part in (spec or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        scope, _, value = part.partition('=')
+        per_minute, _, burst = value.partition('/')
+        limits[scope.strip()] = (float(per_minute), int(burst or 1))
+    return limits
+
+
+class RateLimiter:
+    def __init__(self, limits, sweep_interval=60, max_buckets=10000, clock=time.monotonic):
+        # scope -> (tokens per second, burst)
+        self.limits = {scope: (per_minute / 60.0, burst) for scope, (per_minute, burst) in limits.items()}
+        self.sweep_interval = sweep_interval
+        self.max_buckets = max_buckets
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._buckets = {}  # (scope, client key) -> (tokens, last refill)
+        self._next_sweep = clock() + sweep_interval
+        self.allowed = 0
+        self.limited = 0
+
+    def hit(self, scope, key):
+        """Take one token. Returns 0 when allowed, else seconds until a token is available."""
+        rate, burst = self.limits[scope]
+        now = self._clock()
+        bk = (scope, key)
+        with self._lock:
+            if now >= self._next_sweep or len(self._buckets) >= self.max_buckets:
+                self._sweep(now)
+            bucket = self._buckets.get(bk)
+            tokens = burst if bucket is None else min(burst, bucket[0] + (now - bucket[1]) * rate)
+            if tokens >= 1:
+                self._buckets[bk] = (tokens - 1, now)
+                self.allowed += 1
+                return 0
+            self._buckets[bk] = (tokens, now)
+            self.limited += 1
+            return (1 - tokens) / rate if rate > 0 else self.sweep_interval
+
+    def _sweep(self, now):
+        self._next_sweep = now + self.sweep_interval
+        idle = [
+            bk for bk, (tokens, stamp) in self._buckets.items()
+            if tokens + (now - stamp) * self.limits[bk[0]][0] >= self.limits[bk[0]][1]
+        ]
+        for bk in idle:
+            del self._buckets[bk]
+        # still full of active clients: forget the oldest ones (they start over with a full bucket)
+        overflow = len(self._buckets) - self.max_buckets // 2 if len(self._buckets) >= self.max_buckets else 0
+        for bk in list(self._buckets)[:overflow]:
+            del self._buckets[bk]
+
+    def snapshot(self):
+        with self._lock:
+            return {'buckets': len(self._buckets), 'allowed': self.allowed, 'limited': self.limited}
+
+
+def client_key():
+    """device_id cookie if set, else the client IP (same order as get_device_identifier minus ARP)."""
+    device_id = request.cookies.get('device_id')
+    if device_id:
+        return f'device:{device_id}'
+    return request.remote_addr or request.headers.get('X-Forwarded-For') or ''
+
+
+def rate_limited(scope):
+    """Route decorator: 429 with Retry-After once this client's `scope` bucket is empty."""
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(*args, **kwargs):
+            limiter = current_app.extensions.get('rate_limit')
+            if limiter is None or scope not in limiter.limits:
+                return view_func(*args, **kwargs)
+            wait = limiter.hit(scope, client_key())
+            if wait:
+                resp = make_response({'error': 'Too many requests', 'retry_after': math.ceil(wait)}, 429)
+                resp.headers['Retry-After'] = str(math.ceil(wait))
+                return resp
+            return view_func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def init_app(app):
+    if not app.config.get('RATE_LIMIT_ENABLED', True):
+        return None
+    limits = dict(DEFAULT_LIMITS)
+    limits.update(parse_limits(app.config.get('RATE_LIMITS')))
+    limiter = RateLimiter(
+        limits,
+        sweep_interval=app.config.get('RATE_LIMIT_SWEEP_INTERVAL', 60),
+        max_buckets=app.config.get('RATE_LIMIT_MAX_BUCKETS', 10000),
+    )
+    app.extensions['rate_limit'] = limiter
+    return limiter
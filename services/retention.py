@@ -0,0 +1,246 @@
+"""Retention and compaction for system_logs and bottle_logs.
+
+Runs periodically in a background thread (`RETENTION_INTERVAL` seconds,
+0 disables it) and can be run once from `scripts/compact_db.py`.
+
+Each run:
+  - folds system_logs older than `SYSTEM_LOG_RETENTION_DAYS` into
+    `system_log_daily_counts` (one row per PH day and event type) and
+    deletes them;
+  - downsamples bottle_logs older than `BOTTLE_LOG_RETENTION_DAYS` to one
+    row per session (totals stay exact, `bottle_daily_totals` is untouched);
+  - deletes stored idempotency responses older than `IDEMPOTENCY_TTL`;
+  - returns freed pages to the filesystem with `PRAGMA incremental_vacuum`.
+
+All work happens in batches of `RETENTION_BATCH_SIZE` rows, each in its own
+short transaction with a pause in between, so the portal never waits long
+for the write lock. Incremental vacuum needs `auto_vacuum=INCREMENTAL`,
+which new databases get from `db.init_db`; older databases can be switched
+once with `python scripts/compact_db.py --enable-incremental`.
+"""
+import threading
+import time
+from datetime import datetime, timezone
+
+import db
+import migrations
+from services import idempotency
+
+AUTO_VACUUM_INCREMENTAL = 2
+_BOTTLE_POSITION_KEY = 'bottle_logs_compacted_session'
+
+
+def _now():
+    return int(datetime.now(timezone.utc).timestamp())
+
+
+def _freelist_bytes(conn):
+    pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    return pages * page_size
+
+
+def _file_bytes(conn):
+    pages = conn.execute('PRAGMA page_count').fetchone()[0]
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    return pages * page_size
+
+
+def prune_system_logs(conn, cutoff_ts, batch_size=1000, pause=0.05):
+    """Fold system_logs older than cutoff_ts into daily counts and delete them."""
+    deleted = 0
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            ids = [r[0] for r in conn.execute(
+                'SELECT id FROM system_logs WHERE created_at < ? ORDER BY created_at LIMIT ?',
+                (cutoff_ts, batch_size),
+            ).fetchall()]
+            if not ids:
+                conn.execute('COMMIT')
+                return deleted
+            placeholders = ','.join('?' * len(ids))
+            conn.execute(f'''
+                INSERT INTO system_log_daily_counts (day, event_type, events)
+                SELECT date(created_at + 28800, 'unixepoch') AS day, event_type, COUNT(*)
+                FROM system_logs
+                WHERE id IN ({placeholders})
+                GROUP BY day, event_type
+                ON CONFLICT(day, event_type) DO UPDATE SET events = events + excluded.events
+            ''', ids)
+            conn.execute(f'DELETE FROM system_logs WHERE id IN ({placeholders})', ids)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        deleted += len(ids)
+        if len(ids) < batch_size:
+            return deleted
+        if pause:
+            time.sleep(pause)
+
+
+def compact_bottle_logs(conn, cutoff_ts, batch_size=1000, pause=0.05):
+    """
+    Collapse bottle_logs of sessions whose logs are all older than cutoff_ts
+    into a single row per session. Walks sessions in id order; the position
+    before the first session that is still too recent is kept in
+    retention_state so the next run starts there. Returns rows removed.
+    """
+    row = conn.execute('SELECT value FROM retention_state WHERE key = ?', (_BOTTLE_POSITION_KEY,)).fetchone()
+    position = row[0] if row else 0
+    resume_at = None  # last session id before the first one we had to skip
+    removed = 0
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            groups = conn.execute('''
+                SELECT session_id, COUNT(*), SUM(count), MIN(id), MAX(created_at)
+                FROM bottle_logs
+                WHERE session_id > ?
+                GROUP BY session_id
+                ORDER BY session_id
+                LIMIT ?
+            ''', (position, batch_size)).fetchall()
+
+            keep, drop = [], []
+            for session_id, rows, total, first_id, last_ts in groups:
+                if last_ts >= cutoff_ts:
+                    if resume_at is None:
+                        resume_at = position
+                elif rows > 1:
+                    keep.append((total, first_id))
+                    drop.append((session_id, first_id))
+                    removed += rows - 1
+                position = session_id
+
+            # UPDATE (not INSERT) so the bottle_daily_totals trigger doesn't count twice
+            conn.executemany('UPDATE bottle_logs SET count = ? WHERE id = ?', keep)
+            conn.executemany('DELETE FROM bottle_logs WHERE session_id = ? AND id <> ?', drop)
+            conn.execute(
+                'INSERT INTO retention_state (key, value) VALUES (?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+                (_BOTTLE_POSITION_KEY, position if resume_at is None else resume_at),
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if len(groups) < batch_size:
+            return removed
+        if pause:
+            time.sleep(pause)
+
+
+def incremental_vacuum(conn, step_pages=256, pause=0.05):
+    """Release free pages in steps; returns bytes returned to the filesystem."""
+    mode = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+    if mode != AUTO_VACUUM_INCREMENTAL:
+        return 0
+    before = _file_bytes(conn)
+    while conn.execute('PRAGMA freelist_count').fetchone()[0] > 0:
+        conn.execute(f'PRAGMA incremental_vacuum({int(step_pages)})').fetchall()
+        if pause:
+            time.sleep(pause)
+    return before - _file_bytes(conn)
+
+
+def purge_idempotency_keys(conn, ttl):
+    """Drop stored Idempotency-Key responses older than ttl seconds."""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        deleted = idempotency.purge_expired(conn, ttl, _now())
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return deleted
+
+
+def run_retention(db_path, system_log_days=90, bottle_log_days=180, batch_size=1000,
+                  pause=0.05, vacuum_pages=256, idempotency_ttl=86400, logger=None):
+    """Run one retention pass against db_path and return a report dict."""
+    started = time.perf_counter()
+    conn = db.connect_autocommit(db_path)
+    try:
+        if not migrations.is_applied(conn, migrations.RETENTION_VERSION, db_path):
+            if logger:
+                logger.info("Retention skipped: schema version %d not applied yet", migrations.RETENTION_VERSION)
+            return None
+        now = _now()
+        size_before = _file_bytes(conn)
+        report = {
+            'system_logs_deleted': 0,
+            'bottle_logs_removed': 0,
+            'idempotency_keys_deleted': 0,
+        }
+        if system_log_days:
+            report['system_logs_deleted'] = prune_system_logs(
+                conn, now - int(system_log_days) * 86400, batch_size, pause)
+        if bottle_log_days:
+            report['bottle_logs_removed'] = compact_bottle_logs(
+                conn, now - int(bottle_log_days) * 86400, batch_size, pause)
+        if idempotency_ttl and migrations.is_applied(conn, migrations.IDEMPOTENCY_VERSION, db_path):
+            report['idempotency_keys_deleted'] = purge_idempotency_keys(conn, idempotency_ttl)
+        report['free_bytes'] = _freelist_bytes(conn)
+        report['reclaimed_bytes'] = incremental_vacuum(conn, vacuum_pages, pause)
+        report['incremental_vacuum'] = conn.execute('PRAGMA auto_vacuum').fetchone()[0] == AUTO_VACUUM_INCREMENTAL
+        report['size_before'] = size_before
+        report['size_after'] = _file_bytes(conn)
+        report['duration_s'] = round(time.perf_counter() - started, 3)
+    finally:
+        conn.close()
+
+    if logger:
+        logger.info(
+            "Retention: deleted %d system_logs, removed %d bottle_logs rows, reclaimed %d bytes in %.2fs",
+            report['system_logs_deleted'], report['bottle_logs_removed'],
+            report['reclaimed_bytes'], report['duration_s'],
+        )
+        if not report['incremental_vacuum'] and report['free_bytes']:
+            logger.info(
+                "Retention: %d free bytes kept in file; run scripts/compact_db.py --enable-incremental once",
+                report['free_bytes'],
+            )
+    return report
+
+
+def enable_incremental_vacuum(db_path):
+    """One-time switch to auto_vacuum=INCREMENTAL. Runs a full (blocking) VACUUM."""
+    conn = db.connect_autocommit(db_path)
+    try:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        return conn.execute('PRAGMA auto_vacuum').fetchone()[0] == AUTO_VACUUM_INCREMENTAL
+    finally:
+        conn.close()
+
+
+def _config_kwargs(app):
+    return {
+        'system_log_days': app.config.get('SYSTEM_LOG_RETENTION_DAYS', 90),
+        'bottle_log_days': app.config.get('BOTTLE_LOG_RETENTION_DAYS', 180),
+        'batch_size': app.config.get('RETENTION_BATCH_SIZE', 1000),
+        'pause': app.config.get('RETENTION_BATCH_PAUSE', 0.05),
+        'vacuum_pages': app.config.get('RETENTION_VACUUM_PAGES', 256),
+        'idempotency_ttl': app.config.get('IDEMPOTENCY_TTL', 86400),
+    }
+
+
+def init_app(app):
+    """Start the periodic retention thread unless RETENTION_INTERVAL is 0."""
+    interval = int(app.config.get('RETENTION_INTERVAL', 3600))
+    if interval <= 0:
+        return None
+
+    def _loop():
+        while True:
+            time.sleep(interval)
+            try:
+                run_retention(db.get_db_path(app), logger=app.logger, **_config_kwargs(app))
+            except Exception:
+                app.logger.exception("Retention job failed")
+
+    t = threading.Thread(target=_loop, daemon=True, name='retention')
+    t.start()
+    return t
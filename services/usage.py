@@ -0,0 +1,146 @@
+"""Per-session traffic accounting.
+
+Every `USAGE_INTERVAL` seconds the collector reads the cumulative per-IP
+byte/packet counters of the access rules in one dump
+(`AccessController.counters()`, i.e. one `iptables-save -c` for the
+iptables backend). It subtracts the previous reading and charges the
+difference to the running session holding each IP
+(`db.get_running_sessions_by_ip`, which also counts a started session
+topping up its time, as the access reconciler does). A counter that went
+backwards belongs to a rule that was re-created, so its whole value counts
+as new traffic.
+
+The rules, and their counters, survive a portal restart. The first pass of
+a new collector only takes the baseline and stores nothing. Otherwise all
+traffic since the rules were created would be charged a second time.
+
+Deltas go to `session_usage` (one row per session) and to
+`usage_daily_totals` (per PH day), both from migration 10, in one
+transaction per pass. The admin dashboard reads them through
+`db.get_session_usage` and `db.get_usage_today`.
+"""
+import threading
+import time
+
+import db
+import migrations
+
+
+class UsageCollector:
+    def __init__(self, controller, db_path, interval=60, clock=time.time):
+        self.controller = controller
+        self.db_path = db_path
+        self.interval = interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._last = None  # ip -> counters tuple from the previous pass; None until the baseline
+        self.runs = 0
+        self.last = None
+
+    def _deltas(self, counters):
+        if self._last is None:
+            self._last = counters
+            return {}
+        deltas = {}
+        for ip, current in counters.items():
+            previous = self._last.get(ip)
+            if previous is None or any(c < p for c, p in zip(current, previous)):
+                delta = current
+            else:
+                delta = tuple(c - p for c, p in zip(current, previous))
+            if any(delta):
+                deltas[ip] = delta
+        self._last = counters
+        return deltas
+
+    def collect(self):
+        """One pass: read counters, store the deltas. Returns a stats dict."""
+        started = time.perf_counter()
+        counters = self.controller.counters()
+        with self._lock:
+            deltas = self._deltas(counters)
+        stored = 0
+        if deltas:
+            stored = self._store(deltas)
+        stats = {
+            'clients': len(counters),
+            'changed': len(deltas),
+            'stored': stored,
+            'bytes': sum(d[1] + d[3] for d in deltas.values()),
+            'duration_ms': round((time.perf_counter() - started) * 1000, 2),
+            'at': int(self._clock()),
+        }
+        with self._lock:
+            self.runs += 1
+            self.last = stats
+        if stored:
+            db.notify_change('usage')
+        return stats
+
+    def _store(self, deltas):
+        now = int(self._clock())
+        conn = db.connect_autocommit(self.db_path)
+        try:
+            if not migrations.is_applied(conn, migrations.USAGE_VERSION, self.db_path):
+                return 0
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                sessions = db.get_running_sessions_by_ip(conn, now)
+                rows = [
+                    (sessions[ip], d[1], d[3], d[0], d[2], now)
+                    for ip, d in deltas.items() if ip in sessions
+                ]
+                if rows:
+                    conn.executemany('''
+                        INSERT INTO session_usage
+                            (session_id, bytes_up, bytes_down, packets_up, packets_down, updated_at)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        ON CONFLICT(session_id) DO UPDATE SET
+                            bytes_up = bytes_up + excluded.bytes_up,
+                            bytes_down = bytes_down + excluded.bytes_down,
+                            packets_up = packets_up + excluded.packets_up,
+                            packets_down = packets_down + excluded.packets_down,
+                            updated_at = excluded.updated_at
+                    ''', rows)
+                    conn.execute('''
+                        INSERT INTO usage_daily_totals (day, bytes_up, bytes_down, packets_up, packets_down)
+                        VALUES (date(? + 28800, 'unixepoch'), ?, ?, ?, ?)
+                        ON CONFLICT(day) DO UPDATE SET
+                            bytes_up = bytes_up + excluded.bytes_up,
+                            bytes_down = bytes_down + excluded.bytes_down,
+                            packets_up = packets_up + excluded.packets_up,
+                            packets_down = packets_down + excluded.packets_down
+                    ''', (now, *(sum(r[i] for r in rows) for i in range(1, 5))))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            return len(rows)
+        finally:
+            conn.close()
+
+    def snapshot(self):
+        with self._lock:
+            return {'runs': self.runs, 'tracked_ips': len(self._last or ()), 'last': self.last}
+
+
+def init_app(app):
+    """Start the collector thread unless USAGE_INTERVAL is 0."""
+    interval = int(app.config.get('USAGE_INTERVAL', 60))
+    controller = app.extensions.get('access_control')
+    if interval <= 0 or controller is None:
+        return None
+    collector = UsageCollector(controller, db.get_db_path(app), interval=interval)
+    app.extensions['usage'] = collector
+
+    def _loop():
+        # the first pass takes the baseline right away
+        while True:
+            try:
+                collector.collect()
+            except Exception:
+                app.logger.exception("Usage collection failed")
+            time.sleep(interval)
+
+    threading.Thread(target=_loop, daemon=True, name='usage').start()
+    return collector
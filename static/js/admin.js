@@ -34,6 +34,18 @@ function updateKpis(payload) {
   if (bottlesTodayEl) bottlesTodayEl.textContent = payload.bottles_today ?? 0;
   if (totalBottlesEl) totalBottlesEl.textContent = payload.total_bottles ?? 0;
   if (totalReviewsEl) totalReviewsEl.textContent = payload.total_reviews ?? 0;
+
+  const dataTodayEl = document.getElementById('kpi-data-today');
+  const usageToday = payload.usage_today || {};
+  if (dataTodayEl) dataTodayEl.textContent = formatBytes((usageToday.bytes_up || 0) + (usageToday.bytes_down || 0));
+  sessionUsage = payload.session_usage || {};
+}
+
+function formatBytes(n) {
+  if (!n) return '0 B';
+  const units = ['B', 'kB', 'MB', 'GB', 'TB'];
+  const i = Math.min(Math.floor(Math.log(n) / Math.log(1000)), units.length - 1);
+  return `${(n / 1000 ** i).toFixed(i ? 1 : 0)} ${units[i]}`;
 }
 
 function updateRatingsSummary(means) {
@@ -51,6 +63,11 @@ function updateRatingsSummary(means) {
   }
 }
 
+function formatUsage(usage) {
+  if (!usage) return '-';
+  return `↓ ${formatBytes(usage.bytes_down)} ↑ ${formatBytes(usage.bytes_up)}`;
+}
+
 function formatTsRelative(sessionEnd) {
   if (!sessionEnd) return '-';
   const now = Math.floor(Date.now() / 1000);
@@ -69,6 +86,7 @@ function formatTs(ts) {
 
 // Ongoing sessions pagination state
 let latestOngoing = [];
+let sessionUsage = {}; // session id -> { bytes_up, bytes_down }
 let ongoingFiltered = [];
 let ongoingPage = 1;
 
@@ -123,7 +141,7 @@ function renderOngoingPage() {
 
   if (!ongoingFiltered.length) {
     const tr = document.createElement('tr');
-    tr.innerHTML = `<td colspan="4" class="empty-cell">No ongoing sessions.</td>`;
+    tr.innerHTML = `<td colspan="5" class="empty-cell">No ongoing sessions.</td>`;
     tbody.appendChild(tr);
     return;
   }
@@ -136,7 +154,7 @@ function renderOngoingPage() {
 
   if (!pageRows.length) {
     const tr = document.createElement('tr');
-    tr.innerHTML = `<td colspan="4" class="empty-cell">No ongoing sessions.</td>`;
+    tr.innerHTML = `<td colspan="5" class="empty-cell">No ongoing sessions.</td>`;
     tbody.appendChild(tr);
   } else {
     pageRows.forEach((row) => {
@@ -146,6 +164,7 @@ function renderOngoingPage() {
         { label: 'Status', value: row.status || '-' },
         { label: 'Bottles', value: row.bottles_inserted || 0 },
         { label: 'Expires In', value: formatTsRelative(row.session_end) },
+        { label: 'Data', value: formatUsage(sessionUsage[row.id]) },
       ];
 
       cells.forEach((cell) => {
@@ -0,0 +1,41 @@
+/**
+ * POST with an Idempotency-Key and automatic retries.
+ *
+ * The same key is sent on every attempt, so the server runs the request at
+ * most once and replays its stored response to any retry. Retries happen on
+ * network errors, 5xx responses and 409 "still being processed" answers.
+ */
+const RETRY_DELAYS_MS = [300, 800, 2000];
+
+let seq = 0;
+
+// crypto.randomUUID needs a secure context, which the captive portal (http) is not
+export function newIdempotencyKey() {
+  seq += 1;
+  return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 12)}-${seq}`;
+}
+
+function sleep(ms) {
+  return new Promise((resolve) => setTimeout(resolve, ms));
+}
+
+export async function postIdempotent(url, body = undefined, { key = newIdempotencyKey(), headers = {} } = {}) {
+  const init = {
+    method: 'POST',
+    credentials: 'same-origin',
+    headers: { 'Content-Type': 'application/json', 'Idempotency-Key': key, ...headers },
+    body: body === undefined ? undefined : JSON.stringify(body)
+  };
+  let lastError = null;
+  for (let attempt = 0; attempt <= RETRY_DELAYS_MS.length; attempt++) {
+    if (attempt > 0) await sleep(RETRY_DELAYS_MS[attempt - 1]);
+    try {
+      const res = await fetch(url, init);
+      const inProgress = res.status === 409 && res.headers.get('Retry-After');
+      if ((res.status < 500 && !inProgress) || attempt === RETRY_DELAYS_MS.length) return res;
+    } catch (err) {
+      lastError = err;
+    }
+  }
+  throw lastError || new Error(`${url} failed after retries`);
+}
@@ -1,3 +1,5 @@
+import { postIdempotent } from './retry.js';
+
 function getCookie(name) {
   const value = `; ${document.cookie}`;
   const parts = value.split(`; ${name}=`);
@@ -36,6 +38,33 @@ export async function acquireInsertionLock(payload = {}) {
   });
 }
 
+// Waiting line for the insertion lock: position / ETA / your_turn for this device
+export async function getQueueStatus() {
+  const res = await fetch('/api/session/queue', { method: 'GET', credentials: 'same-origin' });
+  if (!res.ok) throw new Error(`getQueueStatus failed: ${res.status}`);
+  return await res.json();
+}
+
+export async function leaveQueue() {
+  return await fetch('/api/session/queue', { method: 'DELETE', credentials: 'same-origin' });
+}
+
+// Keep the insertion lock while the insert modal is open
+export async function sendHeartbeat(sessionId) {
+  return await fetch(`/api/session/${encodeURIComponent(sessionId)}/heartbeat`, {
+    method: 'POST',
+    credentials: 'same-origin',
+    keepalive: true
+  });
+}
+
+// Fire-and-forget unlock that survives the page being closed
+export function unlockInsertionOnExit() {
+  if (navigator.sendBeacon) return navigator.sendBeacon('/api/session/unlock');
+  fetch('/api/session/unlock', { method: 'POST', credentials: 'same-origin', keepalive: true }).catch(() => {});
+  return true;
+}
+
 export async function unlockInsertion(payload = {}) {
   return await fetch('/api/session/unlock', {
     method: 'POST',
@@ -44,19 +73,23 @@ export async function unlockInsertion(payload = {}) {
   });
 }
 
+// Idempotency-Key + retries: a lost response never credits the bottles twice
 export async function postBottles(sessionId, count = 1) {
-  return await fetch('/api/bottle', {
+  return await postIdempotent('/api/bottle', { session_id: sessionId, count });
+}
+
+// Batch of bottle events [{ key, count, ts }]; keys make a retried batch safe
+export async function postBottleEvents(sessionId, events) {
+  return await fetch('/api/bottle/batch', {
     method: 'POST',
     headers: { 'Content-Type': 'application/json' },
-    body: JSON.stringify({ session_id: sessionId, count })
+    credentials: 'same-origin',
+    body: JSON.stringify({ session_id: sessionId, events })
   });
 }
 
 export async function activateSession(sessionId) {
-  return await fetch(`/api/session/${sessionId}/activate`, {
-    method: 'POST',
-    headers: { 'Content-Type': 'application/json' }
-  });
+  return await postIdempotent(`/api/session/${sessionId}/activate`);
 }
 
 // Get session by ID
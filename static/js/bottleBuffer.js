@@ -0,0 +1,95 @@
+/**
+ * Coalescing buffer for bottle events.
+ *
+ * Bottles detected in quick succession are collected for a short window and
+ * sent as one POST /api/bottle/batch. Every event carries a unique key, so a
+ * batch that failed on a flaky link is simply re-sent: the server skips keys
+ * it has already credited.
+ */
+import { postBottleEvents } from './api/sessionApi.js';
+
+const FLUSH_DELAY_MS = 250; // coalescing window after the last bottle
+const MAX_BATCH = 50; // flush right away once this many events are pending
+const RETRY_BASE_MS = 500;
+const RETRY_MAX_MS = 8000;
+
+let pending = []; // [{ key, count, ts, sessionId, resolve, reject }]
+let flushTimer = null;
+let inFlight = null;
+let retryDelay = RETRY_BASE_MS;
+let seq = 0;
+
+// crypto.randomUUID needs a secure context, which the captive portal (http) is not
+function makeKey() {
+  seq += 1;
+  return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 10)}-${seq}`;
+}
+
+function scheduleFlush(delay) {
+  if (flushTimer) clearTimeout(flushTimer);
+  flushTimer = setTimeout(() => { flushTimer = null; flushBottles().catch(() => {}); }, delay);
+}
+
+/**
+ * Queue `count` bottles for sessionId. Resolves with the server's session
+ * state (bottles_inserted, seconds_earned, session_end, ...) once the batch
+ * containing this event has been stored.
+ */
+export function queueBottle(sessionId, count = 1) {
+  return new Promise((resolve, reject) => {
+    pending.push({ key: makeKey(), count, ts: Math.floor(Date.now() / 1000), sessionId: String(sessionId), resolve, reject });
+    scheduleFlush(pending.length >= MAX_BATCH ? 0 : FLUSH_DELAY_MS);
+  });
+}
+
+export function hasPendingBottles() {
+  return pending.length > 0 || inFlight !== null;
+}
+
+/** Send everything queued so far; resolves once the buffer is empty. */
+export async function flushBottles() {
+  if (flushTimer) { clearTimeout(flushTimer); flushTimer = null; }
+  while (inFlight) await inFlight.catch(() => {});
+  if (!pending.length) return null;
+
+  // one session per request; other sessions' events stay queued
+  const sessionId = pending[0].sessionId;
+  const batch = pending.filter((e) => e.sessionId === sessionId).slice(0, MAX_BATCH);
+
+  inFlight = (async () => {
+    let res;
+    try {
+      res = await postBottleEvents(sessionId, batch.map(({ key, count, ts }) => ({ key, count, ts })));
+    } catch (err) {
+      // network error: keep the events (same keys) and retry with backoff
+      scheduleFlush(retryDelay);
+      retryDelay = Math.min(retryDelay * 2, RETRY_MAX_MS);
+      throw err;
+    }
+    const body = await res.json().catch(() => ({}));
+    if (res.status >= 500) {
+      scheduleFlush(Number(res.headers.get('Retry-After')) * 1000 || retryDelay);
+      retryDelay = Math.min(retryDelay * 2, RETRY_MAX_MS);
+      throw new Error(body.error || `bottle batch failed: ${res.status}`);
+    }
+    retryDelay = RETRY_BASE_MS;
+    pending = pending.filter((e) => !batch.includes(e));
+    if (!res.ok) {
+      const err = new Error(body.error || `bottle batch rejected: ${res.status}`);
+      batch.forEach((e) => e.reject(err));
+      throw err;
+    }
+    batch.forEach((e) => e.resolve(body));
+    window.dispatchEvent(new CustomEvent('bottle-registered', {
+      detail: { session_id: sessionId, bottles: Number(body.bottles_inserted ?? 0), seconds: Number(body.seconds_earned ?? 0) }
+    }));
+    return body;
+  })();
+
+  try {
+    return await inFlight;
+  } finally {
+    inFlight = null;
+    if (pending.length && !flushTimer) scheduleFlush(0);
+  }
+}
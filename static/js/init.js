@@ -1,6 +1,5 @@
 import { $, openModal, closeModal } from './dom.js';
 import { startBottleTimer, registerBottle } from './timer.js';
-import { initMockDevPanel } from './mockDevPanel.js';
 import {
   getCurrentSessionId,
   createSession,
@@ -106,6 +105,16 @@ document.addEventListener('DOMContentLoaded', async () => {
       });
     }
 
+    // Our turn in the insertion line: acquire the reserved lock and open the modal
+    window.addEventListener('insertion-turn', () => {
+      if (insertBtn && !insertBtn.disabled) insertBtn.click();
+    });
+
+    // Lease reclaimed while the modal was open (phone slept): reload server state
+    window.addEventListener('insertion-lock-lost', () => {
+      lookupSession().catch((e) => console.warn('lookupSession after lost lock failed', e));
+    });
+
     // X button handler for modal (single handler)
     const modalCloseX = document.getElementById('modal-close-x');
     if (modalCloseX) {
@@ -166,7 +175,12 @@ document.addEventListener('DOMContentLoaded', async () => {
       howBtn.addEventListener('click', () => openModal('modal-howitworks'));
     }
 
-    initMockDevPanel();
+    // the dev panel is only rendered with MOCK_SENSOR; production never fetches its module
+    if ($('mock-dev-panel')) {
+      import('./mockDevPanel.js')
+        .then(({ initMockDevPanel }) => initMockDevPanel())
+        .catch((e) => console.warn('Failed to load dev panel', e));
+    }
 
     // ✅ If we just returned from rating page, show success toast once
     try {
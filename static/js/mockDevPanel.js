@@ -12,6 +12,7 @@ let yOffset = 0;
 
 import { bottleInserted, createSession, lookupSession, getCurrentSessionId } from './sessionManager.js';
 import { updateConnectionStatus } from './ui.js';
+import { queueBottle } from './bottleBuffer.js';
 
 export function initMockDevPanel() {
   const panel = document.getElementById('mock-dev-panel');
@@ -64,23 +65,17 @@ export function initMockDevPanel() {
       }
 
       try {
-        const response = await fetch('/api/bottle', {
-          method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify({ session_id: sessionId })
-        });
-
-        const contentType = response.headers.get('content-type');
-        if (!contentType || !contentType.includes('application/json')) {
-          const text = await response.text();
-          console.error('❌ Expected JSON but got:', text.substring(0, 200));
-          showToast('Server returned invalid response (not JSON)', 'error', 5000);
-          return;
+        // rapid clicks are coalesced into one /api/bottle/batch request
+        let data;
+        let failure = null;
+        try {
+          data = await queueBottle(sessionId, 1);
+        } catch (err) {
+          failure = err;
+          data = { error: err.message };
         }
-
-        const data = await response.json();
         
-        if (response.ok) {
+        if (!failure) {
           if (sessionInfo) {
             const status = data.status || 'active';
             const endTime = data.session_end ? new Date(data.session_end * 1000).toLocaleTimeString() : 'N/A';
@@ -1,3 +1,5 @@
+import { postIdempotent } from './api/retry.js';
+
 function showToast(message, type = 'info', duration = 4000) {
   // Prefer existing global toast helper if available
   if (window.showToast && typeof window.showToast === 'function') {
@@ -71,11 +73,8 @@ document.addEventListener('DOMContentLoaded', () => {
     payload.comment = (document.getElementById('rating-comment')?.value || '').trim();
 
     try {
-      const res = await fetch('/api/rating', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify(payload)
-      });
+      // retried with one Idempotency-Key, so a flaky link can't submit twice
+      const res = await postIdempotent('/api/rating', payload);
 
       if (!res.ok) {
         const body = await res.json().catch(() => ({}));
@@ -1,6 +1,7 @@
 import { $, showToast } from './dom.js';
 import { formatTime, getCurrentTimestamp } from './utils.js';
-import { lookupSession as apiLookupSession, acquireInsertionLock, unlockInsertion, postBottles, activateSession as apiActivateSession, getSession as apiGetSession } from './api/sessionApi.js';
+import { lookupSession as apiLookupSession, acquireInsertionLock, unlockInsertion, postBottles, postBottleEvents, activateSession as apiActivateSession, getSession as apiGetSession, getQueueStatus } from './api/sessionApi.js';
+import { flushBottles } from './bottleBuffer.js';
 import { updateButtonStates, updateConnectionStatus } from './ui.js';
 import { startSessionCountdown, stopSessionCountdown } from './timer.js';
 
@@ -11,6 +12,9 @@ let isCommitting = false;
 let serverBottleCount = 0; // track server-side known count to avoid double-posting
 let wasActiveBeforeInsertion = false; // track if session was active when insert modal opened
 let lastActiveSessionBeforeInsertion = null; // snapshot of active session before insertion modal
+let queuePollTimer = null; // polling /api/session/queue while waiting for the insertion lock
+const QUEUE_POLL_MS = 5000;
+const ACTIVATION_RETRY_MS = 10000; // re-ask for an active slot while queued for capacity
 // Expose for timer/UI modules
 if (typeof window !== 'undefined') {
   window.sessionManager = {
@@ -56,9 +60,13 @@ export async function createSession(mac_address = null, ip_address = null) {
 
     if (res.status === 409) {
       const body = await res.json().catch(() => ({}));
-      const msg = body.message || body.error || 'Machine is currently busy';
+      let msg = body.message || body.error || 'Machine is currently busy';
+      if (body.queued && body.eta_seconds) {
+        msg += ` Estimated wait: ${Math.max(1, Math.round(body.eta_seconds / 60))} min.`;
+      }
       showToast(msg, 'error', 8000);
       console.warn('createSession: lock denied:', msg);
+      if (body.queued) waitForInsertionTurn();
       throw new Error(msg);
     }
     if (!res.ok) {
@@ -98,6 +106,42 @@ export async function createSession(mac_address = null, ip_address = null) {
   }
 }
 
+// Poll our place in the insertion line; when the server reserves the lock for
+// us, emit 'insertion-turn' so the page can acquire it and open the modal.
+export function waitForInsertionTurn() {
+  if (queuePollTimer) return;
+  let lastPosition = null;
+  const poll = async () => {
+    try {
+      const status = await getQueueStatus();
+      if (!status.queued) {
+        stopWaitingForTurn();
+        return;
+      }
+      if (status.your_turn) {
+        stopWaitingForTurn();
+        showToast("It's your turn! Insert your bottles now.", 'success', 5000);
+        window.dispatchEvent(new CustomEvent('insertion-turn', { detail: status }));
+        return;
+      }
+      if (status.position !== lastPosition) {
+        lastPosition = status.position;
+        window.dispatchEvent(new CustomEvent('insertion-queue-updated', { detail: status }));
+      }
+    } catch (e) {
+      console.warn('waitForInsertionTurn: poll failed', e);
+    }
+  };
+  queuePollTimer = setInterval(poll, QUEUE_POLL_MS);
+}
+
+export function stopWaitingForTurn() {
+  if (queuePollTimer) {
+    clearInterval(queuePollTimer);
+    queuePollTimer = null;
+  }
+}
+
 export function activateSession(session_id, bottles = 0, seconds = 0) {
   if (!session_id) {
     console.warn('activateSession: missing session_id');
@@ -244,12 +288,22 @@ window.addEventListener('bottles-committed', async (ev) => {
         pendingSessionData.session_end > Math.floor(Date.now() / 1000)
       );
 
+    // Send any bottles still sitting in the coalescing buffer first
+    try {
+      await flushBottles();
+    } catch (e) {
+      console.warn('bottles-committed: flushing buffered bottles failed', e);
+    }
+
     // Compute delta vs what server already knows to avoid double-increment.
     const delta = Math.max(0, bottles - (serverBottleCount || 0));
     let res = null;
     if (delta > 0) {
-      // Preferred: send only the delta
-      res = await postBottles(sessionId, delta);
+      // Preferred: send only the delta, keyed by the committed total so a retried commit can't double-credit
+      res = await postBottleEvents(sessionId, [
+        { key: `commit-${sessionId}-${bottles}`, count: delta, ts: Math.floor(Date.now() / 1000) }
+      ]);
+      if (res && res.status === 503) res = await postBottles(sessionId, delta);
       if (!res || !res.ok) {
         // fallback: some servers expect one-by-one increments; try loop fallback
         console.warn('postBottles failed, falling back to per-bottle POST for delta');
@@ -306,8 +360,9 @@ window.addEventListener('bottles-committed', async (ev) => {
         console.error('Failed to refresh session after committing bottles for active session', e);
       }
     } else {
-      // Activate session on server (server will set status -> active and set start/end)
-      const actRes = await apiActivateSession(sessionId);
+      // Activate session on server (server will set status -> active and set start/end);
+      // waits in line while the hotspot is at its active-session cap
+      const actRes = await activateWhenAdmitted(sessionId);
       if (!actRes.ok) {
         const body = await actRes.json().catch(() => ({}));
         console.error('Failed to activate session', sessionId, actRes.status, body);
@@ -355,6 +410,28 @@ window.addEventListener('bottles-committed', async (ev) => {
 
 export { handleBottleInserted as bottleInserted };
 
+// POST activate until the server gives us a slot. A 202 {queued: true} means
+// the hotspot is full: our time stays paused and we ask again after Retry-After.
+async function activateWhenAdmitted(sessionId) {
+  let lastPosition = null;
+  for (;;) {
+    const res = await apiActivateSession(sessionId);
+    if (res.status !== 202) return res;
+    const body = await res.json().catch(() => ({}));
+    if (!body.queued) return res;
+    if (body.position !== lastPosition) {
+      lastPosition = body.position;
+      let msg = `Hotspot is full. You are #${body.position} in line; your time starts when a slot frees up.`;
+      if (body.eta_seconds) msg += ` Estimated wait: ${Math.max(1, Math.round(body.eta_seconds / 60))} min.`;
+      showToast(msg, 'info', 8000);
+      window.dispatchEvent(new CustomEvent('activation-queued', { detail: body }));
+    }
+    updateButtonStates({ status: 'awaiting_insertion' });
+    const retryAfter = Number(res.headers.get('Retry-After')) || ACTIVATION_RETRY_MS / 1000;
+    await new Promise((resolve) => setTimeout(resolve, retryAfter * 1000));
+  }
+}
+
 // Helper: load session object into manager state + UI, dispatch update event
 export function loadSession(session) {
   if (!session) {
@@ -1,13 +1,17 @@
 const BOTTLE_TIMER_DURATION = 180; // seconds (3 minutes)
 const SECONDS_PER_BOTTLE = 120; // seconds earned per bottle
+const HEARTBEAT_INTERVAL = 5000; // ms; the server reclaims the lock after a few missed beats
 
 import { $ } from './ui.js';
-import { closeModal } from './dom.js';
+import { closeModal, showToast } from './dom.js';
+import { sendHeartbeat, unlockInsertionOnExit } from './api/sessionApi.js';
+import { queueBottle } from './bottleBuffer.js';
 
 let bottleTimerInterval = null;
 let bottleTimeRemaining = BOTTLE_TIMER_DURATION;
 let bottleCount = 0;
 let currentSessionId = null;
+let heartbeatInterval = null;
 
 // session countdown (exported for sessionManager.js)
 let sessionTimerInterval = null;
@@ -57,6 +61,8 @@ export function startBottleTimer(sessionId = null, initialBottles = 0, initialSe
     }
   }, 1000);
 
+  startHeartbeat();
+
   // Attach Done button handler (idempotent)
   if (doneBtn) {
     doneBtn.onclick = () => {
@@ -73,7 +79,51 @@ export function stopBottleTimer() {
   handleTimerEnd();
 }
 
+// Tell the server the insert modal is still open so it keeps the insertion lock.
+function startHeartbeat() {
+  stopHeartbeat();
+  if (!currentSessionId) return;
+  const sessionId = currentSessionId;
+  const beat = async () => {
+    try {
+      const res = await sendHeartbeat(sessionId);
+      if (res.status === 409) {
+        // lock already reclaimed (e.g. tab was suspended too long); the server
+        // kept any bottles already counted
+        console.warn('heartbeat: insertion lock no longer held');
+        stopHeartbeat();
+        if (bottleTimerInterval) {
+          clearInterval(bottleTimerInterval);
+          bottleTimerInterval = null;
+        }
+        try { closeModal('modal-insert-bottle'); } catch (e) {}
+        showToast('Insertion timed out. Bottles already counted are kept; tap Insert to add more.', 'error', 8000);
+        window.dispatchEvent(new CustomEvent('insertion-lock-lost', { detail: { session_id: sessionId } }));
+      }
+    } catch (e) {
+      console.warn('heartbeat failed', e);
+    }
+  };
+  beat();
+  heartbeatInterval = setInterval(beat, HEARTBEAT_INTERVAL);
+  window.addEventListener('pagehide', releaseOnExit);
+}
+
+function stopHeartbeat() {
+  if (heartbeatInterval) {
+    clearInterval(heartbeatInterval);
+    heartbeatInterval = null;
+  }
+  window.removeEventListener('pagehide', releaseOnExit);
+}
+
+// Closing the tab mid-insertion frees the machine right away
+function releaseOnExit() {
+  if (heartbeatInterval) unlockInsertionOnExit();
+}
+
 function handleTimerEnd() {
+  stopHeartbeat();
   try { closeModal('modal-insert-bottle'); } catch (e) {}
   const secondsEarned = bottleCount * SECONDS_PER_BOTTLE;
   // emit an event other modules listen to
@@ -90,6 +140,7 @@ function handleTimerEnd() {
 }
 
 // ✅ registerBottle now increments from current state
+// Bottles are coalesced by bottleBuffer.js; it emits 'bottle-registered' with the server totals.
 export async function registerBottle(count = 1) {
   if (!currentSessionId) {
     console.warn('registerBottle: no currentSessionId');
@@ -97,37 +148,11 @@ export async function registerBottle(count = 1) {
   }
 
   try {
-    const res = await fetch('/api/bottle', {
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ session_id: currentSessionId, count })
-    });
-
-    if (!res.ok) {
-      const body = await res.json().catch(() => ({}));
-      console.error('registerBottle: /api/bottle failed', res.status, body);
-      if (window.showToast) {
-        window.showToast(body.error || 'Failed to register bottle', 'error', 4000);
-      }
-      return;
-    }
-
-    const data = await res.json().catch(() => ({}));
-    const bottles = Number(data.bottles_inserted ?? 0);
-    const seconds = Number(data.seconds_earned ?? 0);
-
-    // Notify sessionManager so it can update bottle-count + time-earned
-    window.dispatchEvent(new CustomEvent('bottle-registered', {
-      detail: {
-        session_id: currentSessionId,
-        bottles,
-        seconds
-      }
-    }));
+    await queueBottle(currentSessionId, count);
   } catch (err) {
-    console.error('registerBottle error', err);
+    console.error('registerBottle: /api/bottle/batch failed', err);
     if (window.showToast) {
-      window.showToast('Error registering bottle', 'error', 4000);
+      window.showToast(err.message || 'Failed to register bottle', 'error', 4000);
     }
   }
 }